@@ -0,0 +1,214 @@
+import numpy as np
+import collections
+import hashlib
+import mmap
+import os
+import tempfile
+
+# The folder of the binary annotation cache, shared by all the scripts
+ANNOTATION_CACHE_FOLDER = os.path.join(
+    os.path.expanduser("~"), ".cache", "musicology", "annotations"
+)
+CACHE_MAGIC = b"ASAPBEAT"
+CACHE_VERSION = 1
+
+# The header of a cache file, followed by the beat times, the time signature events, the key events and the
+# downbeat flags, each section being aligned on 8 bytes so that the arrays are read in place from the memory map
+CACHE_HEADER_DTYPE = np.dtype(
+    [
+        ("magic", "S8"),
+        ("version", "<u8"),
+        ("mtime_ns", "<i8"),
+        ("size", "<i8"),
+        ("nr_beats", "<i8"),
+        ("nr_time_signatures", "<i8"),
+        ("nr_keys", "<i8"),
+        ("padding", "<i8"),
+    ]
+)
+BEAT_TIME_DTYPE = np.dtype("<f8")
+TIME_SIGNATURE_DTYPE = np.dtype(
+    [("beat", "<i8"), ("numerator", "<i8"), ("denominator", "<i8")]
+)
+KEY_DTYPE = np.dtype([("beat", "<i8"), ("key", "<i8")])
+
+Annotation = collections.namedtuple(
+    "Annotation", ["beat_times", "is_downbeat", "time_signatures", "keys"]
+)
+Annotation.__doc__ = """The beats of an annotation file of the ASAP dataset.
+
+Args:
+    beat_times: The time of each beat, in seconds.
+    is_downbeat: Whether each beat is a downbeat.
+    time_signatures: The time signature changes, the beat at which each one starts, its numerator and denominator.
+    keys: The key changes, the beat at which each one starts and its number of sharps, negative for flats.
+"""
+
+
+def parse_annotation_file(file_path):
+    """Parse an annotation file of the ASAP dataset, whose lines are the time of a beat, repeated, and its label,
+    such as "db,3/4,-2" for a downbeat starting the time signature 3/4 in the key with two flats, or "b".
+
+    Args:
+        file_path: The annotation file.
+    """
+    with open(file_path, "r") as f:
+        lines = f.readlines()
+
+    beat_times = np.empty(len(lines), dtype=BEAT_TIME_DTYPE)
+    is_downbeat = np.zeros(len(lines), dtype=bool)
+    time_signatures = []
+    keys = []
+    for beat, line in enumerate(lines):
+        splits = line.split("\t")
+        beat_times[beat] = float(splits[0])
+        labels = splits[-1].strip().split(",")
+        is_downbeat[beat] = labels[0].startswith("db")
+        if len(labels) > 1 and "/" in labels[1]:
+            numerator, denominator = labels[1].strip().split("/")
+            time_signatures.append((beat, int(numerator), int(denominator)))
+        if len(labels) > 2 and labels[2].strip().lstrip("+-").isdigit():
+            keys.append((beat, int(labels[2])))
+
+    return Annotation(
+        beat_times,
+        is_downbeat,
+        np.array(time_signatures, dtype=TIME_SIGNATURE_DTYPE),
+        np.array(keys, dtype=KEY_DTYPE),
+    )
+
+
+def get_cache_file(file_path, cache_folder=ANNOTATION_CACHE_FOLDER):
+    """Return the cache file of an annotation file, named after the hash of its absolute path.
+
+    Args:
+        file_path: The annotation file.
+        cache_folder: The folder of the cache.
+    """
+    path_hash = hashlib.sha256(os.path.abspath(file_path).encode()).hexdigest()
+    return os.path.join(cache_folder, path_hash[:32] + ".beats")
+
+
+def get_section_size(nr_bytes):
+    """Return the size of a section of a cache file, padded to a multiple of 8 bytes.
+
+    Args:
+        nr_bytes: The size of the content of the section.
+    """
+    return (nr_bytes + 7) // 8 * 8
+
+
+def write_annotation_cache(cache_file, stat, annotation):
+    """Write the binary cache of an annotation file, replacing the previous one atomically.
+
+    Args:
+        cache_file: The cache file.
+        stat: The os.stat of the annotation file, whose modification time and size validate the cache.
+        annotation: The annotation, see Annotation.
+    """
+    header = np.zeros(1, dtype=CACHE_HEADER_DTYPE)
+    header["magic"] = CACHE_MAGIC
+    header["version"] = CACHE_VERSION
+    header["mtime_ns"] = stat.st_mtime_ns
+    header["size"] = stat.st_size
+    header["nr_beats"] = len(annotation.beat_times)
+    header["nr_time_signatures"] = len(annotation.time_signatures)
+    header["nr_keys"] = len(annotation.keys)
+
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    fd, temporary_file = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for section in (
+                header,
+                annotation.beat_times.astype(BEAT_TIME_DTYPE, copy=False),
+                annotation.time_signatures.astype(TIME_SIGNATURE_DTYPE, copy=False),
+                annotation.keys.astype(KEY_DTYPE, copy=False),
+                annotation.is_downbeat.astype(np.uint8),
+            ):
+                content = section.tobytes()
+                f.write(content)
+                f.write(bytes(get_section_size(len(content)) - len(content)))
+        os.replace(temporary_file, cache_file)
+    except BaseException:
+        os.remove(temporary_file)
+        raise
+
+
+def read_annotation_cache(cache_file, stat):
+    """Return the annotation memory-mapped from its binary cache, or None if there is no valid cache, the annotation
+    file having been modified or resized since the cache was written.
+
+    Args:
+        cache_file: The cache file.
+        stat: The os.stat of the annotation file.
+    """
+    try:
+        with open(cache_file, "rb") as f:
+            cache = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(cache) < CACHE_HEADER_DTYPE.itemsize:
+        return None
+    header = np.frombuffer(cache, dtype=CACHE_HEADER_DTYPE, count=1)[0]
+    if (
+        header["magic"] != CACHE_MAGIC
+        or header["version"] != CACHE_VERSION
+        or header["mtime_ns"] != stat.st_mtime_ns
+        or header["size"] != stat.st_size
+    ):
+        return None
+
+    sections = []
+    offset = CACHE_HEADER_DTYPE.itemsize
+    for dtype, count in (
+        (BEAT_TIME_DTYPE, header["nr_beats"]),
+        (TIME_SIGNATURE_DTYPE, header["nr_time_signatures"]),
+        (KEY_DTYPE, header["nr_keys"]),
+        (np.dtype(bool), header["nr_beats"]),
+    ):
+        count = int(count)
+        if offset + dtype.itemsize * count > len(cache):
+            return None
+        sections.append(np.frombuffer(cache, dtype=dtype, count=count, offset=offset))
+        offset += get_section_size(dtype.itemsize * count)
+    beat_times, time_signatures, keys, is_downbeat = sections
+    return Annotation(beat_times, is_downbeat, time_signatures, keys)
+
+
+def load_annotation(file_path, cache_folder=ANNOTATION_CACHE_FOLDER):
+    """Return the annotation of an annotation file, read from its binary cache if the file was not modified since
+    it was cached, and parsed and cached otherwise.
+
+    Args:
+        file_path: The annotation file.
+        cache_folder: The folder of the cache, the file being parsed without cache if None.
+    """
+    if cache_folder is None:
+        return parse_annotation_file(file_path)
+
+    stat = os.stat(file_path)
+    cache_file = get_cache_file(file_path, cache_folder)
+    annotation = read_annotation_cache(cache_file, stat)
+    if annotation is not None:
+        return annotation
+
+    annotation = parse_annotation_file(file_path)
+    try:
+        write_annotation_cache(cache_file, stat, annotation)
+    except OSError:
+        # the annotation is still returned if the cache folder is not writable
+        pass
+    return annotation
+
+
+def get_time_signature_name(annotation):
+    """Return the first time signature of the annotation, such as "3/4", or None if it has none.
+
+    Args:
+        annotation: The annotation, see Annotation.
+    """
+    if len(annotation.time_signatures) == 0:
+        return None
+    time_signature = annotation.time_signatures[0]
+    return f"{time_signature['numerator']}/{time_signature['denominator']}"
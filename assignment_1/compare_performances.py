@@ -8,27 +8,18 @@ def compare_different_performances(performances_folder_path):
     total_multipliers = {}
     for subdir, dirs, files in os.walk(performances_folder_path):
         unperformed_annotation = "midi_score_annotations.txt"
-        unperf_lines = open(
-            performances_folder_path + "/" + unperformed_annotation, "r"
-        ).readlines()
-        durations_unperformed = get_durations(unperf_lines)
+        unperformed_beat_times, _ = read_annotation(
+            performances_folder_path + "/" + unperformed_annotation
+        )
+        durations_unperformed = np.diff(unperformed_beat_times)
         for annot_file in files:
             # if it is a performance annotation file
             if annot_file.endswith(".txt") and annot_file != unperformed_annotation:
-                perf_lines = open(
-                    performances_folder_path + "/" + annot_file, "r"
-                ).readlines()
-                durations_performed = get_durations(perf_lines)
-                # Make sure the number of beats in the performed and unperformed files is the same
-                if len(perf_lines) < len(unperf_lines):
-                    durations_unperformed = durations_unperformed[: len(perf_lines) - 1]
-                elif len(perf_lines) > len(unperf_lines):
-                    lines_to_add_to_unperf = len(perf_lines) - len(unperf_lines)
-                    avg_duration = get_avg_duration(durations_unperformed)
-                    for i in range(lines_to_add_to_unperf):
-                        durations_unperformed.append(avg_duration)
-                multipliers = get_unperformed_to_performed_multipliers(
-                    durations_unperformed, durations_performed
+                performed_beat_times, _ = read_annotation(
+                    performances_folder_path + "/" + annot_file
+                )
+                multipliers = get_performance_multipliers(
+                    durations_unperformed, performed_beat_times
                 )
 
                 total_multipliers[annot_file] = {
@@ -1,117 +1,169 @@
 from taskA import (
+    ANNOTATION_SUFFIX,
+    MultiplierAggregator,
+    find_pieces,
+    load_aggregator,
+    map_pieces,
     plot_timing_function,
-    get_time_signature,
+    read_annotation,
     get_unperformed_to_performed_multipliers,
 )
 import mido
+import numpy as np
 import os
 import matplotlib.pyplot as plt
 import argparse
+import functools
 
 
-def get_velocities(midi_file_path):
-    mid = mido.MidiFile(midi_file_path)
+def get_onsets_and_velocities(midi_file_path):
+    """
+    Get the onset times in seconds and the velocities of the notes of a MIDI file, in all its tracks.
+    """
+    onsets = []
     velocities = []
+    time = 0.0
+    # the messages of the merged tracks, timed in seconds with the tempo changes
+    for msg in mido.MidiFile(midi_file_path):
+        time += msg.time
+        if msg.type == "note_on" and msg.velocity != 0:
+            onsets.append(time)
+            velocities.append(msg.velocity)
 
-    for track in mid.tracks:
-        for msg in track:
-            if msg.type == "note_on" and msg.velocity != 0:
-                velocities.append(msg.velocity)
-
-    return velocities
+    return np.array(onsets), np.array(velocities, dtype=np.float64)
 
 
-def get_avg_velocity(velocities):
-    return sum(velocities) / len(velocities)
+def get_beat_velocities(onsets, velocities, beat_times):
+    """
+    Get the average velocity of the notes played during each beat, from its time to the time of the next beat.
+    The notes after the last beat belong to it, and the notes before the first beat are left out.
+    Return a dense array of the velocity of each beat, NaN for the beats without notes.
+    """
+    beats = np.searchsorted(beat_times, onsets, side="right") - 1
+    is_played = beats >= 0
+    sums = np.bincount(
+        beats[is_played], weights=velocities[is_played], minlength=len(beat_times)
+    )
+    counts = np.bincount(beats[is_played], minlength=len(beat_times))
+    return np.divide(
+        sums, counts, out=np.full(len(beat_times), np.nan), where=counts > 0
+    )
+
+
+def get_midi_beat_velocities(midi_file_path, annotation_file_path):
+    """
+    Get the average velocity of each beat of a MIDI file, whose beats are given by its annotation file.
+    """
+    beat_times, _ = read_annotation(annotation_file_path)
+    return get_beat_velocities(*get_onsets_and_velocities(midi_file_path), beat_times)
 
 
-def calculate_avg_multiplier(subcorpus_path):
+def aggregate_piece_velocities(piece, subcorpus_path):
     """
-    Calculate the average multiplier for each beat for each time signature.
-    Loop through all subfolders and for each subfolder, get the velocities of the performed and unperformed files.
-    Calculate the multipliers for each beat by dividing the velocity of the performed file by the velocity of the unperformed file.
-    Update the sum and number of multipliers for each time signature and beat.
-    Return the average multiplier for each time signature and beat.
+    Aggregate the velocity multipliers of the performances of a piece, recorded by the path of their MIDI file
+    relative to the subcorpus. The performances without MIDI file are left out.
     """
-    # for each time signature, for each beat,
-    # calculate the average multiplier by dividing the sum of the multipliers by the number of multipliers
-    sum_mult_per_time_sig_per_beat = {}
-    nr_of_mult_per_time_sig_per_beat = {}
-    avg_mult_per_time_sig_per_beat = {}
-
-    # go through all subfolders
-    for subdir, dirs, files in os.walk(subcorpus_path):
-        unperformed_annotation = "midi_score_annotations.txt"
-        unperformed_midi = "midi_score.mid"
-        if unperformed_annotation not in files:
+    unperformed_annotation_file_path, performed_annotation_file_paths = piece
+    _, time_signature = read_annotation(unperformed_annotation_file_path)
+    velocities_unperformed = get_midi_beat_velocities(
+        os.path.join(
+            os.path.dirname(unperformed_annotation_file_path), "midi_score.mid"
+        ),
+        unperformed_annotation_file_path,
+    )
+
+    aggregator = MultiplierAggregator()
+    for performed_annotation_file_path in performed_annotation_file_paths:
+        performed_file_path = (
+            performed_annotation_file_path[: -len(ANNOTATION_SUFFIX)] + ".mid"
+        )
+        if not os.path.exists(performed_file_path):
             continue
-
-        unperformed_file_path = os.path.join(subdir, unperformed_midi)
-
-        unperformed_annotation_file_path = os.path.join(subdir, unperformed_annotation)
-        unperf_lines = open(unperformed_annotation_file_path, "r").readlines()
-        time_signature = get_time_signature(unperf_lines).strip()
-
-        midi_files = [file for file in files if file.endswith(".mid")]
-        for midi_file in midi_files:
-            if midi_file == unperformed_midi:
-                continue
-            velocities_unperformed = get_velocities(unperformed_file_path)
-
-            performed_file_path = os.path.join(subdir, midi_file)
-            velocities_perfomed = get_velocities(performed_file_path)
-
-            # Make sure the number of beats in the performed and unperformed files is the same
-            if len(velocities_perfomed) < len(velocities_unperformed):
-                velocities_unperformed = velocities_unperformed[
-                    : len(velocities_perfomed) - 1
-                ]
-            elif len(velocities_perfomed) > len(velocities_unperformed):
-                lines_to_add_to_unperf = len(velocities_perfomed) - len(
-                    velocities_unperformed
-                )
-                avg_velocity = get_avg_velocity(velocities_unperformed)
-                for i in range(lines_to_add_to_unperf):
-                    velocities_unperformed.append(avg_velocity)
-
-            # Initialize the time signature dictionary if it is not present
-            if time_signature not in sum_mult_per_time_sig_per_beat:
-                sum_mult_per_time_sig_per_beat[time_signature] = {}
-                nr_of_mult_per_time_sig_per_beat[time_signature] = {}
-
-            multipliers = get_unperformed_to_performed_multipliers(
-                velocities_unperformed, velocities_perfomed
+        velocities_performed = get_midi_beat_velocities(
+            performed_file_path, performed_annotation_file_path
+        )
+
+        # Compare the beats of both files
+        nr_beats = min(len(velocities_unperformed), len(velocities_performed))
+        multipliers = get_unperformed_to_performed_multipliers(
+            velocities_unperformed[:nr_beats], velocities_performed[:nr_beats]
+        )
+        aggregator.add_performance(
+            time_signature,
+            multipliers,
+            os.path.relpath(performed_file_path, subcorpus_path),
+        )
+    return aggregator
+
+
+def aggregate_velocity_multipliers(subcorpus_path, aggregator=None, nr_workers=None):
+    """
+    Add the velocity multipliers of the performances of the subcorpus which were not added yet to the aggregator.
+    For each piece, bin the velocities of the notes of the performed and unperformed MIDI files into the beats of their annotations.
+    Calculate the multipliers for each beat by dividing the velocity of the performed file by the velocity of the unperformed file.
+    Return the aggregator of the multipliers for each time signature and beat, a new one if none is given.
+    """
+    if aggregator is None:
+        aggregator = MultiplierAggregator()
+    pieces = []
+    for unperformed_file_path, performed_file_paths in find_pieces(subcorpus_path):
+        new_performed_file_paths = [
+            performed_file_path
+            for performed_file_path in performed_file_paths
+            if os.path.relpath(
+                performed_file_path[: -len(ANNOTATION_SUFFIX)] + ".mid", subcorpus_path
             )
+            not in aggregator.performances
+        ]
+        if new_performed_file_paths:
+            pieces.append((unperformed_file_path, new_performed_file_paths))
 
-            # Update the sum and number of multipliers for each time signature and beat
-            for beat, mult in enumerate(multipliers):
-                if beat not in sum_mult_per_time_sig_per_beat[time_signature]:
-                    sum_mult_per_time_sig_per_beat[time_signature][beat] = mult
-                    nr_of_mult_per_time_sig_per_beat[time_signature][beat] = 1
-                sum_mult_per_time_sig_per_beat[time_signature][beat] += mult
-                nr_of_mult_per_time_sig_per_beat[time_signature][beat] += 1
-
-    # Calculate the average multiplier for each time signature and beat
-    for time_signature in sum_mult_per_time_sig_per_beat:
-        avg_mult_per_time_sig_per_beat[time_signature] = {}
-        for beat in sum_mult_per_time_sig_per_beat[time_signature]:
-            avg_mult_per_time_sig_per_beat[time_signature][beat] = (
-                sum_mult_per_time_sig_per_beat[time_signature][beat]
-                / nr_of_mult_per_time_sig_per_beat[time_signature][beat]
-            )
+    for piece_aggregator in map_pieces(
+        functools.partial(aggregate_piece_velocities, subcorpus_path=subcorpus_path),
+        pieces,
+        nr_workers,
+    ):
+        aggregator.merge(piece_aggregator)
+    return aggregator
 
-    return avg_mult_per_time_sig_per_beat
+
+def calculate_avg_multiplier(subcorpus_path, nr_workers=None):
+    """
+    Calculate the average velocity multiplier for each beat for each time signature.
+    """
+    return aggregate_velocity_multipliers(
+        subcorpus_path, nr_workers=nr_workers
+    ).get_avg_multiplier()
 
 
 if __name__ == "__main__":
     # use argparse and take subcorpus path as input
     parser = argparse.ArgumentParser()
     parser.add_argument("subcorpus_path", help="path to the subcorpus")
+    parser.add_argument(
+        "--aggregator",
+        help="file of the running statistics of the velocity multipliers, updated with the performances not added yet",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="number of processes reading the pieces, by default the number of CPUs",
+    )
     args = parser.parse_args()
 
     # get the subcorpus path folder containing the annotations of the performed and unperformed midi in each subfolder
     subcorpus_path = args.subcorpus_path
 
-    avg_mult_per_time_sig_per_beat = calculate_avg_multiplier(subcorpus_path)
-
-    plot_timing_function(avg_mult_per_time_sig_per_beat, ylabel="note number")
+    if args.aggregator is not None:
+        aggregator = aggregate_velocity_multipliers(
+            subcorpus_path, load_aggregator(args.aggregator), args.workers
+        )
+        aggregator.save(args.aggregator)
+        avg_mult_per_time_sig_per_beat = aggregator.get_avg_multiplier()
+    else:
+        avg_mult_per_time_sig_per_beat = calculate_avg_multiplier(
+            subcorpus_path, args.workers
+        )
+
+    plot_timing_function(avg_mult_per_time_sig_per_beat)
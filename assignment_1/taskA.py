@@ -1,125 +1,376 @@
 import os
 import matplotlib.pyplot as plt
+import numpy as np
 import argparse
+import concurrent.futures
+import functools
+import json
 
+from annotations import get_time_signature_name, load_annotation
 
-def get_time_signature(lines):
+UNPERFORMED_ANNOTATION = "midi_score_annotations.txt"
+ANNOTATION_SUFFIX = "_annotations.txt"
+
+
+def get_avg_duration(durations):
+    """
+    Calculate the average duration of the a list of durations.
+    """
+    return sum(durations) / len(durations)
+
+
+def get_unperformed_to_performed_multipliers(
+    durations_unperformed, durations_performed
+):
+    """
+    Calculate the multipliers for each beat by dividing the duration of the performed file by the duration of the unperformed file.
+    """
+    durations_unperformed = np.asarray(durations_unperformed, dtype=np.float64)
+    durations_performed = np.asarray(durations_performed, dtype=np.float64)
+    return durations_performed[: len(durations_unperformed)] / durations_unperformed
+
+
+def read_annotation(file_path):
+    """
+    Read the beat times and the time signature of an annotation file.
+    The file is parsed once into the binary annotation cache, and read from it until it is modified.
+    """
+    annotation = load_annotation(file_path)
+    return annotation.beat_times, get_time_signature_name(annotation)
+
+
+def find_pieces(subcorpus_path):
     """
-    Get the time signature from the lines of the file.
+    Find the pieces of the subcorpus, the subfolders containing an unperformed annotation file.
+    Return the path of the unperformed annotation file and the paths of the performed annotation files of each piece.
     """
-    time_signature = None
-    for line in lines:
-        splits = line.split(",")
-        if len(splits) < 2:
+    pieces = []
+    for subdir, dirs, files in os.walk(subcorpus_path):
+        if UNPERFORMED_ANNOTATION not in files:
             continue
-        time_signature = line.split(",")[1]
-        if "/" in time_signature:
-            return time_signature
-    return None
+        performed_file_paths = [
+            os.path.join(subdir, file)
+            for file in files
+            if file.endswith(ANNOTATION_SUFFIX) and file != UNPERFORMED_ANNOTATION
+        ]
+        pieces.append(
+            (os.path.join(subdir, UNPERFORMED_ANNOTATION), performed_file_paths)
+        )
+    return pieces
 
 
-def get_durations(lines):
+def get_performance_multipliers(durations_unperformed, performed_beat_times):
     """
-    Get the durations of the beats from the lines of the file.
+    Calculate the multipliers for each beat of a performance from the beat durations of the unperformed file.
+    The unperformed durations are cut to the beats of the performance, or extended with their average duration.
     """
-    durations = []
-    for i in range(len(lines) - 1):
-        durations.append(
-            float(lines[i + 1].split("\t")[0]) - float(lines[i].split("\t")[0])
+    durations_performed = np.diff(performed_beat_times)
+
+    # Make sure the number of beats in the performed and unperformed files is the same
+    nr_durations = len(durations_performed)
+    durations = durations_unperformed[:nr_durations]
+    if nr_durations > len(durations_unperformed):
+        durations = np.append(
+            durations,
+            np.full(
+                nr_durations - len(durations_unperformed),
+                get_avg_duration(durations_unperformed.tolist()),
+            ),
         )
-    return durations
+    return get_unperformed_to_performed_multipliers(durations, durations_performed)
 
 
-def get_avg_duration(durations):
+def get_piece_multipliers(piece):
     """
-    Calculate the average duration of the a list of durations.
+    Calculate the multipliers for each beat of each performance of a piece.
+    Return the time signature and the multipliers of each performance.
     """
-    return sum(durations) / len(durations)
+    unperformed_file_path, performed_file_paths = piece
+    unperformed_beat_times, _ = read_annotation(unperformed_file_path)
+    durations_unperformed = np.diff(unperformed_beat_times)
 
+    piece_multipliers = []
+    for performed_file_path in performed_file_paths:
+        performed_beat_times, time_signature = read_annotation(performed_file_path)
+        if time_signature is None:
+            raise ValueError(f"No time signature in {performed_file_path}")
+        piece_multipliers.append(
+            (
+                time_signature,
+                get_performance_multipliers(
+                    durations_unperformed, performed_beat_times
+                ),
+            )
+        )
+    return piece_multipliers
 
-def get_unperformed_to_performed_multipliers(
-    durations_unperformed, durations_performed
-):
+
+def map_pieces(function, pieces, nr_workers=None):
     """
-    Calculate the multipliers for each beat by dividing the duration of the performed file by the duration of the unperformed file.
+    Apply the function to each piece in a pool of processes, or in this process with a single worker.
+    Return the results in the order of the pieces.
+    """
+    if nr_workers == 1:
+        return list(map(function, pieces))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nr_workers) as executor:
+        return list(executor.map(function, pieces, chunksize=8))
+
+
+def sum_multipliers_per_beat(performance_multipliers, double_count_first=False):
+    """
+    Sum the multipliers of the performances for each beat, and count them.
+    Return the dense arrays of the sums and numbers of multipliers of the beats.
+    With double_count_first, the first multiplier of each beat is counted twice, as in the original script.
     """
-    multipliers = []
-    for i in range(len(durations_unperformed)):
-        mult = durations_performed[i] / durations_unperformed[i]
-        multipliers.append(mult)
-    return multipliers
+    multipliers = np.concatenate(performance_multipliers)
+    beats = np.concatenate(
+        [np.arange(len(multipliers)) for multipliers in performance_multipliers]
+    )
+    sums = np.bincount(beats, weights=multipliers)
+    counts = np.bincount(beats)
+    if double_count_first:
+        # every beat up to the last one has a first multiplier, in the first performance long enough
+        first_idx = np.unique(beats, return_index=True)[1]
+        sums += multipliers[first_idx]
+        counts += 1
+    return sums, counts
 
 
-def calculate_avg_multiplier(subcorpus_path):
+def calculate_avg_multiplier(subcorpus_path, nr_workers=None, double_count_first=False):
     """
     Calculate the average multiplier for each beat for each time signature.
-    Loop through all subfolders and for each subfolder, get the durations of the performed and unperformed files.
-    Calculate the multipliers for each beat by dividing the duration of the performed file by the duration of the unperformed file.
-    Update the sum and number of multipliers for each time signature and beat.
+    Find the pieces of the subcorpus once and calculate the multipliers of the performances of each piece in a pool of processes.
+    Sum the multipliers of each time signature and beat at once, in the order of the pieces whatever the number of processes.
+    With double_count_first, the first multiplier of each beat is counted twice, which reproduces the averages of the original script.
     Return the average multiplier for each time signature and beat.
     """
-    # for each time signature, for each beat,
-    # calculate the average multiplier by dividing the sum of the multipliers by the number of multipliers
-    sum_mult_per_time_sig_per_beat = {}
-    nr_of_mult_per_time_sig_per_beat = {}
+    all_piece_multipliers = map_pieces(
+        get_piece_multipliers, find_pieces(subcorpus_path), nr_workers
+    )
+
+    # the multipliers of each performance for each time signature, in the order of the pieces
+    multipliers_per_time_sig = {}
+    for piece_multipliers in all_piece_multipliers:
+        for time_signature, multipliers in piece_multipliers:
+            multipliers_per_time_sig.setdefault(time_signature, []).append(multipliers)
+
+    # Calculate the average multiplier for each time signature and beat
     avg_mult_per_time_sig_per_beat = {}
+    for time_signature, performance_multipliers in multipliers_per_time_sig.items():
+        sums, counts = sum_multipliers_per_beat(
+            performance_multipliers, double_count_first
+        )
+        avg_mult_per_time_sig_per_beat[time_signature] = dict(
+            enumerate((sums / counts).tolist())
+        )
 
-    # go through all subfolders
-    for subdir, dirs, files in os.walk(subcorpus_path):
-        unperformed_annotation = "midi_score_annotations.txt"
-        if unperformed_annotation not in files:
-            continue
+    return avg_mult_per_time_sig_per_beat
+
+
+class MultiplierAggregator:
+    """
+    Running statistics of the multipliers for each beat for each time signature, updated one performance at a time.
+    The number, mean and sum of squared deviations from the mean of the multipliers of each beat are updated with
+    Welford's algorithm, and the statistics of separate aggregators, of separate processes or machines, are merged.
+    The performances added are recorded, so that a performance is only added once.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.means = {}
+        self.m2s = {}
+        self.performances = set()
 
-        unperformed_file_path = os.path.join(subdir, unperformed_annotation)
-        unperf_lines = open(unperformed_file_path, "r").readlines()
-
-        annotation_files = [file for file in files if file.endswith("_annotations.txt")]
-        for annotation_file in annotation_files:
-            if annotation_file == unperformed_annotation:
-                continue
-            durations_unperformed = get_durations(unperf_lines)
-            performed_file_path = os.path.join(subdir, annotation_file)
-            perf_lines = open(performed_file_path, "r").readlines()
-
-            durations_performed = get_durations(perf_lines)
-
-            # Make sure the number of beats in the performed and unperformed files is the same
-            if len(perf_lines) < len(unperf_lines):
-                durations_unperformed = durations_unperformed[: len(perf_lines) - 1]
-            elif len(perf_lines) > len(unperf_lines):
-                lines_to_add_to_unperf = len(perf_lines) - len(unperf_lines)
-                avg_duration = get_avg_duration(durations_unperformed)
-                for i in range(lines_to_add_to_unperf):
-                    durations_unperformed.append(avg_duration)
-
-            time_signature = get_time_signature(perf_lines).strip()
-            # Initialize the time signature dictionary if it is not present
-            if time_signature not in sum_mult_per_time_sig_per_beat:
-                sum_mult_per_time_sig_per_beat[time_signature] = {}
-                nr_of_mult_per_time_sig_per_beat[time_signature] = {}
-
-            multipliers = get_unperformed_to_performed_multipliers(
-                durations_unperformed, durations_performed
+    def get_beat_statistics(self, time_signature, nr_beats):
+        """
+        Get the arrays of the numbers, means and sums of squared deviations of the multipliers of the time signature,
+        extended to the number of beats.
+        """
+        if time_signature not in self.counts:
+            self.counts[time_signature] = np.zeros(0, dtype=np.int64)
+            self.means[time_signature] = np.zeros(0)
+            self.m2s[time_signature] = np.zeros(0)
+        nr_missing_beats = nr_beats - len(self.counts[time_signature])
+        if nr_missing_beats > 0:
+            for statistics in (self.counts, self.means, self.m2s):
+                statistics[time_signature] = np.append(
+                    statistics[time_signature],
+                    np.zeros(nr_missing_beats, statistics[time_signature].dtype),
+                )
+        return (
+            self.counts[time_signature][:nr_beats],
+            self.means[time_signature][:nr_beats],
+            self.m2s[time_signature][:nr_beats],
+        )
+
+    def add_performance(self, time_signature, multipliers, performance=None):
+        """
+        Add the multipliers for each beat of a performance, unless the performance was already added.
+        The beats whose multiplier is NaN, without multiplier in the performance, are left unchanged.
+        Return whether the performance was added.
+        """
+        if performance is not None:
+            if performance in self.performances:
+                return False
+            self.performances.add(performance)
+        multipliers = np.asarray(multipliers, dtype=np.float64)
+        counts, means, m2s = self.get_beat_statistics(time_signature, len(multipliers))
+        is_valid = ~np.isnan(multipliers)
+        counts += is_valid
+        deltas = np.where(is_valid, multipliers - means, 0.0)
+        means += np.divide(deltas, counts, out=np.zeros(len(counts)), where=is_valid)
+        m2s += np.where(is_valid, deltas * (multipliers - means), 0.0)
+        return True
+
+    def merge(self, other):
+        """
+        Add the statistics of another aggregator, which must not share performances with this one.
+        """
+        shared_performances = self.performances & other.performances
+        if shared_performances:
+            raise ValueError(
+                f"The aggregators share {len(shared_performances)} performances, "
+                f"such as {min(shared_performances)}"
+            )
+        for time_signature, other_counts in other.counts.items():
+            counts, means, m2s = self.get_beat_statistics(
+                time_signature, len(other_counts)
+            )
+            total_counts = counts + other_counts
+            other_ratios = np.divide(
+                other_counts,
+                total_counts,
+                out=np.zeros(len(total_counts)),
+                where=total_counts > 0,
             )
+            deltas = other.means[time_signature] - means
+            means += deltas * other_ratios
+            m2s += other.m2s[time_signature] + deltas**2 * counts * other_ratios
+            counts[:] = total_counts
+        self.performances |= other.performances
 
-            # Update the sum and number of multipliers for each time signature and beat
-            for beat, mult in enumerate(multipliers):
-                if beat not in sum_mult_per_time_sig_per_beat[time_signature]:
-                    sum_mult_per_time_sig_per_beat[time_signature][beat] = mult
-                    nr_of_mult_per_time_sig_per_beat[time_signature][beat] = 1
-                sum_mult_per_time_sig_per_beat[time_signature][beat] += mult
-                nr_of_mult_per_time_sig_per_beat[time_signature][beat] += 1
+    def get_avg_multiplier(self):
+        """
+        Get the average multiplier for each beat for each time signature, as calculate_avg_multiplier returns it.
+        The beats without multiplier are left out.
+        """
+        avg_mult_per_time_sig_per_beat = {}
+        for time_signature, counts in self.counts.items():
+            beats = np.flatnonzero(counts)
+            avg_mult_per_time_sig_per_beat[time_signature] = dict(
+                zip(beats.tolist(), self.means[time_signature][beats].tolist())
+            )
+        return avg_mult_per_time_sig_per_beat
 
-    # Calculate the average multiplier for each time signature and beat
-    for time_signature in sum_mult_per_time_sig_per_beat:
-        avg_mult_per_time_sig_per_beat[time_signature] = {}
-        for beat in sum_mult_per_time_sig_per_beat[time_signature]:
-            avg_mult_per_time_sig_per_beat[time_signature][beat] = (
-                sum_mult_per_time_sig_per_beat[time_signature][beat]
-                / nr_of_mult_per_time_sig_per_beat[time_signature][beat]
+    def get_std_multiplier(self):
+        """
+        Get the standard deviation of the multipliers for each beat for each time signature, 0 for a single multiplier.
+        """
+        std_mult_per_time_sig_per_beat = {}
+        for time_signature, counts in self.counts.items():
+            variances = np.divide(
+                self.m2s[time_signature],
+                counts - 1,
+                out=np.zeros(len(counts)),
+                where=counts > 1,
+            )
+            beats = np.flatnonzero(counts)
+            std_mult_per_time_sig_per_beat[time_signature] = dict(
+                zip(beats.tolist(), np.sqrt(variances[beats]).tolist())
             )
+        return std_mult_per_time_sig_per_beat
 
-    return avg_mult_per_time_sig_per_beat
+    def save(self, file_path):
+        """
+        Save the statistics and the performances added to a NumPy .npz file.
+        """
+        time_signatures = list(self.counts)
+        arrays = {
+            "time_signatures": np.array(time_signatures, dtype=str),
+            "performances": np.array(sorted(self.performances), dtype=str),
+        }
+        for idx, time_signature in enumerate(time_signatures):
+            arrays[f"counts_{idx}"] = self.counts[time_signature]
+            arrays[f"means_{idx}"] = self.means[time_signature]
+            arrays[f"m2s_{idx}"] = self.m2s[time_signature]
+        with open(file_path, "wb") as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, file_path):
+        """
+        Load the statistics and the performances added from a file saved by save.
+        """
+        aggregator = cls()
+        with np.load(file_path) as arrays:
+            for idx, time_signature in enumerate(arrays["time_signatures"].tolist()):
+                aggregator.counts[time_signature] = arrays[f"counts_{idx}"]
+                aggregator.means[time_signature] = arrays[f"means_{idx}"]
+                aggregator.m2s[time_signature] = arrays[f"m2s_{idx}"]
+            aggregator.performances = set(arrays["performances"].tolist())
+        return aggregator
+
+
+def load_aggregator(file_path):
+    """
+    Load the aggregator saved in the file, or create an empty one if the file does not exist yet.
+    """
+    if file_path is not None and os.path.exists(file_path):
+        return MultiplierAggregator.load(file_path)
+    return MultiplierAggregator()
+
+
+def aggregate_piece(piece, subcorpus_path):
+    """
+    Aggregate the multipliers of the performances of a piece, recorded by their path relative to the subcorpus.
+    """
+    aggregator = MultiplierAggregator()
+    for performed_file_path, (time_signature, multipliers) in zip(
+        piece[1], get_piece_multipliers(piece)
+    ):
+        aggregator.add_performance(
+            time_signature,
+            multipliers,
+            os.path.relpath(performed_file_path, subcorpus_path),
+        )
+    return aggregator
+
+
+def aggregate_multipliers(subcorpus_path, aggregator=None, nr_workers=None):
+    """
+    Add the multipliers of the performances of the subcorpus which were not added yet to the aggregator.
+    The performances of each piece are aggregated in a pool of processes, and merged in the order of the pieces.
+    Return the aggregator, a new one if none is given.
+    """
+    if aggregator is None:
+        aggregator = MultiplierAggregator()
+    pieces = []
+    for unperformed_file_path, performed_file_paths in find_pieces(subcorpus_path):
+        new_performed_file_paths = [
+            performed_file_path
+            for performed_file_path in performed_file_paths
+            if os.path.relpath(performed_file_path, subcorpus_path)
+            not in aggregator.performances
+        ]
+        if new_performed_file_paths:
+            pieces.append((unperformed_file_path, new_performed_file_paths))
+
+    for piece_aggregator in map_pieces(
+        functools.partial(aggregate_piece, subcorpus_path=subcorpus_path),
+        pieces,
+        nr_workers,
+    ):
+        aggregator.merge(piece_aggregator)
+    return aggregator
+
+
+def save_avg_multiplier(avg_mult_per_time_sig_per_beat, file_path):
+    """
+    Save the average multiplier for each beat for each time signature to a JSON file,
+    the timing functions read by load_timing_functions of assignment_2/transform.py for its timing curve.
+    """
+    with open(file_path, "w") as f:
+        json.dump(avg_mult_per_time_sig_per_beat, f, indent=2)
 
 
 def plot_timing_function(avg_mult_per_time_sig_per_beat, xlabel="multiplier", ylabel="beat number"):
@@ -146,10 +397,42 @@ if __name__ == "__main__":
     # use argparse and take subcorpus path as input
     parser = argparse.ArgumentParser()
     parser.add_argument("subcorpus_path", help="path to the subcorpus")
+    parser.add_argument(
+        "--output",
+        help="JSON file to save the average multipliers to, the timing function of assignment_2/transform.py",
+    )
+    parser.add_argument(
+        "--double-count-first",
+        action="store_true",
+        help="count the first multiplier of each beat twice, as the original script did",
+    )
+    parser.add_argument(
+        "--aggregator",
+        help="file of the running statistics of the multipliers, updated with the performances not added yet",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="number of processes reading the pieces, by default the number of CPUs",
+    )
     args = parser.parse_args()
 
     # get the subcorpus path folder containing the annotations of the performed and unperformed midi in each subfolder
     subcorpus_path = args.subcorpus_path
 
-    avg_mult_per_time_sig_per_beat = calculate_avg_multiplier(subcorpus_path)
+    if args.aggregator is not None:
+        if args.double_count_first:
+            parser.error("--double-count-first cannot be used with --aggregator")
+        aggregator = aggregate_multipliers(
+            subcorpus_path, load_aggregator(args.aggregator), args.workers
+        )
+        aggregator.save(args.aggregator)
+        avg_mult_per_time_sig_per_beat = aggregator.get_avg_multiplier()
+    else:
+        avg_mult_per_time_sig_per_beat = calculate_avg_multiplier(
+            subcorpus_path, args.workers, args.double_count_first
+        )
+    if args.output is not None:
+        save_avg_multiplier(avg_mult_per_time_sig_per_beat, args.output)
     plot_timing_function(avg_mult_per_time_sig_per_beat)
@@ -41,12 +41,23 @@ if __name__ == "__main__":
     # use argparse and take subcorpus path as input
     parser = argparse.ArgumentParser()
     parser.add_argument("subcorpus_path", help="path to the subcorpus")
+    parser.add_argument(
+        "--aggregator",
+        help="file of the running statistics of the multipliers, updated with the performances not added yet",
+    )
     args = parser.parse_args()
 
     # get the subcorpus path folder containing the annotations of the performed and unperformed midi in each subfolder
     subcorpus_path = args.subcorpus_path
 
-    avg_mult_per_time_sig_per_beat = calculate_avg_multiplier(subcorpus_path)
+    if args.aggregator is not None:
+        aggregator = aggregate_multipliers(
+            subcorpus_path, load_aggregator(args.aggregator)
+        )
+        aggregator.save(args.aggregator)
+        avg_mult_per_time_sig_per_beat = aggregator.get_avg_multiplier()
+    else:
+        avg_mult_per_time_sig_per_beat = calculate_avg_multiplier(subcorpus_path)
 
     plot_expressive_timing_function(avg_mult_per_time_sig_per_beat, "4/4", 5)
     plot_expressive_timing_function(avg_mult_per_time_sig_per_beat, "3/4", 4)
@@ -0,0 +1,54 @@
+import numpy as np
+import os
+
+import annotations
+
+
+def write_annotation_file(file_path, beat_times):
+    """Write an annotation file of the ASAP dataset in 4/4 in C major.
+
+    Args:
+        file_path: The annotation file.
+        beat_times: The time of each beat.
+    """
+    with open(file_path, "w") as f:
+        for beat, beat_time in enumerate(beat_times):
+            label = "db" if beat % 4 == 0 else "b"
+            if beat == 0:
+                label += ",4/4,0"
+            f.write(f"{beat_time:.3f}\t{beat_time:.3f}\t{label}\n")
+
+
+def test_modified_file_is_parsed_again(tmp_path):
+    file_path = str(tmp_path / "Perf_annotations.txt")
+    cache_folder = str(tmp_path / "cache")
+    write_annotation_file(file_path, [0.5, 1.0, 1.5, 2.0, 2.5])
+    stat = os.stat(file_path)
+
+    annotation = annotations.load_annotation(file_path, cache_folder)
+    assert list(annotation.beat_times) == [0.5, 1.0, 1.5, 2.0, 2.5]
+    assert list(annotation.is_downbeat) == [True, False, False, False, True]
+    assert annotations.get_time_signature_name(annotation) == "4/4"
+    cache_file = annotations.get_cache_file(file_path, cache_folder)
+    assert os.path.exists(cache_file)
+    assert annotations.read_annotation_cache(cache_file, stat) is not None
+
+    # the same size but a later modification time
+    write_annotation_file(file_path, [0.6, 1.1, 1.6, 2.1, 2.6])
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert os.stat(file_path).st_size == stat.st_size
+    annotation = annotations.load_annotation(file_path, cache_folder)
+    assert list(annotation.beat_times) == [0.6, 1.1, 1.6, 2.1, 2.6]
+
+    # another size but the same modification time
+    stat = os.stat(file_path)
+    write_annotation_file(file_path, [0.6, 1.1, 1.6, 2.1, 2.6, 3.1])
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    annotation = annotations.load_annotation(file_path, cache_folder)
+    assert list(annotation.beat_times) == [0.6, 1.1, 1.6, 2.1, 2.6, 3.1]
+    assert len(annotation.is_downbeat) == 6
+
+    # the rebuilt cache is read back
+    cached = annotations.read_annotation_cache(cache_file, os.stat(file_path))
+    assert cached is not None
+    assert np.array_equal(cached.beat_times, annotation.beat_times)
@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+import functools
+import os
+
+import annotations
+import taskA
+
+
+def write_annotation_file(file_path, beat_times, time_signature):
+    """Write an annotation file of the ASAP dataset with a downbeat every three beats.
+
+    Args:
+        file_path: The annotation file.
+        beat_times: The time of each beat.
+        time_signature: The time signature, such as "3/4", labelling the first beat.
+    """
+    with open(file_path, "w") as f:
+        for beat, beat_time in enumerate(beat_times):
+            label = "db" if beat % 3 == 0 else "b"
+            if beat == 0:
+                label += f",{time_signature},0"
+            f.write(f"{beat_time}\t{beat_time}\t{label}\n")
+
+
+def write_corpus(corpus_path, seed=0):
+    """Write a corpus of pieces with performances shorter and longer than their score.
+
+    Args:
+        corpus_path: The folder of the corpus.
+        seed: The seed of the random generator.
+    """
+    rng = np.random.default_rng(seed)
+    for piece_idx in range(6):
+        piece_path = os.path.join(corpus_path, f"piece{piece_idx}")
+        os.makedirs(piece_path)
+        time_signature = ["3/4", "4/4"][piece_idx % 2]
+        nr_beats = int(rng.integers(20, 40))
+        write_annotation_file(
+            os.path.join(piece_path, taskA.UNPERFORMED_ANNOTATION),
+            np.cumsum(rng.uniform(0.4, 0.6, nr_beats)),
+            time_signature,
+        )
+        for performance_idx in range(3):
+            write_annotation_file(
+                os.path.join(piece_path, f"Perf{performance_idx}_annotations.txt"),
+                np.cumsum(rng.uniform(0.3, 0.8, nr_beats + performance_idx * 5 - 5)),
+                time_signature,
+            )
+
+
+def get_reference_avg_multiplier(corpus_path):
+    """Return the average multiplier of each beat of each time signature as the original script computed it, the
+    first multiplier of each beat being counted twice.
+
+    Args:
+        corpus_path: The folder of the corpus.
+    """
+    sums = {}
+    counts = {}
+    for subdir, _, files in os.walk(corpus_path):
+        if taskA.UNPERFORMED_ANNOTATION not in files:
+            continue
+        with open(os.path.join(subdir, taskA.UNPERFORMED_ANNOTATION)) as f:
+            unperformed_times = [float(line.split("\t")[0]) for line in f]
+        for file in files:
+            if (
+                not file.endswith(taskA.ANNOTATION_SUFFIX)
+                or file == taskA.UNPERFORMED_ANNOTATION
+            ):
+                continue
+            with open(os.path.join(subdir, file)) as f:
+                lines = f.readlines()
+            performed_times = [float(line.split("\t")[0]) for line in lines]
+            time_signature = lines[0].split(",")[1]
+            durations_unperformed = np.diff(unperformed_times).tolist()
+            durations_performed = np.diff(performed_times).tolist()
+            avg_duration = sum(durations_unperformed) / len(durations_unperformed)
+            durations_unperformed = durations_unperformed[: len(durations_performed)]
+            durations_unperformed += [avg_duration] * (
+                len(durations_performed) - len(durations_unperformed)
+            )
+            sums.setdefault(time_signature, {})
+            counts.setdefault(time_signature, {})
+            for beat, (duration_unperformed, duration_performed) in enumerate(
+                zip(durations_unperformed, durations_performed)
+            ):
+                multiplier = duration_performed / duration_unperformed
+                if beat not in sums[time_signature]:
+                    sums[time_signature][beat] = multiplier
+                    counts[time_signature][beat] = 1
+                sums[time_signature][beat] += multiplier
+                counts[time_signature][beat] += 1
+    return {
+        time_signature: {
+            beat: sums[time_signature][beat] / counts[time_signature][beat]
+            for beat in sums[time_signature]
+        }
+        for time_signature in sums
+    }
+
+
+def test_double_count_first_reproduces_the_original_averages(tmp_path, monkeypatch):
+    corpus_path = str(tmp_path / "corpus")
+    write_corpus(corpus_path)
+    monkeypatch.setattr(
+        taskA,
+        "load_annotation",
+        functools.partial(
+            annotations.load_annotation, cache_folder=str(tmp_path / "cache")
+        ),
+    )
+
+    avg_multipliers = taskA.calculate_avg_multiplier(
+        corpus_path, nr_workers=1, double_count_first=True
+    )
+    reference = get_reference_avg_multiplier(corpus_path)
+    assert avg_multipliers.keys() == reference.keys()
+    for time_signature, beat_multipliers in reference.items():
+        assert list(avg_multipliers[time_signature]) == list(beat_multipliers)
+        assert list(avg_multipliers[time_signature].values()) == pytest.approx(
+            list(beat_multipliers.values()), rel=1e-12
+        )
+
+    # without double_count_first, every multiplier is counted once
+    single_count = taskA.calculate_avg_multiplier(corpus_path, nr_workers=1)
+    assert single_count.keys() == reference.keys()
+    assert single_count["3/4"] != pytest.approx(avg_multipliers["3/4"], rel=1e-12)
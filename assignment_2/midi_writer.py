@@ -0,0 +1,483 @@
+import mido
+import numpy as np
+import functools
+import struct
+
+
+# Constants
+# The order of the events at the same tick, as pretty_midi writes them, the text events being left unordered
+TIMING_EVENT_ORDER = {
+    "set_tempo": 1,
+    "time_signature": 2,
+    "key_signature": 3,
+    "lyrics": 4,
+}
+PROGRAM_CHANGE_ORDER = 6
+PITCHWHEEL_ORDER = 7
+CONTROL_CHANGE_ORDER = 8
+NOTE_ON_ORDER = 10
+ORDER_SPACING = 256 * 256
+# Bits of the order of an event in its sort key, the tick taking the bits above
+ORDER_BITS = 20
+
+NOTE_ON_STATUS = 0x90
+CONTROL_CHANGE_STATUS = 0xB0
+PROGRAM_CHANGE_STATUS = 0xC0
+PITCHWHEEL_STATUS = 0xE0
+PITCHWHEEL_CENTER = 8192
+DRUM_CHANNEL = 9
+# the channels of the instruments which are not drums, as pretty_midi assigns them
+INSTRUMENT_CHANNELS = [channel for channel in range(16) if channel != DRUM_CHANNEL]
+TRACK_NAME_TYPE = 0x03
+TEXT_TYPE = 0x01
+LYRICS_TYPE = 0x05
+END_OF_TRACK = b"\xff\x2f\x00"
+MIDI_FILE_TYPE = 1
+# the charset of the texts of a piece, as pretty_midi reads them by default
+DEFAULT_CHARSET = "latin1"
+MICROSECONDS_PER_MINUTE = 6e7
+# the key names of the key numbers of pretty_midi, as mido encodes them
+KEY_NAMES = [
+    "C", "Db", "D", "Eb", "E", "F", "F#", "G", "Ab", "A", "Bb", "B",
+    "Cm", "C#m", "Dm", "D#m", "Em", "Fm", "F#m", "Gm", "G#m", "Am", "Bbm", "Bm",
+]  # fmt: skip
+
+
+def encode_variable_int(value):
+    """Return the bytes of the variable length integer, as in a MIDI file.
+
+    Args:
+        value: The non-negative integer.
+    """
+    data = [value & 0x7F]
+    value >>= 7
+    while value:
+        data.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(data))
+
+
+def encode_meta_text(type_byte, text, charset):
+    """Return the bytes of a meta message holding a text, such as a track name.
+
+    Args:
+        type_byte: The type of the meta message.
+        text: The text.
+        charset: The charset of the text.
+    """
+    data = text.encode(charset)
+    return bytes([0xFF, type_byte]) + encode_variable_int(len(data)) + data
+
+
+def get_tick_scales(piano):
+    """Return the (tick, tick scale) of each tempo change of the piece, the tick scale being the duration of a tick in
+    seconds, computed from the tempo in microseconds per beat of the MIDI file as pretty_midi does, so that the
+    times of the ticks are exactly the times of the loaded events.
+
+    Args:
+        piano: The pretty_midi piece.
+    """
+    tick_scales = []
+    for time, tempo in zip(*piano.get_tempo_changes()):
+        midi_tempo = round(MICROSECONDS_PER_MINUTE / tempo)
+        # the tempo of a piece created with an initial tempo may not be a whole number of microseconds per beat
+        if abs(MICROSECONDS_PER_MINUTE / tempo - midi_tempo) > 1e-6:
+            midi_tempo = MICROSECONDS_PER_MINUTE / tempo
+        tick_scales.append(
+            (
+                piano.time_to_tick(time),
+                60.0 / ((MICROSECONDS_PER_MINUTE / midi_tempo) * piano.resolution),
+            )
+        )
+    return tick_scales
+
+
+def get_tick_to_time(tick_scales, nr_ticks):
+    """Return the time of each tick, in seconds, computed tempo change by tempo change as pretty_midi does.
+
+    Args:
+        tick_scales: The (tick, tick scale) of each tempo change, see get_tick_scales.
+        nr_ticks: The number of ticks.
+    """
+    tick_to_time = np.zeros(nr_ticks, dtype=np.float64)
+    last_end_time = 0
+    for (start_tick, tick_scale), (end_tick, _) in zip(
+        tick_scales[:-1], tick_scales[1:]
+    ):
+        ticks = np.arange(end_tick - start_tick + 1)
+        tick_to_time[start_tick : end_tick + 1] = last_end_time + tick_scale * ticks
+        last_end_time = tick_to_time[end_tick]
+    final_tick, final_tick_scale = tick_scales[-1]
+    ticks = np.arange(nr_ticks - final_tick)
+    tick_to_time[final_tick:] = last_end_time + final_tick_scale * ticks
+    return tick_to_time
+
+
+def compare_timing_events(event1, event2):
+    """Compare two (tick, type, bytes) events of the timing track as pretty_midi does when sorting them: by tick,
+    and by type at the same tick, the text events being equal to any event at the same tick.
+
+    Args:
+        event1: The first event.
+        event2: The second event.
+    """
+    if (
+        event1[0] == event2[0]
+        and event1[1] in TIMING_EVENT_ORDER
+        and event2[1] in TIMING_EVENT_ORDER
+    ):
+        return TIMING_EVENT_ORDER[event1[1]] - TIMING_EVENT_ORDER[event2[1]]
+    return event1[0] - event2[0]
+
+
+class TempoMap:
+    """
+    The tempo map of a piece, converting the times of the events into MIDI ticks as pretty_midi does, and the
+    encoded events of its timing track. A tempo map is loaded once and shared by all the files written with it,
+    such as the phrases of a piece.
+
+    The map is built from the tempo changes of the piece only, so the ticks are the ticks of pretty_midi up to the
+    end of the piece, after which both follow the final tempo and may only round a time within a rounding error of
+    half a tick differently.
+
+    Args:
+        piano: The piece whose tempo changes, time and key signatures, lyrics and text events are written.
+        charset: The charset of the texts of the piece, as given to pretty_midi.PrettyMIDI.
+    """
+
+    def __init__(self, piano, charset=DEFAULT_CHARSET):
+        self.resolution = piano.resolution
+        self.charset = charset
+        tick_scales = get_tick_scales(piano)
+        # the time of each tick up to the end of the piece, the later ticks following the final tempo
+        self.tick_to_time = get_tick_to_time(
+            tick_scales,
+            max(piano.time_to_tick(piano.get_end_time()), tick_scales[-1][0]) + 1,
+        )
+        self.final_tick_scale = tick_scales[-1][1]
+
+        # The (tick, type, bytes) events of the timing track, in the order pretty_midi adds them
+        self.timing_events = []
+        if (
+            len(piano.time_signature_changes) == 0
+            or min(ts.time for ts in piano.time_signature_changes) > 0.0
+        ):
+            # the default time signature of 4/4
+            self.add_timing_event(
+                0, mido.MetaMessage("time_signature", numerator=4, denominator=4)
+            )
+        for tick, tick_scale in tick_scales:
+            tempo = int(
+                MICROSECONDS_PER_MINUTE / (60.0 / (tick_scale * self.resolution))
+            )
+            self.add_timing_event(tick, mido.MetaMessage("set_tempo", tempo=tempo))
+        for ts in piano.time_signature_changes:
+            self.add_timing_event(
+                self.time_to_tick(ts.time),
+                mido.MetaMessage(
+                    "time_signature", numerator=ts.numerator, denominator=ts.denominator
+                ),
+            )
+        for ks in piano.key_signature_changes:
+            self.add_timing_event(
+                self.time_to_tick(ks.time),
+                mido.MetaMessage("key_signature", key=KEY_NAMES[ks.key_number]),
+            )
+        for lyric in piano.lyrics:
+            self.timing_events.append(
+                (
+                    self.time_to_tick(lyric.time),
+                    "lyrics",
+                    encode_meta_text(LYRICS_TYPE, lyric.text, self.charset),
+                )
+            )
+        self.timing_events.extend(self.get_text_events(piano.text_events))
+        self.timing_track = self.encode_timing_track()
+
+    def add_timing_event(self, tick, message):
+        """Add a meta message to the events of the timing track.
+
+        Args:
+            tick: The tick of the message.
+            message: The mido meta message.
+        """
+        self.timing_events.append((int(tick), message.type, bytes(message.bytes())))
+
+    def get_text_events(self, text_events):
+        """Return the (tick, type, bytes) events of the timing track of the text events.
+
+        Args:
+            text_events: The pretty_midi text events.
+        """
+        return [
+            (
+                self.time_to_tick(text_event.time),
+                "text",
+                encode_meta_text(TEXT_TYPE, text_event.text, self.charset),
+            )
+            for text_event in text_events
+        ]
+
+    def time_to_tick(self, times):
+        """Return the ticks of the times, as pretty_midi.PrettyMIDI.time_to_tick, for a time or an array of times.
+
+        Args:
+            times: The time or the array of times, in seconds.
+        """
+        if np.ndim(times) == 0:
+            return int(self.time_to_tick(np.array([times], dtype=np.float64))[0])
+
+        times = np.asarray(times, dtype=np.float64)
+        nr_ticks = len(self.tick_to_time)
+        ticks = np.searchsorted(self.tick_to_time, times, side="left")
+
+        # Round to the closest tick, the later one on a tie
+        is_inside = ticks < nr_ticks
+        inside_ticks = ticks[is_inside]
+        inside_times = times[is_inside]
+        previous_ticks = np.maximum(inside_ticks - 1, 0)
+        is_previous_closer = (inside_ticks > 0) & (
+            np.abs(inside_times - self.tick_to_time[previous_ticks])
+            < np.abs(inside_times - self.tick_to_time[inside_ticks])
+        )
+        ticks[is_inside] = inside_ticks - is_previous_closer
+
+        # The ticks after the tick to time array follow the final tempo
+        ticks[~is_inside] = np.round(
+            (nr_ticks - 1)
+            + (times[~is_inside] - self.tick_to_time[-1]) / self.final_tick_scale
+        )
+        return ticks
+
+    def encode_timing_track(self, text_events=()):
+        """Return the bytes of the timing track, with the given text events added to the text events of the piece.
+
+        Args:
+            text_events: The pretty_midi text events to add.
+        """
+        events = self.timing_events + self.get_text_events(text_events)
+        events.sort(key=functools.cmp_to_key(compare_timing_events))
+
+        data = bytearray()
+        tick = 0
+        for event_tick, _, event_bytes in events:
+            data += encode_variable_int(event_tick - tick)
+            data += event_bytes
+            tick = event_tick
+        data += encode_variable_int(1) + END_OF_TRACK
+        return bytes(data)
+
+
+def get_variable_int_bytes(values):
+    """Return the number of bytes of each variable length integer and the bytes of all of them, the bytes of each
+    integer being padded to the largest number of bytes.
+
+    Args:
+        values: The array of non-negative integers.
+    """
+    nr_bytes = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        nr_bytes += values >= (1 << shift)
+    max_nr_bytes = int(nr_bytes.max()) if len(values) > 0 else 1
+
+    byte_idx = np.arange(max_nr_bytes)
+    shifts = 7 * (nr_bytes[:, np.newaxis] - 1 - byte_idx)
+    value_bytes = (values[:, np.newaxis] >> np.maximum(shifts, 0)) & 0x7F
+    # set the high bit of every byte but the last
+    value_bytes |= np.where(shifts > 0, 0x80, 0)
+    return nr_bytes, value_bytes.astype(np.uint8)
+
+
+def encode_channel_events(ticks, orders, messages, nr_message_bytes):
+    """Return the bytes of the channel events of a track, sorted by tick and by order at the same tick, with the
+    delta times and the running status as written by mido.
+
+    Args:
+        ticks: The tick of each event.
+        orders: The order of each event at the same tick.
+        messages: The status byte and the two data bytes of each event, as a (nr_events, 3) array.
+        nr_message_bytes: The number of bytes of each message, 2 or 3.
+    """
+    # the sort is stable, so the events with the same tick and order keep the order in which they are added
+    event_order = np.argsort((ticks << ORDER_BITS) + orders, kind="stable")
+    ticks = ticks[event_order]
+    messages = messages[event_order]
+    nr_message_bytes = nr_message_bytes[event_order]
+
+    delta_times = np.diff(ticks, prepend=0)
+    nr_delta_bytes, delta_bytes = get_variable_int_bytes(delta_times)
+    # the status byte is omitted when it is the same as the one of the previous event
+    has_status = np.ones(len(ticks), dtype=bool)
+    has_status[1:] = messages[1:, 0] != messages[:-1, 0]
+
+    nr_event_bytes = nr_delta_bytes + nr_message_bytes - ~has_status
+    event_offsets = np.cumsum(nr_event_bytes) - nr_event_bytes
+    data = np.zeros(int(nr_event_bytes.sum()), dtype=np.uint8)
+    for byte_idx in range(delta_bytes.shape[1]):
+        is_byte = nr_delta_bytes > byte_idx
+        data[event_offsets[is_byte] + byte_idx] = delta_bytes[is_byte, byte_idx]
+
+    message_offsets = event_offsets + nr_delta_bytes
+    data[message_offsets[has_status]] = messages[has_status, 0]
+    message_offsets += has_status
+    data[message_offsets] = messages[:, 1]
+    is_three_bytes = nr_message_bytes == 3
+    data[message_offsets[is_three_bytes] + 1] = messages[is_three_bytes, 2]
+    return data.tobytes()
+
+
+def get_channel(instrument_idx, is_drum):
+    """Return the channel of an instrument, as pretty_midi assigns it.
+
+    Args:
+        instrument_idx: The index of the instrument in the piece.
+        is_drum: Whether the instrument is a drum.
+    """
+    if is_drum:
+        return DRUM_CHANNEL
+    return INSTRUMENT_CHANNELS[instrument_idx % len(INSTRUMENT_CHANNELS)]
+
+
+def encode_track(
+    tempo_map,
+    channel,
+    program,
+    starts,
+    ends,
+    pitches,
+    velocities,
+    name="",
+    pitch_bends=(),
+    control_changes=(),
+):
+    """Return the bytes of the track of an instrument whose notes are given as arrays, as written by pretty_midi.
+
+    Args:
+        tempo_map: The tempo map.
+        channel: The channel of the instrument, see get_channel.
+        program: The program of the instrument.
+        starts: The start of each note.
+        ends: The end of each note.
+        pitches: The pitch of each note.
+        velocities: The velocity of each note.
+        name: The name of the instrument.
+        pitch_bends: The pretty_midi pitch bends of the instrument.
+        control_changes: The pretty_midi control changes of the instrument.
+    """
+    nr_notes = len(starts)
+    nr_events = 1 + 2 * nr_notes + len(pitch_bends) + len(control_changes)
+    ticks = np.zeros(nr_events, dtype=np.int64)
+    orders = np.zeros(nr_events, dtype=np.int64)
+    messages = np.zeros((nr_events, 3), dtype=np.int64)
+    nr_message_bytes = np.full(nr_events, 3, dtype=np.int64)
+
+    # The program change at the start of the track
+    orders[0] = PROGRAM_CHANGE_ORDER * ORDER_SPACING
+    messages[0, :2] = [PROGRAM_CHANGE_STATUS | channel, program]
+    nr_message_bytes[0] = 2
+
+    # Each note is a note on followed by a note on without velocity ending it
+    pitches = np.asarray(pitches, dtype=np.int64)
+    note_velocities = np.zeros(2 * nr_notes, dtype=np.int64)
+    note_velocities[::2] = velocities
+    note_events = slice(1, 1 + 2 * nr_notes)
+    ticks[1 : 1 + 2 * nr_notes : 2] = tempo_map.time_to_tick(starts)
+    ticks[2 : 2 + 2 * nr_notes : 2] = tempo_map.time_to_tick(ends)
+    orders[note_events] = (
+        NOTE_ON_ORDER * ORDER_SPACING + np.repeat(pitches, 2) * 256 + note_velocities
+    )
+    messages[note_events, 0] = NOTE_ON_STATUS | channel
+    messages[note_events, 1] = np.repeat(pitches, 2)
+    messages[note_events, 2] = note_velocities
+
+    event_idx = 1 + 2 * nr_notes
+    for bend in pitch_bends:
+        value = bend.pitch + PITCHWHEEL_CENTER
+        ticks[event_idx] = tempo_map.time_to_tick(bend.time)
+        orders[event_idx] = PITCHWHEEL_ORDER * ORDER_SPACING + bend.pitch
+        messages[event_idx] = [PITCHWHEEL_STATUS | channel, value & 0x7F, value >> 7]
+        event_idx += 1
+    for control_change in control_changes:
+        ticks[event_idx] = tempo_map.time_to_tick(control_change.time)
+        orders[event_idx] = (
+            CONTROL_CHANGE_ORDER * ORDER_SPACING
+            + control_change.number * 256
+            + control_change.value
+        )
+        messages[event_idx] = [
+            CONTROL_CHANGE_STATUS | channel,
+            control_change.number,
+            control_change.value,
+        ]
+        event_idx += 1
+
+    data = bytearray()
+    if name:
+        # the track name comes first, resetting the running status
+        data += encode_variable_int(0) + encode_meta_text(
+            TRACK_NAME_TYPE, name, tempo_map.charset
+        )
+    data += encode_channel_events(ticks, orders, messages, nr_message_bytes)
+    data += encode_variable_int(1) + END_OF_TRACK
+    return bytes(data)
+
+
+def get_instrument_arrays(instrument):
+    """Return the start, end, pitch and velocity arrays of the notes of a pretty_midi instrument.
+
+    Args:
+        instrument: The instrument.
+    """
+    return (
+        np.array([note.start for note in instrument.notes], dtype=np.float64),
+        np.array([note.end for note in instrument.notes], dtype=np.float64),
+        np.array([note.pitch for note in instrument.notes], dtype=np.int64),
+        np.array([note.velocity for note in instrument.notes], dtype=np.int64),
+    )
+
+
+def encode_instrument(tempo_map, instrument_idx, instrument, note_arrays=None):
+    """Return the bytes of the track of a pretty_midi instrument.
+
+    Args:
+        tempo_map: The tempo map.
+        instrument_idx: The index of the instrument in the piece, giving its channel.
+        instrument: The instrument.
+        note_arrays: The start, end, pitch and velocity arrays of the notes to write instead of the notes of the
+            instrument.
+    """
+    if note_arrays is None:
+        note_arrays = get_instrument_arrays(instrument)
+    return encode_track(
+        tempo_map,
+        get_channel(instrument_idx, instrument.is_drum),
+        instrument.program,
+        *note_arrays,
+        name=instrument.name,
+        pitch_bends=instrument.pitch_bends,
+        control_changes=instrument.control_changes,
+    )
+
+
+def write_midi_file(output_midi_file, tempo_map, tracks, text_events=()):
+    """Write the encoded tracks into a MIDI file after the timing track of the tempo map.
+
+    Args:
+        output_midi_file: The output MIDI file.
+        tempo_map: The tempo map.
+        tracks: The bytes of the tracks, see encode_track.
+        text_events: The pretty_midi text events to add to the timing track.
+    """
+    timing_track = (
+        tempo_map.encode_timing_track(text_events)
+        if len(text_events) > 0
+        else tempo_map.timing_track
+    )
+    chunks = [
+        b"MThd",
+        struct.pack(">Lhhh", 6, MIDI_FILE_TYPE, 1 + len(tracks), tempo_map.resolution),
+    ]
+    for track in [timing_track] + list(tracks):
+        chunks += [b"MTrk", struct.pack(">L", len(track)), track]
+    with open(output_midi_file, "wb") as f:
+        f.write(b"".join(chunks))
@@ -0,0 +1,600 @@
+import mido
+import numpy as np
+import pretty_midi
+import argparse
+import collections
+import heapq
+import json
+import threading
+import time
+
+from transform import (
+    BASS_HAND,
+    DEFAULT_PIPELINE,
+    HUMANIZATION_DISTRIBUTIONS,
+    MELODY_HAND,
+    PIPELINE_STAGES,
+    TIMING_VARIATION,
+    VELOCITY_VARIATION,
+    Humanizer,
+    Performance,
+    load_learned_multipliers,
+    load_pipeline,
+    run_pipeline,
+)
+
+
+# Constants
+# The notes received after a note before rendering it, which bounds the latency
+LOOKAHEAD_NOTES = 32
+# The rendered notes kept as context for the effects on the next notes, which bounds the memory
+HISTORY_NOTES = 64
+HOP_NOTES = 16  # the notes received between two renderings of the buffer
+# The time left to render a note and send it before its output, in seconds
+OUTPUT_MARGIN = 0.1
+# The stages applied to a stream, the timing curve needing the beats and the time signature of the whole piece
+STREAM_STAGES = [name for name in PIPELINE_STAGES if name != "timing_curve"]
+
+RenderedNote = collections.namedtuple(
+    "RenderedNote",
+    ["hand", "note", "input_start", "render_time", "output_delay"],
+    defaults=[None],
+)
+
+
+def read_file_events(midi_file, realtime=False):
+    """Yield the (time, hand, message) events of the MIDI file in time order, the time being in seconds from the
+    start and the hand being the index of the instrument of the note, as loaded by pretty_midi.
+
+    Args:
+        midi_file: The MIDI file to replay.
+        realtime: Whether to wait for the time of each event, as if the file was played live.
+    """
+    midi = mido.MidiFile(midi_file)
+    # The times are converted from ticks by pretty_midi, so the notes are the same as the notes of the loaded file
+    tick_to_time = pretty_midi.PrettyMIDI(midi_file).tick_to_time
+
+    # The instruments of pretty_midi are the (track, channel) of the notes, in the order of their first note
+    events = []
+    hands = {}
+    for track_idx, track in enumerate(midi.tracks):
+        tick = 0
+        for message in track:
+            tick += message.time
+            hand = None
+            if message.type in ("note_on", "note_off"):
+                hand = hands.setdefault((track_idx, message.channel), len(hands))
+            events.append((tick, hand, message))
+    # the sort is stable, so the events at the same tick keep the order of their tracks as in mido.merge_tracks
+    events.sort(key=lambda event: event[0])
+
+    start_time = time.perf_counter()
+    for tick, hand, message in events:
+        current_time = float(tick_to_time(tick))
+        if realtime:
+            time.sleep(max(0.0, current_time - (time.perf_counter() - start_time)))
+        yield current_time, hand, message
+
+
+def read_port_events(port_name=None, split_pitch=None):
+    """Yield the (time, hand, message) events received on the MIDI input port, the time being in seconds from the
+    start. The hand of a note is its channel, or the bass below the split pitch if given.
+
+    Args:
+        port_name: The name of the MIDI input port, the default port if not given.
+        split_pitch: The lowest pitch of the melody, the notes below being the bass.
+    """
+    with mido.open_input(port_name) as port:
+        start_time = time.perf_counter()
+        for message in port:
+            hand = None
+            if message.type in ("note_on", "note_off"):
+                if split_pitch is None:
+                    hand = message.channel
+                else:
+                    hand = BASS_HAND if message.note < split_pitch else MELODY_HAND
+            yield time.perf_counter() - start_time, hand, message
+
+
+def get_stream_notes(events):
+    """Yield the (time, hand, note) notes of the stream of (time, hand, message) events, each note being yielded
+    when it ends. The notes are matched as by pretty_midi, so they come in the same order as the notes of a loaded
+    file. The notes of other instruments than the melody and the bass are ignored.
+
+    Args:
+        events: The (time, hand, message) events, in time order.
+    """
+    # (start, velocity) of the notes turned on for each (hand, channel, pitch)
+    open_notes = {}
+    for current_time, hand, message in events:
+        if hand not in (MELODY_HAND, BASS_HAND):
+            continue
+        key = (hand, message.channel, message.note)
+        if message.type == "note_on" and message.velocity > 0:
+            open_notes.setdefault(key, []).append((current_time, message.velocity))
+        elif message.type in ("note_on", "note_off"):
+            if key not in open_notes:
+                continue
+            # a note on at the same time as the note off continues
+            notes_to_close = [
+                (start, velocity)
+                for start, velocity in open_notes[key]
+                if start != current_time
+            ]
+            notes_to_keep = [
+                (start, velocity)
+                for start, velocity in open_notes[key]
+                if start == current_time
+            ]
+            for start, velocity in notes_to_close:
+                yield current_time, hand, pretty_midi.Note(
+                    velocity, message.note, start, current_time
+                )
+            if len(notes_to_close) > 0 and len(notes_to_keep) > 0:
+                open_notes[key] = notes_to_keep
+            else:
+                del open_notes[key]
+
+
+class StreamingRenderer:
+    """
+    Expressive rendering of a stream of notes, applying the stages of the transform pipeline over a sliding buffer
+    of the notes of both hands. A note is rendered once the lookahead notes following it are received, so that its
+    next notes are known, and only the history notes before the first note not rendered are kept as context, so the
+    latency and the memory are bounded whatever the length of the stream.
+
+    The humanization samples are drawn as the melody notes are received, in the order the transform draws them, and
+    the velocity of the bass is normalized with the average velocity of the melody notes of the buffer.
+
+    Args:
+        stage_names: The names of the stages of the pipeline, in order.
+        lookahead: The number of notes received after a note before rendering it.
+        history: The number of rendered notes kept as context.
+        hop: The number of notes received between two renderings of the buffer.
+        seed: The seed of the random generator of the humanization, a random one if not given.
+        humanizer: The humanization of the melody, see transform.Humanizer.
+    """
+
+    def __init__(
+        self,
+        stage_names=DEFAULT_PIPELINE,
+        lookahead=LOOKAHEAD_NOTES,
+        history=HISTORY_NOTES,
+        hop=HOP_NOTES,
+        seed=None,
+        humanizer=None,
+    ):
+        for name in stage_names:
+            if name not in STREAM_STAGES:
+                raise ValueError(f"The stage {name} cannot be applied to a stream")
+        self.stage_names = list(stage_names)
+        self.lookahead = lookahead
+        self.history = history
+        self.hop = hop
+        self.rng = np.random.default_rng(seed)
+        self.humanizer = Humanizer() if humanizer is None else humanizer
+        self.notes = []  # the buffered (hand, note) notes
+        self.humanization = []  # the humanization samples of each buffered melody note
+        self.buffer_start_idx = 0  # index in the stream of the first buffered note
+        self.nr_notes = 0  # number of notes received
+        self.rendered_idx = 0  # index of the first note not rendered yet
+
+    def add_note(self, hand, note, current_time):
+        """Add the next note of the stream and return the list of the notes rendered.
+
+        Args:
+            hand: The hand playing the note, MELODY_HAND or BASS_HAND.
+            note: The next note, the notes being received in the order of their end.
+            current_time: The time at which the note is received.
+        """
+        self.notes.append((hand, note))
+        self.humanization.append(
+            self.humanizer.draw(self.rng, 1)[0] if hand == MELODY_HAND else None
+        )
+        self.nr_notes += 1
+        if self.nr_notes - self.lookahead - self.rendered_idx < self.hop:
+            return []
+        return self.render_buffer(self.nr_notes - self.lookahead, current_time)
+
+    def finish(self, current_time):
+        """Render the remaining notes at the end of the stream and return their list.
+
+        Args:
+            current_time: The time at which the stream ends.
+        """
+        if self.rendered_idx == self.nr_notes:
+            return []
+        return self.render_buffer(self.nr_notes, current_time)
+
+    def render_buffer(self, rendered_idx, current_time):
+        """Render the buffered notes, return the notes before the given index which were not rendered yet, and
+        remove the notes which are no longer needed from the buffer.
+
+        Args:
+            rendered_idx: The index of the first note left to render.
+            current_time: The time at which the notes are rendered.
+        """
+        piano = pretty_midi.PrettyMIDI()
+        piano.instruments = [pretty_midi.Instrument(0), pretty_midi.Instrument(0)]
+        buffer_idx_by_hand = [[], []]
+        for buffer_idx, (hand, note) in enumerate(self.notes):
+            piano.instruments[hand].notes.append(
+                pretty_midi.Note(note.velocity, note.pitch, note.start, note.end)
+            )
+            buffer_idx_by_hand[hand].append(buffer_idx)
+
+        performance = Performance(piano, humanizer=self.humanizer)
+        performance.humanization = np.array(
+            [
+                self.humanization[buffer_idx]
+                for buffer_idx in buffer_idx_by_hand[MELODY_HAND]
+            ]
+        ).reshape(-1, 2)
+        run_pipeline(performance, self.stage_names)
+
+        rendered_notes = []
+        for hand, hand_notes in enumerate(performance.hands):
+            for position, buffer_idx in enumerate(buffer_idx_by_hand[hand]):
+                note_idx = self.buffer_start_idx + buffer_idx
+                if not self.rendered_idx <= note_idx < rendered_idx:
+                    continue
+                input_note = self.notes[buffer_idx][1]
+                note = pretty_midi.Note(
+                    int(hand_notes.velocity[position]),
+                    int(hand_notes.pitch[position]),
+                    float(hand_notes.start[position]),
+                    float(hand_notes.end[position]),
+                )
+                rendered_notes.append(
+                    (
+                        note_idx,
+                        RenderedNote(hand, note, input_note.start, current_time),
+                    )
+                )
+        rendered_notes.sort(key=lambda rendered_note: rendered_note[0])
+        self.rendered_idx = rendered_idx
+
+        # Drop the notes before the history
+        buffer_start_idx = max(self.buffer_start_idx, rendered_idx - self.history)
+        del self.notes[: buffer_start_idx - self.buffer_start_idx]
+        del self.humanization[: buffer_start_idx - self.buffer_start_idx]
+        self.buffer_start_idx = buffer_start_idx
+        return [rendered_note for _, rendered_note in rendered_notes]
+
+
+def get_output_delays(rendered_notes, delay=None, margin=OUTPUT_MARGIN):
+    """Yield the rendered notes with the delay between the input and the output of each one. A note is only rendered
+    once it has ended and the lookahead notes following it are received, so by default the delay is the latency of
+    the rendering: it is raised, and never lowered, whenever a note would otherwise be played before it is rendered,
+    the notes after it being shifted as well so that they keep their order.
+
+    Args:
+        rendered_notes: The rendered notes, in the order they are rendered.
+        delay: The fixed delay of the output, in seconds, the notes rendered too late for it being late, or None to
+            adapt it to the latency.
+        margin: The time left to render a note and send it before its output, in seconds.
+    """
+    output_delay = 0.0 if delay is None else delay
+    for rendered_note in rendered_notes:
+        if delay is None:
+            output_delay = max(
+                output_delay,
+                rendered_note.render_time - rendered_note.note.start + margin,
+            )
+        yield rendered_note._replace(output_delay=output_delay)
+
+
+class OutputScheduler:
+    """
+    Send MIDI messages to an output port at their scheduled time from a thread, recording how late each message
+    is sent, the jitter of the output.
+
+    Args:
+        port: The MIDI output port.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.start_time = time.perf_counter()
+        self.events = []  # heap of the (time, order, message) events to send
+        self.nr_events = 0
+        # the delay between the scheduled and the actual time of each message sent
+        self.lateness = []
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def schedule(self, event_time, message):
+        """Schedule the message to be sent at the given time.
+
+        Args:
+            event_time: The time of the message, in seconds from the start of the scheduler.
+            message: The MIDI message.
+        """
+        with self.condition:
+            heapq.heappush(self.events, (event_time, self.nr_events, message))
+            self.nr_events += 1
+            self.condition.notify()
+
+    def run(self):
+        """Send the scheduled messages as their time comes, until the scheduler is closed and all are sent."""
+        with self.condition:
+            while True:
+                if len(self.events) == 0:
+                    if self.closed:
+                        return
+                    self.condition.wait()
+                    continue
+                event_time = self.events[0][0]
+                wait_time = event_time - (time.perf_counter() - self.start_time)
+                if wait_time > 0:
+                    self.condition.wait(wait_time)
+                    continue
+                _, _, message = heapq.heappop(self.events)
+                self.port.send(message)
+                self.lateness.append(time.perf_counter() - self.start_time - event_time)
+
+    def close(self):
+        """Wait for the scheduled messages to be sent and stop the scheduler."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+
+def render_stream(
+    events,
+    stage_names=DEFAULT_PIPELINE,
+    lookahead=LOOKAHEAD_NOTES,
+    history=HISTORY_NOTES,
+    hop=HOP_NOTES,
+    seed=None,
+    humanizer=None,
+):
+    """Render the stream of (time, hand, message) events, yielding each rendered note when it is rendered.
+
+    Args:
+        events: The (time, hand, message) events, in time order.
+        stage_names: The names of the stages of the pipeline, in order.
+        lookahead: The number of notes received after a note before rendering it.
+        history: The number of rendered notes kept as context.
+        hop: The number of notes received between two renderings of the buffer.
+        seed: The seed of the random generator of the humanization.
+        humanizer: The humanization of the melody, see transform.Humanizer.
+    """
+    renderer = StreamingRenderer(stage_names, lookahead, history, hop, seed, humanizer)
+    current_time = 0.0
+    try:
+        for current_time, hand, note in get_stream_notes(events):
+            yield from renderer.add_note(hand, note, current_time)
+    except KeyboardInterrupt:
+        # the stream of a port ends when the performer stops it
+        pass
+    yield from renderer.finish(current_time)
+
+
+def schedule_note(scheduler, rendered_note):
+    """Schedule the note on and note off messages of the rendered note on the output, delayed by its output delay.
+
+    Args:
+        scheduler: The output scheduler.
+        rendered_note: The rendered note, see get_output_delays.
+    """
+    note = rendered_note.note
+    delay = rendered_note.output_delay
+    channel = rendered_note.hand
+    scheduler.schedule(
+        note.start + delay,
+        mido.Message(
+            "note_on", channel=channel, note=note.pitch, velocity=note.velocity
+        ),
+    )
+    scheduler.schedule(
+        note.end + delay,
+        mido.Message("note_off", channel=channel, note=note.pitch, velocity=0),
+    )
+
+
+def write_rendered_notes(rendered_notes, output_midi_file):
+    """Write the rendered notes into a MIDI file, with an instrument for the melody and one for the bass.
+
+    Args:
+        rendered_notes: The rendered notes.
+        output_midi_file: The output MIDI file.
+    """
+    piano = pretty_midi.PrettyMIDI()
+    piano.instruments = [pretty_midi.Instrument(0), pretty_midi.Instrument(0)]
+    for rendered_note in rendered_notes:
+        piano.instruments[rendered_note.hand].notes.append(rendered_note.note)
+    piano.write(output_midi_file)
+
+
+def get_stream_statistics(rendered_notes, lateness=None):
+    """Return the latency of the rendering, the time between the start of each input note and its rendering, the
+    delay of the output, the notes rendered after their scheduled output and, if the output was played on a port,
+    the jitter of the messages sent, in seconds.
+
+    Args:
+        rendered_notes: The rendered notes with their output delay, see get_output_delays.
+        lateness: The delay between the scheduled and the actual time of each message sent, if any.
+    """
+    statistics = {"nr_notes": len(rendered_notes)}
+    if len(rendered_notes) == 0:
+        return statistics
+    latencies = np.array(
+        [note.render_time - note.input_start for note in rendered_notes]
+    )
+    delays = np.array([note.output_delay for note in rendered_notes])
+    late_times = (
+        np.array([note.render_time - note.note.start for note in rendered_notes])
+        - delays
+    )
+    statistics.update(
+        {
+            "latency_mean": float(latencies.mean()),
+            "latency_p50": float(np.percentile(latencies, 50)),
+            "latency_p95": float(np.percentile(latencies, 95)),
+            "latency_max": float(latencies.max()),
+            "delay_start": float(delays[0]),
+            "delay_end": float(delays[-1]),
+            "late_notes": int(np.count_nonzero(late_times > 0)),
+            "lateness_max": float(max(0.0, late_times.max())),
+        }
+    )
+    if lateness:
+        lateness = np.array(lateness)
+        statistics.update(
+            {
+                "jitter_mean": float(lateness.mean()),
+                "jitter_std": float(lateness.std()),
+                "jitter_max": float(lateness.max()),
+            }
+        )
+    return statistics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--file", help="The MIDI file to replay as a stream")
+    source.add_argument(
+        "--port",
+        nargs="?",
+        const="",
+        help="The MIDI input port to listen to, the default port if no name is given",
+    )
+    parser.add_argument(
+        "--realtime",
+        action="store_true",
+        help="Replay the file at the speed of the performance",
+    )
+    parser.add_argument(
+        "--split-pitch",
+        type=int,
+        default=None,
+        help="The lowest pitch of the melody on the input port, by default the hand is the channel",
+    )
+    parser.add_argument("--output-file", help="The MIDI file of the rendered notes")
+    parser.add_argument(
+        "--output-port",
+        nargs="?",
+        const="",
+        help="The MIDI output port playing the rendered notes, the default port if no name is given",
+    )
+    parser.add_argument(
+        "--delay",
+        type=float,
+        default=None,
+        help="The fixed delay between the input and the output of the performance, in seconds, by default the "
+        "latency of the rendering",
+    )
+    pipeline = parser.add_mutually_exclusive_group()
+    pipeline.add_argument(
+        "--stages",
+        nargs="+",
+        choices=STREAM_STAGES,
+        default=DEFAULT_PIPELINE,
+        help="The stages of the pipeline, in order",
+    )
+    pipeline.add_argument(
+        "--pipeline", help="A JSON file listing the stages of the pipeline, in order"
+    )
+    parser.add_argument(
+        "--lookahead",
+        type=int,
+        default=LOOKAHEAD_NOTES,
+        help="The notes received after a note before rendering it",
+    )
+    parser.add_argument(
+        "--history",
+        type=int,
+        default=HISTORY_NOTES,
+        help="The rendered notes kept as context",
+    )
+    parser.add_argument(
+        "--hop",
+        type=int,
+        default=HOP_NOTES,
+        help="The notes received between two renderings",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=None, help="The seed of the humanization"
+    )
+    parser.add_argument(
+        "--humanization",
+        choices=HUMANIZATION_DISTRIBUTIONS,
+        default="uniform",
+        help="The distribution of the velocity and timing variations of the melody",
+    )
+    parser.add_argument(
+        "--velocity-variation",
+        type=int,
+        default=VELOCITY_VARIATION,
+        help="The scale of the velocity variations, the largest one for the uniform distribution",
+    )
+    parser.add_argument(
+        "--timing-variation",
+        type=float,
+        default=TIMING_VARIATION,
+        help="The scale of the shifts of the onsets in seconds, the largest one for the uniform distribution",
+    )
+    parser.add_argument(
+        "--multipliers",
+        help="A JSON file of the tempo multipliers of each beat of each time signature, as computed by "
+        "assignment_1/taskA.py, from which the learned variations are drawn",
+    )
+    args = parser.parse_args()
+
+    stage_names = (
+        load_pipeline(args.pipeline) if args.pipeline is not None else args.stages
+    )
+    for name in stage_names:
+        if name not in STREAM_STAGES:
+            parser.error(f"the stage {name} cannot be applied to a stream")
+    if args.humanization == "learned" and args.multipliers is None:
+        parser.error("the learned humanization needs the --multipliers file")
+    humanizer = Humanizer(
+        args.humanization,
+        args.velocity_variation,
+        args.timing_variation,
+        (
+            load_learned_multipliers(args.multipliers)
+            if args.multipliers is not None
+            else None
+        ),
+    )
+    if args.file is not None:
+        events = read_file_events(args.file, args.realtime)
+    else:
+        events = read_port_events(args.port or None, args.split_pitch)
+
+    scheduler = None
+    if args.output_port is not None:
+        scheduler = OutputScheduler(mido.open_output(args.output_port or None))
+
+    rendered_notes = []
+    for rendered_note in get_output_delays(
+        render_stream(
+            events,
+            stage_names,
+            args.lookahead,
+            args.history,
+            args.hop,
+            args.seed,
+            humanizer,
+        ),
+        args.delay,
+    ):
+        rendered_notes.append(rendered_note)
+        if scheduler is not None:
+            schedule_note(scheduler, rendered_note)
+
+    lateness = None
+    if scheduler is not None:
+        scheduler.close()
+        scheduler.port.close()
+        lateness = scheduler.lateness
+    if args.output_file is not None:
+        write_rendered_notes(rendered_notes, args.output_file)
+    print(json.dumps(get_stream_statistics(rendered_notes, lateness)))
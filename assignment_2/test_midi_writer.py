@@ -0,0 +1,43 @@
+import numpy as np
+import pretty_midi
+import os
+
+import transform
+
+MIDI_SCORE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "midi_score.mid")
+
+
+def get_warped_performance(seed=0):
+    """Return the performance of the score with its notes warped by a timing function and shifted by the
+    humanization.
+
+    Args:
+        seed: The seed of the random generators of the timing function and of the humanization.
+    """
+    piano = pretty_midi.PrettyMIDI(MIDI_SCORE)
+    rng = np.random.default_rng(seed)
+    timing_functions = {
+        transform.get_time_signature_name(piano): rng.uniform(0.8, 1.25, 64)
+    }
+    humanizer = transform.Humanizer("gaussian", timing_variation=0.02)
+    performance = transform.Performance(
+        piano, seed=seed, humanizer=humanizer, timing_functions=timing_functions
+    )
+    transform.run_pipeline(performance, ["timing_curve"] + transform.DEFAULT_PIPELINE)
+    return performance
+
+
+def test_written_file_matches_pretty_midi(tmp_path):
+    performance = get_warped_performance()
+    output_midi_file = str(tmp_path / "performance.mid")
+    transform.write_performance(performance, output_midi_file)
+
+    # the warp and the shifts move the notes off the onsets of the score
+    score = transform.Performance(pretty_midi.PrettyMIDI(MIDI_SCORE))
+    assert not np.allclose(performance.note_array["start"], score.note_array["start"])
+
+    performance.update_instruments()
+    reference_midi_file = str(tmp_path / "reference.mid")
+    performance.piano.write(reference_midi_file)
+    with open(output_midi_file, "rb") as f, open(reference_midi_file, "rb") as g:
+        assert f.read() == g.read()
@@ -0,0 +1,41 @@
+import pytest
+import os
+
+import streaming_transform
+
+MIDI_SCORE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "midi_score.mid")
+
+
+def get_rendered_notes(delay=None):
+    """Return the notes of the score rendered as a stream with the default settings, with their output delay.
+
+    Args:
+        delay: The fixed delay of the output, in seconds, or None to adapt it to the latency.
+    """
+    events = streaming_transform.read_file_events(MIDI_SCORE)
+    return list(
+        streaming_transform.get_output_delays(
+            streaming_transform.render_stream(events, seed=0), delay
+        )
+    )
+
+
+def test_default_settings_have_no_late_notes():
+    rendered_notes = get_rendered_notes()
+    statistics = streaming_transform.get_stream_statistics(rendered_notes)
+    assert statistics["nr_notes"] > 0
+    assert statistics["late_notes"] == 0
+    delays = [rendered_note.output_delay for rendered_note in rendered_notes]
+    assert delays == sorted(delays)
+
+
+def test_fixed_delay_reports_late_notes():
+    rendered_notes = get_rendered_notes(delay=0.0)
+    statistics = streaming_transform.get_stream_statistics(rendered_notes)
+    assert statistics["delay_start"] == statistics["delay_end"] == 0.0
+    assert statistics["late_notes"] == statistics["nr_notes"]
+
+
+def test_timing_curve_is_not_a_stream_stage():
+    with pytest.raises(ValueError):
+        streaming_transform.StreamingRenderer(["humanization", "timing_curve"])
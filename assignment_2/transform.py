@@ -1,6 +1,18 @@
+import numpy as np
 import pretty_midi
-import random
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import copy
+import glob
+import hashlib
+import json
+import os
+import time
+import tracemalloc
+
+from midi_writer import TempoMap, encode_instrument, write_midi_file
 
 
 # Constants
@@ -15,411 +27,1868 @@ SHORTENED_STACCATO_MULTIPLIER = 0.4
 STACCATO_DURATION = 0.05
 BREATH_START_MULTIPLIER = 0.1
 BREATH_VELOCITY_MULTIPLIER = 0.4
+# Humanization of the velocity and the timing of the melody, the timing variation of the onsets being in seconds
+HUMANIZATION_DISTRIBUTIONS = ["uniform", "gaussian", "learned"]
+TIMING_VARIATION = 0.0
+MIN_VELOCITY = 1
+# Time signature of a piece without time signature events, as written by pretty_midi
+DEFAULT_TIME_SIGNATURE = "4/4"
+
+# Columns of the note array, the hand being the index of the instrument playing the note
+NOTE_DTYPE = np.dtype(
+    [
+        ("start", np.float64),
+        ("end", np.float64),
+        ("pitch", np.int64),
+        ("velocity", np.int64),
+        ("hand", np.int64),
+    ]
+)
+MELODY_HAND = 0
+BASS_HAND = 1
+
+# Separation of the notes into the hands: by instrument, the first two being the hands, or over all the pitched
+# instruments by a split of their pitches, or by the skyline, the highest notes starting together being the melody
+HAND_SEPARATIONS = ["instruments", "pitch", "skyline"]
+NR_PITCHES = 128
 
+# Batch rendering of a corpus, where each piece is in its own folder as in the ASAP dataset
+UNPERFORMED_MIDI = "midi_score.mid"
+PERFORMED_SUFFIX = "_performed"
+MANIFEST_FILENAME = "manifest.json"
 
-def get_next_notes(note_idx, notes):
-    """Return the indexes of the next notes that start after the current note.
+
+def is_standard_duration(notes):
+    """Return the mask of the notes with a standard duration.
 
     Args:
-        note_idx: The index of the current note.
-        notes: The list of notes.
+        notes: The notes of a hand in the note array.
     """
-    curr_note = notes[note_idx]
-    next_notes = []
-    next_note_start = None
+    note_duration = notes.end - notes.start
+    threshold = 0.01
+    return abs(note_duration - STANDARD_DURATION) < threshold
 
-    # There can be more than one note with the same start time since they can be played together
-    for next_node_idx in range(note_idx + 1, len(notes)):
-        curr_next_note_start = notes[next_node_idx].start
-        if curr_next_note_start > curr_note.start:
-            if next_note_start is None:
-                next_note_start = curr_next_note_start
-            elif curr_next_note_start > next_note_start:
-                break
-            next_notes.append(next_node_idx)
 
-    return next_notes
+def is_extended(notes):
+    """Return the mask of the extended notes.
 
+    Args:
+        notes: The notes of a hand in the note array.
+    """
+    note_duration = notes.end - notes.start
+    threshold = 0.05
+    return note_duration > STANDARD_DURATION + threshold
 
-def get_previous_notes(note_idx, notes):
-    """Return the indexes of the previous notes that end before the current note.
+
+def is_shortened(notes):
+    """Return the mask of the shortened notes.
 
     Args:
-        note_idx: The index of the current note.
-        notes: The list of notes.
+        notes: The notes of a hand in the note array.
     """
-    curr_note = notes[note_idx]
-    previous_notes = []
-    previous_note_end = None
+    note_duration = notes.end - notes.start
+    threshold = 0.05
+    return note_duration < STANDARD_DURATION - threshold
 
-    # There can be more than one note with the same end time since they can be played together
-    for previous_note_idx in range(note_idx - 1, -1, -1):
-        curr_previous_note_end = notes[previous_note_idx].end
-        if curr_previous_note_end < curr_note.start:
-            if previous_note_end is None:
-                previous_note_end = curr_previous_note_end
-            elif curr_previous_note_end < previous_note_end:
-                break
-            previous_notes.append(previous_note_idx)
 
-    return previous_notes
+def get_note_array(instruments):
+    """Return the notes of the instruments as a note array, a record array with the start, end, pitch, velocity and
+    hand of each note. The notes of each hand are contiguous and keep the order of the instrument, since the effects
+    depend on it.
 
+    Args:
+        instruments: The instruments, the melody first and then the bass.
+    """
+    note_array = np.zeros(
+        sum(len(instrument.notes) for instrument in instruments), dtype=NOTE_DTYPE
+    ).view(np.recarray)
+    hand_start = 0
+    for hand, instrument in enumerate(instruments):
+        hand_notes = note_array[hand_start : hand_start + len(instrument.notes)]
+        hand_notes.start = [note.start for note in instrument.notes]
+        hand_notes.end = [note.end for note in instrument.notes]
+        hand_notes.pitch = [note.pitch for note in instrument.notes]
+        hand_notes.velocity = [note.velocity for note in instrument.notes]
+        hand_notes.hand = hand
+        hand_start += len(instrument.notes)
+    return note_array
+
+
+def get_hand_notes(note_array, hand):
+    """Return the notes of the hand as a view of the note array, so the effects applied to them modify the array.
 
-def get_notes_playing_together(curr_note, notes):
-    """Return the indexes of the notes that are played together with the current note.
+    Args:
+        note_array: The note array.
+        hand: The hand.
+    """
+    return note_array[
+        np.searchsorted(note_array.hand, hand, side="left") : np.searchsorted(
+            note_array.hand, hand, side="right"
+        )
+    ]
+
+
+def set_instrument_notes(instrument, hand_notes):
+    """Replace the notes of the instrument by the notes of the hand.
 
     Args:
-        curr_note: The current note.
-        notes: The list of notes.
+        instrument: The instrument.
+        hand_notes: The notes of the hand in the note array.
     """
-    together_notes = []
+    instrument.notes = [
+        pretty_midi.Note(velocity, pitch, start, end)
+        for start, end, pitch, velocity in zip(
+            hand_notes.start.tolist(),
+            hand_notes.end.tolist(),
+            hand_notes.pitch.tolist(),
+            hand_notes.velocity.tolist(),
+        )
+    ]
 
-    for other_note_idx, other_note in enumerate(notes):
-        if (
-            other_note.pitch != curr_note.pitch
-            and other_note.start == curr_note.start
-            and other_note.end == curr_note.end
-        ):
-            together_notes.append(other_note_idx)
-        if other_note.start > curr_note.end:
-            break
-    return together_notes
+
+def get_skyline_hands(note_array):
+    """Return the hand of every note by the skyline: the highest note of the notes starting at the same time is
+    played by the right hand as the melody, the others by the left hand.
+
+    Args:
+        note_array: The note array.
+    """
+    # Sort the notes by start, the highest note first
+    order = np.lexsort((-note_array.pitch, note_array.start))
+    starts = note_array.start[order]
+    is_highest = np.ones(len(order), dtype=bool)
+    is_highest[1:] = starts[1:] != starts[:-1]
+
+    hands = np.full(len(note_array), BASS_HAND)
+    hands[order[is_highest]] = MELODY_HAND
+    return hands
 
 
-def get_notes_with_same_start_smaller_end(curr_note, notes):
-    """Return the indexes of the notes that start at the same time as the current note and end before the current note.
+def get_split_pitch(pitches):
+    """Return the pitch splitting the notes into two clusters of pitches with the smallest variance within each
+    cluster (Otsu's method), computed over the histogram of the pitches in linear time.
 
     Args:
-        curr_note: The current note.
-        notes: The list of notes.
+        pitches: The pitches of the notes.
     """
-    same_start_smaller_end_notes = []
+    counts = np.bincount(pitches, minlength=NR_PITCHES).astype(np.float64)
+    pitch_values = np.arange(len(counts))
+    # number and sum of the pitches below each split pitch
+    lower_counts = np.cumsum(counts)[:-1]
+    lower_sums = np.cumsum(counts * pitch_values)[:-1]
+    upper_counts = lower_counts[-1] + counts[-1] - lower_counts
+    upper_sums = lower_sums[-1] + counts[-1] * pitch_values[-1] - lower_sums
+
+    # the variance between the clusters is the largest when the variance within them is the smallest
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between_variance = (
+            lower_counts
+            * upper_counts
+            * (lower_sums / lower_counts - upper_sums / upper_counts) ** 2
+        )
+    between_variance[(lower_counts == 0) | (upper_counts == 0)] = -1
+    return int(np.argmax(between_variance)) + 1
+
+
+def get_pitch_split_hands(note_array):
+    """Return the hand of every note by splitting the pitches into two clusters: the notes of the higher pitches are
+    played by the right hand as the melody, the others by the left hand.
 
-    for other_note_idx, other_note in enumerate(notes):
-        if (
-            other_note.pitch != curr_note.pitch
-            and other_note.start == curr_note.start
-            and other_note.end < curr_note.end
-        ):
-            same_start_smaller_end_notes.append(other_note_idx)
-        if other_note.start > curr_note.end:
-            break
-    return same_start_smaller_end_notes
+    Args:
+        note_array: The note array.
+    """
+    if len(note_array) == 0:
+        return np.full(0, BASS_HAND)
+    return np.where(
+        note_array.pitch >= get_split_pitch(note_array.pitch), MELODY_HAND, BASS_HAND
+    )
+
+
+def separate_hands(note_array, separation):
+    """Return the note array of the notes of all the instruments separated into the melody and the bass. The notes
+    of each hand keep the order of their end, as in an instrument loaded by pretty_midi.
+
+    Args:
+        note_array: The note array of the notes of all the instruments.
+        separation: The separation of the hands, "pitch" or "skyline".
+    """
+    if separation == "pitch":
+        hands = get_pitch_split_hands(note_array)
+    elif separation == "skyline":
+        hands = get_skyline_hands(note_array)
+    else:
+        raise ValueError(f"Unknown hand separation: {separation}")
+
+    # The notes of each instrument are sorted by end, so the stable sort merging them is linear in the number of
+    # notes for a few instruments, and the notes ending together keep their order
+    order = np.argsort(note_array.end, kind="stable")
+    # the stable sort of the small hand values is a linear radix sort
+    order = order[np.argsort(hands[order].astype(np.int8), kind="stable")]
+    note_array = note_array[order]
+    note_array.hand = hands[order]
+    return note_array
+
+
+def get_next_start_idx(starts):
+    """Return for every note the index of the first following note that starts after it, or the number of notes.
+
+    Args:
+        starts: The start times of the notes.
+    """
+    next_start_idx = [len(starts)] * len(starts)
+    # the notes waiting for a later start, in non-increasing order of start
+    waiting_idx = []
+    start_list = starts.tolist()
+    for note_idx, start in enumerate(start_list):
+        while waiting_idx and start_list[waiting_idx[-1]] < start:
+            next_start_idx[waiting_idx.pop()] = note_idx
+        waiting_idx.append(note_idx)
+    return np.array(next_start_idx, dtype=np.int64)
+
+
+def get_next_repeated_mask(starts, pitches, next_idx, next_stop):
+    """Return the mask of the notes repeated in their next notes, some next note having the same pitch.
+
+    Args:
+        starts: The start times of the notes.
+        pitches: The pitches of the notes.
+        next_idx: The first next note of every note, see NoteAdjacency.get_next_notes_arrays.
+        next_stop: The end of the range of the next notes of every note.
+    """
+    nr_notes = len(starts)
+    range_sizes = np.where(next_idx < nr_notes, next_stop - next_idx, 0)
+    owners = np.repeat(np.arange(nr_notes), range_sizes)
+    next_notes = (
+        np.arange(len(owners))
+        - np.repeat(np.cumsum(range_sizes) - range_sizes, range_sizes)
+        + np.repeat(next_idx, range_sizes)
+    )
+    is_repeated = (starts[next_notes] > starts[owners]) & (
+        pitches[next_notes] == pitches[owners]
+    )
+    next_repeated_mask = np.zeros(nr_notes, dtype=bool)
+    next_repeated_mask[owners[is_repeated]] = True
+    return next_repeated_mask
+
+
+def build_segment_tree(values, combine, empty):
+    """Return the segment tree of the values, a list whose node i combines its children 2 * i and 2 * i + 1, the
+    root being node 1 and the leaves, from the middle of the list, being the values padded with the empty value.
+
+    Args:
+        values: The values of the leaves.
+        combine: The function combining two values, such as min or max.
+        empty: The value of the padding leaves, neutral for the combination.
+    """
+    tree_size = 1
+    while tree_size < len(values):
+        tree_size *= 2
+    tree = [empty] * (2 * tree_size)
+    tree[tree_size : tree_size + len(values)] = values
+    for node in range(tree_size - 1, 0, -1):
+        tree[node] = combine(tree[2 * node], tree[2 * node + 1])
+    return tree
+
+
+def update_segment_tree(tree, leaf_idx, value, combine):
+    """Set the value of the leaf of the segment tree and update the nodes above it.
+
+    Args:
+        tree: The segment tree, see build_segment_tree.
+        leaf_idx: The index of the leaf, the index of the value in the values of the tree.
+        value: The new value.
+        combine: The function combining two values of the tree.
+    """
+    node = len(tree) // 2 + leaf_idx
+    tree[node] = value
+    while node > 1:
+        node //= 2
+        tree[node] = combine(tree[2 * node], tree[2 * node + 1])
+
+
+class NoteAdjacency:
+    """
+    Index of the next and previous notes of the notes of a hand: the next notes of a note are the first following
+    notes starting after it, all starting together, and its previous notes are the last notes before it ending
+    before its start, all ending together.
+
+    The next notes of a note are the notes from its next note, the first following note starting after it, to the
+    next note of that note, so only the next note of every note is kept. It only depends on the starts, so the index
+    stays valid through the staccato effects, and update_start repairs it when the breath effect moves a note.
+
+    The previous notes of a note depend on the ends of the notes before it, which the staccato effect shortens as it
+    visits the notes, so the visited notes are added with add_previous_note to a stack of increasing ends, in which
+    the previous notes of the next note are found with a binary search.
+
+    Args:
+        starts: The start times of the notes.
+    """
 
+    def __init__(self, starts):
+        self.starts = list(starts)
+        self.next_start_idx = get_next_start_idx(
+            np.array(self.starts, dtype=np.float64)
+        ).tolist()
+        self.latest_starts = build_segment_tree(self.starts, max, float("-inf"))
+        self.tree_size = len(self.latest_starts) // 2
+        self.clear_previous_notes()
+
+    def find_next_start_idx(self, note_idx, start):
+        """Return the index of the first note from the given note that starts after the given start, or the number
+        of notes. The notes before the next note of a note start at most with it, so they are skipped at once.
+
+        Args:
+            note_idx: The index of the first note searched.
+            start: The start time.
+        """
+        while note_idx < len(self.starts) and self.starts[note_idx] <= start:
+            note_idx = self.next_start_idx[note_idx]
+        return note_idx
+
+    def find_previous_start_idx(self, note_idx, start):
+        """Return the index of the last note before the given note that starts at or after the given start, or -1.
+
+        Args:
+            note_idx: The index of the note.
+            start: The start time.
+        """
+        # climb until a subtree on the left of the notes already searched has a late enough start
+        node = self.tree_size + note_idx
+        while node > 1:
+            if node % 2 == 1 and self.latest_starts[node - 1] >= start:
+                node -= 1
+                break
+            node //= 2
+        else:
+            return -1
+        # and descend to its last note with a late enough start
+        while node < self.tree_size:
+            node = 2 * node + 1
+            if self.latest_starts[node] < start:
+                node -= 1
+        return node - self.tree_size
+
+    def get_next_notes_arrays(self):
+        """Return the range of the next notes of every note: the next notes of note i are the notes of next_idx[i]
+        to next_stop[i] starting after it, the first one starting at the start of all of them.
+        """
+        next_idx = np.array(self.next_start_idx, dtype=np.int64)
+        next_stop = np.append(next_idx, len(next_idx))[next_idx]
+        return next_idx, next_stop
+
+    def update_start(self, note_idx, start):
+        """Set the start of the note, after an effect moved it, and update the next note of the notes it affects.
+
+        Args:
+            note_idx: The index of the note.
+            start: The new start time of the note.
+        """
+        previous_start = self.starts[note_idx]
+        self.starts[note_idx] = start
+        update_segment_tree(self.latest_starts, note_idx, start, max)
+        self.next_start_idx[note_idx] = self.find_next_start_idx(note_idx + 1, start)
+
+        # Only a note starting at least as late as the notes between it and the moved note can have the moved note
+        # as next note, and none before a note starting at least as late as both of its starts
+        other_idx = note_idx - 1
+        while other_idx >= 0:
+            other_start = self.starts[other_idx]
+            if start > other_start:
+                self.next_start_idx[other_idx] = note_idx
+            elif self.next_start_idx[other_idx] == note_idx:
+                self.next_start_idx[other_idx] = self.find_next_start_idx(
+                    note_idx, other_start
+                )
+            if other_start >= max(start, previous_start):
+                break
+            other_idx = self.find_previous_start_idx(other_idx, other_start)
+
+    def clear_previous_notes(self):
+        """Remove the notes added with add_previous_note, before visiting the notes again."""
+        self.ends = [None] * len(self.starts)
+        # stack of the notes with increasing ends, with the closest previous note with a smaller end of each note
+        self.stack_ends = []
+        self.stack_idx = []
+        self.previous_smaller_idx = [-1] * len(self.starts)
+
+    def add_previous_note(self, note_idx, end):
+        """Add the visited note with its final end, as a previous note of the notes after it.
+
+        Args:
+            note_idx: The index of the note, the notes being added in order.
+            end: The end time of the note.
+        """
+        self.ends[note_idx] = end
+        while self.stack_ends and self.stack_ends[-1] >= end:
+            self.stack_ends.pop()
+            self.stack_idx.pop()
+        self.previous_smaller_idx[note_idx] = (
+            self.stack_idx[-1] if self.stack_idx else -1
+        )
+        self.stack_ends.append(end)
+        self.stack_idx.append(note_idx)
+
+    def get_previous_notes(self, note_idx):
+        """Return the indexes of the previous notes that end before the note, the notes before it having been added
+        with add_previous_note.
+
+        Args:
+            note_idx: The index of the note.
+        """
+        start = self.starts[note_idx]
+        # the previous notes end at the same time as the last note ending before the note
+        position = bisect.bisect_left(self.stack_ends, start) - 1
+        if position < 0:
+            return []
+        last_previous_idx = self.stack_idx[position]
+        return [
+            previous_idx
+            for previous_idx in range(
+                last_previous_idx, self.previous_smaller_idx[last_previous_idx], -1
+            )
+            if self.ends[previous_idx] < start
+        ]
+
+
+def get_note_adjacency(notes):
+    """Return the adjacency index of the notes of a hand.
+
+    Args:
+        notes: The notes of a hand in the note array.
+    """
+    return NoteAdjacency(notes.start.tolist())
 
-def is_nearby_note_repeated(note_idx, nearby_notes, notes):
-    """Return True if some nearby note has the same pitch as the current note, False otherwise.
+
+class NoteIntervals:
+    """
+    Interval index of the notes of a hand, to find the notes played with a note followed by silence as the breath
+    effect does, without scanning the notes from the first one.
+
+    The notes played with a note are searched up to the first note starting after the end of the note, which is
+    found in a segment tree of the latest starts. The concurrent notes before it are searched
+    in the segment trees of the earliest starts and of the latest ends, only descending into the notes that can end
+    after the start of the note without all starting with it. The notes starting with the note are kept by start,
+    in the order of the notes.
 
     Args:
-        note_idx: The index of the current note.
-        nearby_notes: The indexes of the next notes.
-        notes: The list of notes.
+        starts: The start times of the notes.
+        ends: The end times of the notes.
+        pitches: The pitches of the notes.
     """
-    curr_note = notes[note_idx]
 
-    for next_note_idx in nearby_notes:
-        if notes[next_note_idx].pitch == curr_note.pitch:
-            return True
+    def __init__(self, starts, ends, pitches):
+        self.starts = list(starts)
+        self.ends = list(ends)
+        self.pitches = list(pitches)
+        self.latest_starts = build_segment_tree(self.starts, max, float("-inf"))
+        self.earliest_starts = build_segment_tree(self.starts, min, float("inf"))
+        self.latest_ends = build_segment_tree(self.ends, max, float("-inf"))
+        self.tree_size = len(self.latest_starts) // 2
+        self.onset_notes = {}  # the indexes of the notes starting at each start
+        for note_idx, start in enumerate(self.starts):
+            self.onset_notes.setdefault(start, []).append(note_idx)
+
+    def get_scan_stop(self, end):
+        """Return the index of the first note starting after the end, where the scans stop, or the number of notes.
+
+        Args:
+            end: The end time of the note.
+        """
+        if self.latest_starts[1] <= end:
+            return len(self.starts)
+        node = 1
+        while node < self.tree_size:
+            node *= 2
+            if self.latest_starts[node] <= end:
+                node += 1
+        return node - self.tree_size
+
+    def has_concurrent_note(self, scan_stop, start):
+        """Return True if a note before the scan stop, not starting at the start, ends at or after it, False
+        otherwise, that is if a note not starting with the note is concurrent with it.
+
+        Args:
+            scan_stop: The index where the scan stops, see get_scan_stop.
+            start: The start time of the note.
+        """
+        # (node, index of its first note, number of its notes)
+        nodes = [(1, 0, self.tree_size)]
+        while nodes:
+            node, node_start, node_size = nodes.pop()
+            if (
+                node_start >= scan_stop
+                or self.latest_ends[node] < start
+                or self.earliest_starts[node] == self.latest_starts[node] == start
+            ):
+                continue
+            if node >= self.tree_size:
+                return True
+            node_size //= 2
+            nodes.append((2 * node + 1, node_start + node_size, node_size))
+            nodes.append((2 * node, node_start, node_size))
+        return False
 
-    return False
+    def get_same_start_notes(self, scan_stop, start, pitch):
+        """Return the indexes of the notes before the scan stop starting at the start with another pitch, in order.
+
+        Args:
+            scan_stop: The index where the scan stops, see get_scan_stop.
+            start: The start time of the note.
+            pitch: The pitch of the note.
+        """
+        return [
+            note_idx
+            for note_idx in self.onset_notes.get(start, [])
+            if note_idx < scan_stop and self.pitches[note_idx] != pitch
+        ]
+
+    def update_note(self, note_idx, start, end):
+        """Set the start and the end of the note, after an effect moved it.
+
+        Args:
+            note_idx: The index of the note.
+            start: The new start time of the note.
+            end: The new end time of the note.
+        """
+        onset_notes = self.onset_notes[self.starts[note_idx]]
+        onset_notes.remove(note_idx)
+        if len(onset_notes) == 0:
+            del self.onset_notes[self.starts[note_idx]]
+        bisect.insort(self.onset_notes.setdefault(start, []), note_idx)
+        self.starts[note_idx] = start
+        self.ends[note_idx] = end
+        update_segment_tree(self.latest_starts, note_idx, start, max)
+        update_segment_tree(self.earliest_starts, note_idx, start, min)
+        update_segment_tree(self.latest_ends, note_idx, end, max)
+
+
+def get_note_intervals(notes):
+    """Return the interval index of the notes of a hand.
 
+    Args:
+        notes: The notes of a hand in the note array.
+    """
+    return NoteIntervals(notes.start.tolist(), notes.end.tolist(), notes.pitch.tolist())
 
-def apply_staccato_effect(note, multiplier=STACCATO_MULTIPLIER):
-    """Apply the staccato effect to the note.
+
+def get_breath_notes(note_idx, melody_intervals, bass_intervals):
+    """Return the indexes of the melody and bass notes of another pitch played together with the melody note,
+    starting and ending with it, and of those starting with it and ending before it, or None if a note not starting
+    with it is concurrent with it.
+
+    Args:
+        note_idx: The index of the melody note followed by silence.
+        melody_intervals: The interval index of the melody notes.
+        bass_intervals: The interval index of the bass notes.
+    """
+    start = melody_intervals.starts[note_idx]
+    end = melody_intervals.ends[note_idx]
+    pitch = melody_intervals.pitches[note_idx]
+    melody_scan_stop = melody_intervals.get_scan_stop(end)
+    bass_scan_stop = bass_intervals.get_scan_stop(end)
+    if melody_intervals.has_concurrent_note(
+        melody_scan_stop, start
+    ) or bass_intervals.has_concurrent_note(bass_scan_stop, start):
+        return None
+
+    breath_notes = []
+    for intervals, scan_stop in (
+        (melody_intervals, melody_scan_stop),
+        (bass_intervals, bass_scan_stop),
+    ):
+        same_start_notes = intervals.get_same_start_notes(scan_stop, start, pitch)
+        breath_notes.append(
+            (
+                [idx for idx in same_start_notes if intervals.ends[idx] == end],
+                [idx for idx in same_start_notes if intervals.ends[idx] < end],
+            )
+        )
+    (melody_together, melody_same_start), (
+        bass_together,
+        bass_same_start,
+    ) = breath_notes
+    return melody_together, bass_together, melody_same_start, bass_same_start
+
+
+def update_note_indexes(note_idx, start, end, intervals, adjacency=None):
+    """Update the indexes of the notes of a hand after an effect moved the note.
+
+    Args:
+        note_idx: The index of the note.
+        start: The new start time of the note.
+        end: The new end time of the note.
+        intervals: The interval index of the notes.
+        adjacency: The adjacency index of the notes, if any.
+    """
+    intervals.update_note(note_idx, start, end)
+    if adjacency is not None:
+        adjacency.update_start(note_idx, start)
+
+
+def normalize_velocity_array(velocity, notes):
+    """Normalize the velocity of the notes of a hand.
+
+    Args:
+        velocity: The velocity to which the notes are normalized.
+        notes: The notes of a hand in the note array.
+    """
+    notes.velocity = velocity
+
+
+def get_avg_velocity_array(notes):
+    """Return the average velocity of the notes of a hand.
 
     Args:
-        note: The note to which the staccato effect is applied.
+        notes: The notes of a hand in the note array.
     """
-    note.end = note.end - multiplier * (note.end - note.start)
-    return note
+    return int(notes.velocity.sum()) // len(notes)
+
 
+def add_staccato_to_repeated_notes_array(notes, adjacency=None):
+    """Apply the staccato effect to the repeated notes of a hand, the notes repeated in their next or previous notes
+    which are not shortened: they are shortened and played louder, the louder the longer the run of notes repeated
+    in their next notes.
 
-def add_staccato_to_repeated_notes(notes):
-    """Iterate through the notes and apply the staccato effect to the repeated notes.
+    The notes repeated in their next notes are found at once. The previous notes of a note depend on the ends of the
+    notes before it, which are shortened by the effect, so the notes are then visited in order and added to the
+    adjacency index as previous notes once their end is final.
 
     Args:
-        notes: The list of notes.
+        notes: The notes of a hand in the note array.
+        adjacency: The adjacency index of the notes, built if not given.
     """
+    if adjacency is None:
+        adjacency = get_note_adjacency(notes)
+    next_idx, next_stop = adjacency.get_next_notes_arrays()
+    next_repeated_mask = get_next_repeated_mask(
+        notes.start, notes.pitch, next_idx, next_stop
+    ).tolist()
+    is_shortened_list = is_shortened(notes).tolist()
+    starts = notes.start.tolist()
+    ends = notes.end.tolist()
+    pitches = notes.pitch.tolist()
+    velocities = notes.velocity.tolist()
+
+    adjacency.clear_previous_notes()
     velocity_increase = VELOCITY_VARIATION
-    for curr_note_idx, curr_note in enumerate(notes):
-        next_notes = get_next_notes(curr_note_idx, notes)
-        if is_nearby_note_repeated(curr_note_idx, next_notes, notes):
-            if not is_shortened(curr_note):
-                curr_note = apply_staccato_effect(curr_note)
-                curr_note.velocity = min(
-                    MAX_VELOCITY, curr_note.velocity + velocity_increase
+    for curr_note_idx in range(len(starts)):
+        start = starts[curr_note_idx]
+        if next_repeated_mask[curr_note_idx]:
+            if not is_shortened_list[curr_note_idx]:
+                ends[curr_note_idx] -= STACCATO_MULTIPLIER * (
+                    ends[curr_note_idx] - start
+                )
+                velocities[curr_note_idx] = min(
+                    MAX_VELOCITY, velocities[curr_note_idx] + velocity_increase
                 )
                 velocity_increase += VELOCITY_VARIATION
-                notes[curr_note_idx] = curr_note
         else:
-            previous_notes = get_previous_notes(curr_note_idx, notes)
-            if is_nearby_note_repeated(
-                curr_note_idx, previous_notes, notes
-            ) and not is_shortened(curr_note):
-                curr_note = apply_staccato_effect(curr_note)
-                curr_note.velocity = min(
-                    MAX_VELOCITY, curr_note.velocity + velocity_increase
-                )
-                notes[curr_note_idx] = curr_note
+            if not is_shortened_list[curr_note_idx]:
+                pitch = pitches[curr_note_idx]
+                if any(
+                    pitches[previous_idx] == pitch
+                    for previous_idx in adjacency.get_previous_notes(curr_note_idx)
+                ):
+                    ends[curr_note_idx] -= STACCATO_MULTIPLIER * (
+                        ends[curr_note_idx] - start
+                    )
+                    velocities[curr_note_idx] = min(
+                        MAX_VELOCITY, velocities[curr_note_idx] + velocity_increase
+                    )
             velocity_increase = VELOCITY_VARIATION
+        adjacency.add_previous_note(curr_note_idx, ends[curr_note_idx])
 
+    notes.end = ends
+    notes.velocity = velocities
 
-def get_avg_velocity(notes):
-    """Return the average velocity of the notes.
+
+def add_staccato_to_melody_array(notes, adjacency=None):
+    """Apply the staccato effect to the melody notes not already followed by a staccato before their next notes:
+    the notes of standard duration get the general staccato effect, and the shortened ones the staccato effect with
+    a smaller multiplier. Each note is only shortened according to its own duration and the start of its next
+    notes, so all the notes are shortened at once.
 
     Args:
-        notes: The list of notes.
+        notes: The notes of a hand in the note array.
+        adjacency: The adjacency index of the notes, built if not given.
     """
-    velocity_sum = 0
-    for note in notes:
-        velocity_sum += note.velocity
-    return velocity_sum // len(notes)
+    if adjacency is None:
+        adjacency = get_note_adjacency(notes)
+    next_idx, _ = adjacency.get_next_notes_arrays()
+    has_next = next_idx < len(notes)
+    next_starts = np.append(notes.start, np.inf)[next_idx]
+    has_staccato = has_next & (next_starts - notes.end > STACCATO_DURATION)
+
+    is_standard = ~has_staccato & is_standard_duration(notes)
+    is_short = ~has_staccato & ~is_standard & is_shortened(notes)
+    multipliers = np.where(
+        is_standard, STACCATO_MULTIPLIER, SHORTENED_STACCATO_MULTIPLIER
+    )
+    to_shorten = is_standard | is_short
+    notes.end[to_shorten] = notes.end[to_shorten] - multipliers[to_shorten] * (
+        notes.end[to_shorten] - notes.start[to_shorten]
+    )
 
 
-def normalize_velocity(velocity, notes):
-    """Normalize the velocity of the notes.
+def load_timing_functions(multipliers_file):
+    """Return the timing function of each time signature saved in a JSON file by save_avg_multiplier of
+    assignment_1/taskA.py, the average duration multiplier of each beat of each time signature, as a dictionary of
+    the arrays of the multipliers of the beats by time signature. The beats without multiplier keep their duration.
 
     Args:
-        velocity: The velocity to which the notes are normalized.
-        notes: The list of notes.
+        multipliers_file: The JSON file of the multipliers.
     """
-    for note in notes:
-        note.velocity = velocity
+    with open(multipliers_file) as f:
+        avg_mult_per_time_sig_per_beat = json.load(f)
 
+    timing_functions = {}
+    for time_signature, beat_multipliers in avg_mult_per_time_sig_per_beat.items():
+        beats = np.array([int(beat) for beat in beat_multipliers], dtype=np.int64)
+        multipliers = np.ones(beats.max() + 1 if len(beats) > 0 else 0)
+        multipliers[beats] = list(beat_multipliers.values())
+        timing_functions[time_signature] = multipliers
+    return timing_functions
 
-def is_standard_duration(note):
-    """Return True if the note has a standard duration, False otherwise.
+
+def load_learned_multipliers(multipliers_file):
+    """Return the multipliers of a JSON file, the average multiplier of each beat of each time signature as computed
+    by calculate_avg_multiplier of assignment_1/taskA.py, or a list of multipliers.
 
     Args:
-        note: The note to check.
+        multipliers_file: The JSON file of the multipliers.
     """
-    note_duration = note.end - note.start
-    threshold = 0.01
-    return abs(note_duration - STANDARD_DURATION) < threshold
+    with open(multipliers_file) as f:
+        multipliers = json.load(f)
+    if isinstance(multipliers, dict):
+        multipliers = [
+            multiplier
+            for beat_multipliers in multipliers.values()
+            for multiplier in beat_multipliers.values()
+        ]
+    return np.array(multipliers, dtype=np.float64)
 
 
-def is_extended(note):
-    """Return True if the note is extended, False otherwise.
+def get_time_signature_name(piano):
+    """Return the first time signature of the piece, as named in the annotations of the ASAP dataset, such as "3/4".
 
     Args:
-        note: The note to check.
+        piano: The piece.
     """
-    note_duration = note.end - note.start
-    threshold = 0.05
-    return note_duration > STANDARD_DURATION + threshold
+    if len(piano.time_signature_changes) == 0:
+        return DEFAULT_TIME_SIGNATURE
+    time_signature = min(piano.time_signature_changes, key=lambda ts: ts.time)
+    return f"{time_signature.numerator}/{time_signature.denominator}"
 
 
-def is_shortened(note):
-    """Return True if the note is shortened, False otherwise.
+def get_beat_map(beats, multipliers):
+    """Return the performed time of each beat, the duration of each beat being multiplied by its multiplier in the
+    timing function, as the cumulative sum of the performed durations of the beats. The beats after the last
+    multiplier keep their duration.
 
     Args:
-        note: The note to check.
+        beats: The unperformed time of each beat.
+        multipliers: The multiplier of the duration of each beat, see load_timing_functions.
     """
-    note_duration = note.end - note.start
-    threshold = 0.05
-    return note_duration < STANDARD_DURATION - threshold
+    beat_durations = np.diff(beats)
+    nr_multipliers = min(len(beat_durations), len(multipliers))
+    beat_durations[:nr_multipliers] *= multipliers[:nr_multipliers]
+
+    performed_beats = np.empty(len(beats), dtype=np.float64)
+    performed_beats[0] = beats[0]
+    np.cumsum(beat_durations, out=performed_beats[1:])
+    performed_beats[1:] += beats[0]
+    return performed_beats
 
 
-def staccato_before_next_note(curr_note_idx, notes):
-    """Return True if there is a staccato before the next note, False otherwise.
+def warp_times(times, beats, performed_beats):
+    """Return the performed times, interpolated linearly between the performed times of the beats around each time.
+    The times before the first beat are unchanged, and the times after the last beat are shifted with it.
 
     Args:
-        curr_note_idx: The index of the current note.
-        notes: The list of notes.
+        times: The unperformed times.
+        beats: The unperformed time of each beat.
+        performed_beats: The performed time of each beat, see get_beat_map.
     """
-    next_notes = get_next_notes(curr_note_idx, notes)
-    if len(next_notes) == 0:
-        return False
-    next_note_start = notes[next_notes[0]].start
-    curr_note = notes[curr_note_idx]
-    return next_note_start - curr_note.end > STACCATO_DURATION
+    performed_times = np.interp(times, beats, performed_beats)
+    is_after = times > beats[-1]
+    performed_times[is_after] = performed_beats[-1] + times[is_after] - beats[-1]
+    is_before = times < beats[0]
+    performed_times[is_before] = times[is_before]
+    return performed_times
+
+
+class Humanizer:
+    """
+    Humanization of the velocity and the timing of the notes, drawn from a NumPy random generator: each note gets a
+    sample of the distribution, from which both its velocity variation and the shift of its onset are derived in
+    one array operation. The uniform distribution gives a velocity variation between -velocity_variation and
+    velocity_variation, the gaussian one is scaled by the variations as standard deviations, and the learned one is
+    drawn from the relative deviations of the given tempo multipliers around their mean, standardized and scaled as
+    the gaussian one.
+
+    Args:
+        distribution: The distribution of the variations, one of HUMANIZATION_DISTRIBUTIONS.
+        velocity_variation: The scale of the velocity variations.
+        timing_variation: The scale of the shifts of the onsets, in seconds.
+        multipliers: The tempo multipliers of the learned distribution, see load_learned_multipliers.
+    """
+
+    def __init__(
+        self,
+        distribution="uniform",
+        velocity_variation=VELOCITY_VARIATION,
+        timing_variation=TIMING_VARIATION,
+        multipliers=None,
+    ):
+        if distribution not in HUMANIZATION_DISTRIBUTIONS:
+            raise ValueError(f"Unknown humanization distribution: {distribution}")
+        self.distribution = distribution
+        self.velocity_variation = velocity_variation
+        self.timing_variation = timing_variation
+
+        self.learned_deviations = None
+        if distribution == "learned":
+            if multipliers is None or len(multipliers) == 0:
+                raise ValueError("The learned humanization needs tempo multipliers")
+            deviations = multipliers / multipliers.mean() - 1
+            deviation_std = deviations.std()
+            self.learned_deviations = (
+                deviations / deviation_std if deviation_std > 0 else deviations
+            )
+
+    def get_settings(self):
+        """Return the settings of the humanization, which identify the variations drawn with a seed."""
+        settings = {
+            "distribution": self.distribution,
+            "velocity_variation": self.velocity_variation,
+            "timing_variation": self.timing_variation,
+        }
+        if self.learned_deviations is not None:
+            settings["multipliers_hash"] = hashlib.sha256(
+                self.learned_deviations.tobytes()
+            ).hexdigest()
+        return settings
+
+    def draw(self, rng, nr_notes, nr_variants=None):
+        """Return the samples of the notes, an array of (nr_notes, 2) samples or of (nr_variants, nr_notes, 2)
+        samples for several variants, the samples of each note being drawn one after the other, so that drawing the
+        notes one at a time gives the same samples.
+
+        Args:
+            rng: The NumPy random generator.
+            nr_notes: The number of notes.
+            nr_variants: The number of variants, a single one if not given.
+        """
+        shape = (nr_notes, 2) if nr_variants is None else (nr_variants, nr_notes, 2)
+        if self.distribution == "gaussian":
+            return rng.standard_normal(shape)
+        samples = rng.random(shape)
+        if self.distribution == "learned":
+            sample_idx = (samples * len(self.learned_deviations)).astype(np.int64)
+            return self.learned_deviations[sample_idx]
+        return samples
+
+    def apply(self, notes, samples):
+        """Apply the variations of the samples to the velocity and the onset of the notes, keeping their durations,
+        and return whether the onsets changed.
+
+        Args:
+            notes: The notes of a hand in the note array.
+            samples: The (nr_notes, 2) samples of the notes, see draw.
+        """
+        if self.distribution == "uniform":
+            # the samples in [0, 1) are spread evenly over the integer velocity variations and the onset shifts
+            velocity_variations = (
+                np.floor(samples[:, 0] * (2 * self.velocity_variation + 1)).astype(
+                    np.int64
+                )
+                - self.velocity_variation
+            )
+            onset_shifts = (2 * samples[:, 1] - 1) * self.timing_variation
+        else:
+            velocity_variations = np.round(
+                samples[:, 0] * self.velocity_variation
+            ).astype(np.int64)
+            onset_shifts = samples[:, 1] * self.timing_variation
+
+        notes.velocity = np.clip(
+            notes.velocity + velocity_variations, MIN_VELOCITY, MAX_VELOCITY
+        )
+        if self.timing_variation == 0:
+            return False
+        # a note cannot start before the start of the piece
+        onset_shifts = np.maximum(onset_shifts, -notes.start)
+        notes.start += onset_shifts
+        notes.end += onset_shifts
+        return True
+
+
+def apply_breath_effect_array(notes, note_idx, multiplier=BREATH_START_MULTIPLIER):
+    """Apply the breath effect to the notes with the given indexes, delaying their start by a part of their duration
+    and decreasing their velocity, and return the start delay of the last one.
+
+    Args:
+        notes: The notes of a hand in the note array.
+        note_idx: The indexes of the notes.
+        multiplier: The multiplier for the start delay.
+    """
+    start_delays = multiplier * (notes.end[note_idx] - notes.start[note_idx])
+    notes.start[note_idx] += start_delays
+    notes.velocity[note_idx] = np.maximum(
+        5,
+        np.round(
+            notes.velocity[note_idx]
+            - BREATH_VELOCITY_MULTIPLIER * notes.velocity[note_idx]
+        ),
+    )
+    return float(start_delays[-1]) if len(start_delays) > 0 else None
+
 
+def apply_delay_array(notes, note_idx, delay):
+    """Apply the delay to the notes with the given indexes, and decrease their velocity as the breath effect.
+
+    Args:
+        notes: The notes of a hand in the note array.
+        note_idx: The indexes of the notes.
+        delay: The delay to apply.
+    """
+    notes.start[note_idx] += delay
+    notes.end[note_idx] += delay
+    notes.velocity[note_idx] = np.maximum(
+        5,
+        np.round(
+            notes.velocity[note_idx]
+            - BREATH_VELOCITY_MULTIPLIER * notes.velocity[note_idx]
+        ),
+    )
 
-def add_staccato_to_melody(notes):
-    """Iterate through the notes and apply the staccato effect to the melody notes.
-    If the note is of standard duration, apply the general staccato effect.
-    If the note is shortened, apply the staccato effect with a smaller multiplier.
+
+def adjust_notes_followed_by_silence_array(
+    melody_notes, bass_notes, melody_adjacency=None, bass_adjacency=None
+):
+    """Add a sense of breath to the extended melody notes followed by silence, by delaying their start and decreasing
+    their velocity, with the notes played together with them, the notes starting with them being delayed as much.
+
+    The melody notes changed by the effect are marked as processed and are not visited, so the notes left to visit
+    keep their duration and only the extended ones are visited. Their next notes are found in the adjacency index
+    and the notes played with them in the interval indexes of both hands, see get_breath_notes, which are updated
+    as the effect moves the notes.
 
     Args:
-        notes: The list of notes.
+        melody_notes: The melody notes in the note array.
+        bass_notes: The bass notes in the note array.
+        melody_adjacency: The adjacency index of the melody notes, built if not given.
+        bass_adjacency: The adjacency index of the bass notes, kept up to date if given.
     """
-    for curr_note_idx, curr_note in enumerate(notes):
-        # Apply staccato effect only if there is not already a staccato before the next note
-        if staccato_before_next_note(curr_note_idx, notes):
+    if melody_adjacency is None:
+        melody_adjacency = get_note_adjacency(melody_notes)
+    melody_intervals = get_note_intervals(melody_notes)
+    bass_intervals = get_note_intervals(bass_notes)
+    is_processed = np.zeros(len(melody_notes), dtype=bool)
+    for curr_note_idx in np.flatnonzero(is_extended(melody_notes)).tolist():
+        if is_processed[curr_note_idx]:
             continue
+        next_note_idx = melody_adjacency.next_start_idx[curr_note_idx]
+        if next_note_idx == len(melody_notes):
+            continue
+        if (
+            melody_adjacency.starts[next_note_idx]
+            - melody_adjacency.starts[curr_note_idx]
+            <= SILENCE_DURATION
+        ):
+            continue
+        breath_notes = get_breath_notes(curr_note_idx, melody_intervals, bass_intervals)
+        if breath_notes is None:
+            continue
+        (
+            melody_together_idx,
+            bass_together_idx,
+            melody_same_start_idx,
+            bass_same_start_idx,
+        ) = breath_notes
+
+        start_delay = apply_breath_effect_array(melody_notes, melody_together_idx)
+        bass_start_delay = apply_breath_effect_array(bass_notes, bass_together_idx)
+        if bass_start_delay is not None:
+            start_delay = bass_start_delay
+
+        if len(melody_together_idx) > 0 or len(bass_together_idx) > 0:
+            apply_delay_array(melody_notes, melody_same_start_idx, start_delay)
+            apply_delay_array(bass_notes, bass_same_start_idx, start_delay)
+        else:
+            melody_same_start_idx = []
+            bass_same_start_idx = []
+
+        apply_breath_effect_array(melody_notes, [curr_note_idx])
+
+        for note_idx in melody_together_idx + melody_same_start_idx + [curr_note_idx]:
+            is_processed[note_idx] = True
+            update_note_indexes(
+                note_idx,
+                float(melody_notes.start[note_idx]),
+                float(melody_notes.end[note_idx]),
+                melody_intervals,
+                melody_adjacency,
+            )
+        for note_idx in bass_together_idx + bass_same_start_idx:
+            update_note_indexes(
+                note_idx,
+                float(bass_notes.start[note_idx]),
+                float(bass_notes.end[note_idx]),
+                bass_intervals,
+                bass_adjacency,
+            )
+
+
+class Performance:
+    """
+    The notes of a piece being performed, shared by the stages of the pipeline: the note array, the view of the
+    notes of each hand and their adjacency indexes, the hands being indexed by MELODY_HAND and BASS_HAND.
 
-        if is_standard_duration(curr_note):
-            curr_note = apply_staccato_effect(curr_note)
-            notes[curr_note_idx] = curr_note
-        elif is_shortened(curr_note):
-            curr_note = apply_staccato_effect(curr_note, SHORTENED_STACCATO_MULTIPLIER)
-            notes[curr_note_idx] = curr_note
+    Unless the piece has two instruments, the notes of all its pitched instruments are separated into the hands,
+    which replace them as the first two instruments of the piece.
 
+    Args:
+        piano: The unperformed piece, the first instrument being the right hand playing the melody and the second
+            one the left hand playing the bass.
+        separation: The separation of the notes into the hands, one of HAND_SEPARATIONS, by default by instrument
+            if the piece has two pitched instruments and by pitch otherwise.
+        seed: The seed of the random generator of the humanization, a random one if not given.
+        humanizer: The humanization of the melody, see Humanizer, the uniform velocity variations if not given.
+        timing_functions: The timing functions applied by the timing curve, see load_timing_functions.
+    """
 
-def add_general_randomization_on_velocity(notes):
-    """Iterate through the notes and add a general randomization on velocity.
+    def __init__(
+        self, piano, separation=None, seed=None, humanizer=None, timing_functions=None
+    ):
+        self.piano = piano
+        self.rng = np.random.default_rng(seed)
+        self.humanizer = Humanizer() if humanizer is None else humanizer
+        self.timing_functions = timing_functions
+        # the humanization samples of the melody notes, drawn by the humanization if not set
+        self.humanization = None
+        pitched_instruments = [
+            instrument for instrument in piano.instruments if not instrument.is_drum
+        ]
+        if separation is None:
+            separation = "instruments" if len(pitched_instruments) == 2 else "pitch"
+        self.separation = separation
+
+        if separation == "instruments":
+            self.note_array = get_note_array(piano.instruments[:2])
+        else:
+            self.note_array = separate_hands(
+                get_note_array(pitched_instruments), separation
+            )
+        self.index_notes()
+
+        if separation != "instruments":
+            program = pitched_instruments[0].program if pitched_instruments else 0
+            hand_instruments = [
+                pretty_midi.Instrument(program, name=name)
+                for name in ("Melody", "Bass")
+            ]
+            for hand_instrument, hand_notes in zip(hand_instruments, self.hands):
+                set_instrument_notes(hand_instrument, hand_notes)
+            piano.instruments = hand_instruments + [
+                instrument for instrument in piano.instruments if instrument.is_drum
+            ]
+
+    def index_notes(self):
+        """Build the views of the notes of each hand in the note array and their adjacency indexes."""
+        self.hands = [
+            get_hand_notes(self.note_array, hand) for hand in (MELODY_HAND, BASS_HAND)
+        ]
+        # The adjacency of the notes of each hand is indexed once for all the effects
+        self.adjacencies = [get_note_adjacency(hand_notes) for hand_notes in self.hands]
+
+    def copy(self):
+        """Return a copy of the performance with its own notes, sharing the piece, to perform variants of it."""
+        performance = copy.copy(self)
+        performance.note_array = self.note_array.copy()
+        performance.index_notes()
+        return performance
+
+    def update_instruments(self):
+        """Replace the notes of the instruments by the performed notes."""
+        for hand, hand_notes in enumerate(self.hands):
+            set_instrument_notes(self.piano.instruments[hand], hand_notes)
+
+
+def normalize_velocity_stage(performance):
+    """Normalize volume of left hand to be lower than right hand.
 
     Args:
-        notes: The list of notes.
+        performance: The performance.
     """
-    for note in notes:
-        velocity_variation = random.randint(-VELOCITY_VARIATION, VELOCITY_VARIATION)
-        note.velocity = min(MAX_VELOCITY, note.velocity + velocity_variation)
+    # the velocity of the bass is normalized with the melody
+    if len(performance.hands[MELODY_HAND]) == 0:
+        return
+    normalize_velocity_array(
+        get_avg_velocity_array(performance.hands[MELODY_HAND]) - 20,
+        performance.hands[BASS_HAND],
+    )
 
 
-def get_concurrent_notes(curr_note, notes):
-    """Return the indexes of the notes that are played together with the current note.
+def bass_repeated_staccato_stage(performance):
+    """Add staccato to the repeated notes of the left hand.
 
     Args:
-        curr_note: The current note.
-        notes: The list of notes.
+        performance: The performance.
     """
-    concurrent_notes = []
+    add_staccato_to_repeated_notes_array(
+        performance.hands[BASS_HAND], performance.adjacencies[BASS_HAND]
+    )
 
-    for other_note_idx, other_note in enumerate(notes):
-        # do not consider notes that are played at the same time as concurrent
-        if other_note.start == curr_note.start:
-            continue
-        if other_note.start <= curr_note.end and other_note.end >= curr_note.start:
-            concurrent_notes.append(other_note_idx)
-        if other_note.start > curr_note.end:
-            break
-    return concurrent_notes
+
+def melody_staccato_stage(performance):
+    """Add staccato to the melody notes of the right hand.
+
+    Args:
+        performance: The performance.
+    """
+    add_staccato_to_melody_array(
+        performance.hands[MELODY_HAND], performance.adjacencies[MELODY_HAND]
+    )
 
 
-def apply_breath_effect(note, multiplier=BREATH_START_MULTIPLIER):
-    """Apply the breath effect to the note.
+def humanization_stage(performance):
+    """Add a humanization on the velocity and the timing of the right hand.
 
     Args:
-        note: The note to which the breath effect is applied.
-        multiplier: The multiplier for the start delay.
+        performance: The performance.
+    """
+    melody_notes = performance.hands[MELODY_HAND]
+    samples = performance.humanization
+    if samples is None:
+        samples = performance.humanizer.draw(performance.rng, len(melody_notes))
+    if performance.humanizer.apply(melody_notes, samples):
+        performance.adjacencies[MELODY_HAND] = get_note_adjacency(melody_notes)
+
+
+def breath_stage(performance):
+    """Adjust the notes followed by silence in both hands, adding the breath effect.
+
+    Args:
+        performance: The performance.
     """
-    start_delay = multiplier * (note.end - note.start)
-    note.start += start_delay
-    note.velocity = max(
-        5, round(note.velocity - BREATH_VELOCITY_MULTIPLIER * note.velocity)
+    adjust_notes_followed_by_silence_array(
+        performance.hands[MELODY_HAND],
+        performance.hands[BASS_HAND],
+        performance.adjacencies[MELODY_HAND],
+        performance.adjacencies[BASS_HAND],
     )
-    return start_delay
 
 
-def apply_delay(note, delay):
-    """Apply the delay to the note.
+def melody_repeated_staccato_stage(performance):
+    """Add staccato to the repeated notes of the right hand.
 
     Args:
-        note: The note to which the delay is applied.
-        delay: The delay to apply.
+        performance: The performance.
     """
-    note.start += delay
-    note.end += delay
-    note.velocity = max(
-        5, round(note.velocity - BREATH_VELOCITY_MULTIPLIER * note.velocity)
+    add_staccato_to_repeated_notes_array(
+        performance.hands[MELODY_HAND], performance.adjacencies[MELODY_HAND]
     )
 
 
-def adjust_notes_followed_by_silence(melody_notes, bass_notes):
-    """Iterate through the notes and extend the notes that are followed by silence, if not already extended.
-    Additionally, delay the start and decrease the velocity to add a sense of breath.
+def timing_curve_stage(performance):
+    """Warp the times of the notes of both hands with the timing function of the time signature of the piece.
 
     Args:
-        melody_notes: The list of melody notes.
-        bass_notes: The list of bass notes.
+        performance: The performance.
     """
-    breath_effect_indexes = []
-    for curr_note_idx, curr_note in enumerate(melody_notes):
-        if curr_note_idx in breath_effect_indexes:
+    time_signature = get_time_signature_name(performance.piano)
+    if (
+        performance.timing_functions is None
+        or time_signature not in performance.timing_functions
+    ):
+        raise ValueError(f"No timing function for the time signature {time_signature}")
+    beats = performance.piano.get_beats()
+    if len(beats) == 0:
+        return
+    performed_beats = get_beat_map(beats, performance.timing_functions[time_signature])
+
+    notes = performance.note_array
+    notes.start = warp_times(notes.start, beats, performed_beats)
+    notes.end = warp_times(notes.end, beats, performed_beats)
+    # The order of the starts is kept, but the adjacency indexes hold the starts
+    performance.index_notes()
+
+
+PipelineStage = collections.namedtuple(
+    "PipelineStage",
+    ["function", "hands_read", "hands_changed", "is_random"],
+    defaults=[False],
+)
+StageReport = collections.namedtuple(
+    "StageReport", ["name", "seconds", "notes_touched", "allocated_bytes"]
+)
+
+# The registered stages of the pipeline, by name, with the hands whose notes each one reads and changes, and
+# whether it draws from the random generator of the performance
+PIPELINE_STAGES = {
+    "normalize_velocity": PipelineStage(
+        normalize_velocity_stage, {MELODY_HAND, BASS_HAND}, {BASS_HAND}
+    ),
+    "bass_repeated_staccato": PipelineStage(
+        bass_repeated_staccato_stage, {BASS_HAND}, {BASS_HAND}
+    ),
+    "melody_staccato": PipelineStage(
+        melody_staccato_stage, {MELODY_HAND}, {MELODY_HAND}
+    ),
+    "humanization": PipelineStage(
+        humanization_stage, {MELODY_HAND}, {MELODY_HAND}, is_random=True
+    ),
+    "breath": PipelineStage(
+        breath_stage, {MELODY_HAND, BASS_HAND}, {MELODY_HAND, BASS_HAND}
+    ),
+    "melody_repeated_staccato": PipelineStage(
+        melody_repeated_staccato_stage, {MELODY_HAND}, {MELODY_HAND}
+    ),
+    "timing_curve": PipelineStage(
+        timing_curve_stage, {MELODY_HAND, BASS_HAND}, {MELODY_HAND, BASS_HAND}
+    ),
+}
+# The stages of the performance, in the order of the original script
+DEFAULT_PIPELINE = [
+    "normalize_velocity",
+    "bass_repeated_staccato",
+    "melody_staccato",
+    "humanization",
+    "breath",
+    "melody_repeated_staccato",
+]
+
+
+def load_pipeline(pipeline_file):
+    """Return the stage names of the pipeline described in the JSON file, a list of stage names in order.
+
+    Args:
+        pipeline_file: The JSON file of the pipeline.
+    """
+    with open(pipeline_file) as f:
+        stage_names = json.load(f)
+    if not isinstance(stage_names, list):
+        raise ValueError(f"The pipeline {pipeline_file} is not a list of stage names")
+    return stage_names
+
+
+def get_stage_groups(stage_names):
+    """Split the stages into groups of consecutive stages which can run concurrently, none of the stages of a group
+    changing the notes of a hand read or changed by another stage of the group.
+
+    Args:
+        stage_names: The names of the stages, in order.
+    """
+    groups = []
+    hands_read = set()
+    hands_changed = set()
+    for name in stage_names:
+        stage = PIPELINE_STAGES[name]
+        if (
+            len(groups) == 0
+            or stage.hands_changed & (hands_read | hands_changed)
+            or stage.hands_read & hands_changed
+        ):
+            groups.append([])
+            hands_read = set()
+            hands_changed = set()
+        groups[-1].append(name)
+        hands_read |= stage.hands_read
+        hands_changed |= stage.hands_changed
+    return groups
+
+
+def run_stage(performance, name, trace_memory=False):
+    """Run the stage of the pipeline on the performance and return its report: its duration, the number of notes
+    it changed and, when tracing the memory, the peak of the memory it allocated.
+
+    Args:
+        performance: The performance.
+        name: The name of the stage.
+        trace_memory: Whether to trace the memory allocated by the stage with tracemalloc.
+    """
+    stage = PIPELINE_STAGES[name]
+    hands_before = {
+        hand: performance.hands[hand].copy() for hand in stage.hands_changed
+    }
+    if trace_memory:
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+
+    start_time = time.perf_counter()
+    stage.function(performance)
+    seconds = time.perf_counter() - start_time
+
+    allocated_bytes = None
+    if trace_memory:
+        allocated_bytes = tracemalloc.get_traced_memory()[1] - start_memory
+        if not was_tracing:
+            tracemalloc.stop()
+    notes_touched = sum(
+        int(np.count_nonzero(hand_notes != performance.hands[hand]))
+        for hand, hand_notes in hands_before.items()
+    )
+    return StageReport(name, seconds, notes_touched, allocated_bytes)
+
+
+def run_pipeline(
+    performance, stage_names=DEFAULT_PIPELINE, nr_workers=1, trace_memory=False
+):
+    """Run the stages of the pipeline on the performance in order and return their reports, see run_stage.
+    With more than one worker, the consecutive stages working on different hands run concurrently in threads,
+    see get_stage_groups. The memory of the stages can only be traced when they run one at a time.
+
+    Args:
+        performance: The performance.
+        stage_names: The names of the stages, in order, among the registered PIPELINE_STAGES.
+        nr_workers: The number of threads running the stages of a group.
+        trace_memory: Whether to trace the memory allocated by each stage, which runs the stages one at a time.
+    """
+    for name in stage_names:
+        if name not in PIPELINE_STAGES:
+            raise ValueError(
+                f"Unknown pipeline stage {name}, the stages are {', '.join(PIPELINE_STAGES)}"
+            )
+
+    if nr_workers > 1 and not trace_memory:
+        groups = get_stage_groups(stage_names)
+    else:
+        groups = [[name] for name in stage_names]
+
+    reports = []
+    for group in groups:
+        if len(group) == 1:
+            reports.append(run_stage(performance, group[0], trace_memory))
             continue
-        next_notes = get_next_notes(curr_note_idx, melody_notes)
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(nr_workers, len(group))
+        ) as executor:
+            reports.extend(executor.map(run_stage, [performance] * len(group), group))
+    return reports
 
-        if len(next_notes) > 0:
-            next_note_start = melody_notes[next_notes[0]].start
 
-            if (
-                next_note_start - curr_note.start > SILENCE_DURATION
-                and is_extended(curr_note)
-                and len(get_concurrent_notes(curr_note, melody_notes)) == 0
-                and len(get_concurrent_notes(curr_note, bass_notes)) == 0
-            ):
-                melody_notes_played_together = get_notes_playing_together(
-                    curr_note, melody_notes
-                )
-                start_delay = None
-                for note_idx in melody_notes_played_together:
-                    note = melody_notes[note_idx]
-                    start_delay = apply_breath_effect(note)
-                    melody_notes[note_idx] = note
-                    breath_effect_indexes.append(note_idx)
-
-                bass_notes_played_together = get_notes_playing_together(
-                    curr_note, bass_notes
-                )
-                for note_idx in bass_notes_played_together:
-                    note = bass_notes[note_idx]
-                    start_delay = apply_breath_effect(note)
-                    bass_notes[note_idx] = note
-
-                if (
-                    len(melody_notes_played_together) > 0
-                    or len(bass_notes_played_together) > 0
-                ):
-                    same_start_notes_melody = get_notes_with_same_start_smaller_end(
-                        curr_note, melody_notes
-                    )
-                    for note_idx in same_start_notes_melody:
-                        note = melody_notes[note_idx]
-                        apply_delay(note, start_delay)
-                        melody_notes[note_idx] = note
-                        breath_effect_indexes.append(note_idx)
-
-                    same_start_notes_bass = get_notes_with_same_start_smaller_end(
-                        curr_note, bass_notes
-                    )
-                    for note_idx in same_start_notes_bass:
-                        note = bass_notes[note_idx]
-                        apply_delay(note, start_delay)
-                        bass_notes[note_idx] = note
+def print_stage_reports(reports):
+    """Print the duration, the notes touched and the allocated memory of each stage of the pipeline.
+
+    Args:
+        reports: The reports of the stages, see run_stage.
+    """
+    total_seconds = sum(report.seconds for report in reports)
+    for report in reports:
+        allocated = (
+            f", {report.allocated_bytes / 1024:.1f} KiB allocated"
+            if report.allocated_bytes is not None
+            else ""
+        )
+        print(
+            f"{report.name}: {report.seconds:.4f}s "
+            f"({100 * report.seconds / max(total_seconds, 1e-12):.1f}%), "
+            f"{report.notes_touched} notes touched{allocated}"
+        )
+
+
+def write_performance(performance, output_midi_file, tempo_map=None):
+    """Write the performed piece into a MIDI file straight from the note array, as pretty_midi would write it after
+    update_instruments, without building the notes of the instruments.
 
-                apply_breath_effect(curr_note)
-                melody_notes[curr_note_idx] = curr_note
-                breath_effect_indexes.append(curr_note_idx)
+    Args:
+        performance: The performance.
+        output_midi_file: The output MIDI file.
+        tempo_map: The tempo map of the piece, see midi_writer.TempoMap, loaded from the piece if not given.
+    """
+    if tempo_map is None:
+        tempo_map = TempoMap(performance.piano)
+    tracks = []
+    for instrument_idx, instrument in enumerate(performance.piano.instruments):
+        note_arrays = None
+        if instrument_idx < len(performance.hands):
+            hand_notes = performance.hands[instrument_idx]
+            note_arrays = (
+                hand_notes.start,
+                hand_notes.end,
+                hand_notes.pitch,
+                hand_notes.velocity,
+            )
+        tracks.append(
+            encode_instrument(tempo_map, instrument_idx, instrument, note_arrays)
+        )
+    write_midi_file(output_midi_file, tempo_map, tracks)
+
+
+def render_performance(
+    piano,
+    stage_names=DEFAULT_PIPELINE,
+    nr_workers=1,
+    separation=None,
+    seed=None,
+    humanizer=None,
+    timing_functions=None,
+):
+    """Apply the expressive performance effects to the piece over its note array, the first instrument being the
+    right hand playing the melody and the second one the left hand playing the bass.
 
+    Args:
+        piano: The unperformed piece, whose first two instruments are replaced by their performed version.
+        stage_names: The names of the stages of the pipeline, in order, see run_pipeline.
+        nr_workers: The number of threads running the independent stages, see run_pipeline.
+        separation: The separation of the notes into the hands, see Performance.
+        seed: The seed of the random generator of the humanization, see Performance.
+        humanizer: The humanization of the melody, see Performance.
+        timing_functions: The timing functions applied by the timing curve, see Performance.
+    """
+    performance = Performance(piano, separation, seed, humanizer, timing_functions)
+    run_pipeline(performance, stage_names, nr_workers)
+    performance.update_instruments()
+    return piano
+
+
+def render_variants(
+    piano,
+    nr_variants,
+    stage_names=DEFAULT_PIPELINE,
+    separation=None,
+    seed=None,
+    humanizer=None,
+    timing_functions=None,
+):
+    """Return the given number of performances of the piece, each one with its own humanization. The stages before
+    the first random stage are run once for all the variants, and the humanization samples of all the variants are
+    drawn at once, so that a variant does not depend on the number of variants and the first one is the performance
+    rendered with the same seed.
+
+    Args:
+        piano: The unperformed piece.
+        nr_variants: The number of variants.
+        stage_names: The names of the stages of the pipeline, in order, see run_pipeline.
+        separation: The separation of the notes into the hands, see Performance.
+        seed: The seed of the random generator of the humanization, see Performance.
+        humanizer: The humanization of the melody, see Performance.
+        timing_functions: The timing functions applied by the timing curve, see Performance.
+    """
+    performance = Performance(piano, separation, seed, humanizer, timing_functions)
+    random_stage_idx = len(stage_names)
+    for stage_idx, name in enumerate(stage_names):
+        if name in PIPELINE_STAGES and PIPELINE_STAGES[name].is_random:
+            random_stage_idx = stage_idx
+            break
+    run_pipeline(performance, stage_names[:random_stage_idx])
 
-def main(input_midi_file, output_midi_file):
+    samples = performance.humanizer.draw(
+        performance.rng, len(performance.hands[MELODY_HAND]), nr_variants
+    )
+    variants = []
+    for variant_samples in samples:
+        variant = performance.copy()
+        variant.humanization = variant_samples
+        run_pipeline(variant, stage_names[random_stage_idx:])
+        variants.append(variant)
+    return variants
+
+
+def get_variant_midi_file(output_midi_file, variant_idx):
+    """Return the MIDI file of a variant of the performance.
+
+    Args:
+        output_midi_file: The output MIDI file of the performance.
+        variant_idx: The index of the variant.
+    """
+    output_stem, output_extension = os.path.splitext(output_midi_file)
+    return f"{output_stem}_{variant_idx}{output_extension}"
+
+
+def main(
+    input_midi_file,
+    output_midi_file,
+    stage_names=DEFAULT_PIPELINE,
+    nr_threads=1,
+    profile=False,
+    trace_memory=False,
+    separation=None,
+    seed=None,
+    humanizer=None,
+    nr_variants=1,
+    timing_functions=None,
+):
     # Load the input MIDI file representing the unperformed version
     piano = pretty_midi.PrettyMIDI(input_midi_file)
 
-    right_hand_melody = list(piano.instruments)[0]
-    left_hand_bass = list(piano.instruments)[1]
+    if nr_variants > 1:
+        # The variants are written with the tempo map of the piece, loaded once
+        tempo_map = TempoMap(piano)
+        for variant_idx, variant in enumerate(
+            render_variants(
+                piano,
+                nr_variants,
+                stage_names,
+                separation,
+                seed,
+                humanizer,
+                timing_functions,
+            )
+        ):
+            write_performance(
+                variant, get_variant_midi_file(output_midi_file, variant_idx), tempo_map
+            )
+        return
+
+    performance = Performance(piano, separation, seed, humanizer, timing_functions)
+    reports = run_pipeline(performance, stage_names, nr_threads, trace_memory)
 
-    # Normalize volume of left hand to be lower than right hand
-    normalize_velocity(
-        get_avg_velocity(right_hand_melody.notes) - 20, left_hand_bass.notes
+    # Save the new MIDI file
+    write_performance(performance, output_midi_file)
+
+    if profile or trace_memory:
+        print_stage_reports(reports)
+
+
+def get_input_midi_files(input_path):
+    """Return the unperformed MIDI files to render and the folder their paths are relative to.
+
+    Args:
+        input_path: A folder, whose midi_score.mid files are rendered in all its subfolders, or a glob pattern of
+            MIDI files.
+    """
+    if os.path.isdir(input_path):
+        input_midi_files = [
+            os.path.join(subdir, UNPERFORMED_MIDI)
+            for subdir, dirs, files in os.walk(input_path)
+            if UNPERFORMED_MIDI in files
+        ]
+        return sorted(input_midi_files), input_path
+
+    input_midi_files = sorted(
+        file for file in glob.glob(input_path, recursive=True) if os.path.isfile(file)
+    )
+    if len(input_midi_files) == 0:
+        return [], os.path.dirname(input_path)
+    return input_midi_files, os.path.commonpath(
+        [os.path.dirname(os.path.abspath(file)) for file in input_midi_files]
     )
 
-    add_staccato_to_repeated_notes(left_hand_bass.notes)
 
-    add_staccato_to_melody(right_hand_melody.notes)
+def get_file_hash(file):
+    """Return the SHA-256 hash of the content of the file.
 
-    add_general_randomization_on_velocity(right_hand_melody.notes)
+    Args:
+        file: The file.
+    """
+    with open(file, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get_timing_functions_hash(timing_functions):
+    """Return the SHA-256 hash of the timing functions, or None without timing functions.
 
-    adjust_notes_followed_by_silence(right_hand_melody.notes, left_hand_bass.notes)
+    Args:
+        timing_functions: The timing functions, see load_timing_functions.
+    """
+    if timing_functions is None:
+        return None
+    timing_functions_hash = hashlib.sha256()
+    for time_signature in sorted(timing_functions):
+        timing_functions_hash.update(time_signature.encode())
+        timing_functions_hash.update(
+            np.ascontiguousarray(timing_functions[time_signature], np.float64)
+        )
+    return timing_functions_hash.hexdigest()
 
-    add_staccato_to_repeated_notes(right_hand_melody.notes)
 
-    # Update the instruments
-    piano.instruments[0] = right_hand_melody
-    piano.instruments[1] = left_hand_bass
+def get_file_seed(seed, relative_midi_file):
+    """Return the random seed of a file of the corpus, derived from the seed of the batch and the path of the file,
+    so that a file is rendered the same whatever the process rendering it and the other files of the batch.
 
-    # Save the new MIDI file
-    piano.write(output_midi_file)
+    Args:
+        seed: The random seed of the batch.
+        relative_midi_file: The path of the file relative to the corpus folder.
+    """
+    file_key = f"{seed}:{relative_midi_file.replace(os.sep, '/')}"
+    return int.from_bytes(hashlib.sha256(file_key.encode()).digest()[:8], "big")
+
+
+def render_file(
+    input_midi_file,
+    output_midi_file,
+    seed,
+    stage_names=DEFAULT_PIPELINE,
+    separation=None,
+    humanizer=None,
+    timing_functions=None,
+):
+    """Render the expressive performance of the unperformed MIDI file with the given random seed and return the
+    number of notes of the performance.
+
+    Args:
+        input_midi_file: The unperformed MIDI file.
+        output_midi_file: The performed MIDI file.
+        seed: The seed of the random generator of the humanization.
+        stage_names: The names of the stages of the pipeline, in order, see run_pipeline.
+        separation: The separation of the notes into the hands, see Performance.
+        humanizer: The humanization of the melody, see Performance.
+        timing_functions: The timing functions applied by the timing curve, see Performance.
+    """
+    piano = pretty_midi.PrettyMIDI(input_midi_file)
+    performance = Performance(piano, separation, seed, humanizer, timing_functions)
+    run_pipeline(performance, stage_names)
+    os.makedirs(os.path.dirname(os.path.abspath(output_midi_file)), exist_ok=True)
+    write_performance(performance, output_midi_file)
+    return len(performance.note_array) + sum(
+        len(instrument.notes)
+        for instrument in piano.instruments[len(performance.hands) :]
+    )
+
+
+def render_corpus(
+    input_path,
+    output_folder,
+    nr_workers=None,
+    seed=0,
+    force=False,
+    stage_names=DEFAULT_PIPELINE,
+    separation=None,
+    humanizer=None,
+    timing_functions=None,
+):
+    """Render the expressive performance of every unperformed MIDI file of the corpus in a pool of processes.
+    The performances are written into the output folder with the same relative paths, and a manifest records the
+    hash of the input, the seed and the stages of each file, so that the files rendered since their last change
+    are skipped.
+
+    Args:
+        input_path: The corpus folder or a glob pattern of MIDI files, see get_input_midi_files.
+        output_folder: The output folder of the performed MIDI files.
+        nr_workers: The number of processes, by default the number of CPUs.
+        seed: The random seed of the batch, from which the seed of each file is derived.
+        force: Whether to render the files which are up to date too.
+        stage_names: The names of the stages of the pipeline, in order, see run_pipeline.
+        separation: The separation of the notes into the hands, see Performance.
+        humanizer: The humanization of the melody, see Performance.
+        timing_functions: The timing functions applied by the timing curve, see Performance.
+    """
+    if humanizer is None:
+        humanizer = Humanizer()
+    input_midi_files, input_folder = get_input_midi_files(input_path)
+    os.makedirs(output_folder, exist_ok=True)
+
+    manifest_file_path = os.path.join(output_folder, MANIFEST_FILENAME)
+    previous_entries = {}
+    if os.path.exists(manifest_file_path):
+        with open(manifest_file_path) as manifest_file:
+            previous_entries = {
+                entry["input_midi_file"]: entry for entry in json.load(manifest_file)
+            }
+
+    manifest = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nr_workers) as executor:
+        futures = {}
+        for input_midi_file in input_midi_files:
+            relative_midi_file = os.path.relpath(
+                os.path.abspath(input_midi_file), os.path.abspath(input_folder)
+            )
+            relative_output_file = (
+                os.path.splitext(relative_midi_file)[0] + PERFORMED_SUFFIX + ".mid"
+            )
+            entry = {
+                "input_midi_file": relative_midi_file,
+                "output_midi_file": relative_output_file,
+                "input_hash": get_file_hash(input_midi_file),
+                "seed": get_file_seed(seed, relative_midi_file),
+                "stages": list(stage_names),
+                "separation": separation,
+                "humanization": humanizer.get_settings(),
+                "timing_functions": get_timing_functions_hash(timing_functions),
+            }
+            output_midi_file = os.path.join(output_folder, relative_output_file)
+
+            previous_entry = previous_entries.get(relative_midi_file, {})
+            if (
+                not force
+                and os.path.exists(output_midi_file)
+                and all(
+                    previous_entry.get(key) == value for key, value in entry.items()
+                )
+            ):
+                print(f"{relative_midi_file}: up to date")
+                manifest.append(previous_entry)
+                continue
+
+            future = executor.submit(
+                render_file,
+                input_midi_file,
+                output_midi_file,
+                entry["seed"],
+                entry["stages"],
+                separation,
+                humanizer,
+                timing_functions,
+            )
+            futures[future] = entry
+
+        for future in concurrent.futures.as_completed(futures):
+            entry = futures[future]
+            try:
+                entry["nr_notes"] = future.result()
+                print(f"{entry['input_midi_file']}: {entry['nr_notes']} notes rendered")
+            except Exception as e:
+                entry = {"input_midi_file": entry["input_midi_file"], "error": repr(e)}
+                print(f"{entry['input_midi_file']}: rendering failed, {e!r}")
+            manifest.append(entry)
+
+    manifest.sort(key=lambda entry: entry["input_midi_file"])
+    with open(manifest_file_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("input_midi_file", help="The input MIDI file")
-    parser.add_argument("output_midi_file", help="The output MIDI file")
+    parser.add_argument(
+        "input_midi_file",
+        help="The input MIDI file, or a corpus folder or glob pattern of MIDI files to render in parallel",
+    )
+    parser.add_argument(
+        "output_midi_file",
+        help="The output MIDI file, or the output folder of a corpus",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="The number of processes used for a corpus, by default the number of CPUs",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="The random seed of the humanization, from which the seed of each file of a corpus is derived, "
+        "by default 0 for a corpus and a random one for a file",
+    )
+    parser.add_argument(
+        "--variants",
+        type=int,
+        default=1,
+        help="The number of performances of the file, each one with its own humanization, written as "
+        "<output>_<variant>.mid",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Render the files of a corpus even if they are up to date",
+    )
+    pipeline = parser.add_mutually_exclusive_group()
+    pipeline.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(PIPELINE_STAGES),
+        default=DEFAULT_PIPELINE,
+        help="The stages of the pipeline, in order",
+    )
+    pipeline.add_argument(
+        "--pipeline", help="A JSON file listing the stages of the pipeline, in order"
+    )
+    parser.add_argument(
+        "--separation",
+        choices=HAND_SEPARATIONS,
+        default=None,
+        help="How the notes are separated into the hands, by default by instrument if there are two pitched "
+        "instruments and by pitch otherwise",
+    )
+    parser.add_argument(
+        "--humanization",
+        choices=HUMANIZATION_DISTRIBUTIONS,
+        default="uniform",
+        help="The distribution of the velocity and timing variations of the melody",
+    )
+    parser.add_argument(
+        "--velocity-variation",
+        type=int,
+        default=VELOCITY_VARIATION,
+        help="The scale of the velocity variations, the largest one for the uniform distribution",
+    )
+    parser.add_argument(
+        "--timing-variation",
+        type=float,
+        default=TIMING_VARIATION,
+        help="The scale of the shifts of the onsets in seconds, the largest one for the uniform distribution",
+    )
+    parser.add_argument(
+        "--multipliers",
+        help="A JSON file of the tempo multipliers of each beat of each time signature, as computed by "
+        "assignment_1/taskA.py, from which the learned variations are drawn",
+    )
+    parser.add_argument(
+        "--timing-function",
+        help="A JSON file of the tempo multipliers of each beat of each time signature, as saved by "
+        "assignment_1/taskA.py --output, with which the timing curve warps the times of the notes, appended to "
+        "the stages if it is not one of them",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="The number of threads running the consecutive stages working on different hands",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the duration and the number of notes touched by each stage",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Print the memory allocated by each stage too, running the stages one at a time",
+    )
     args = parser.parse_args()
 
     input_midi_file = args.input_midi_file
     output_midi_file = args.output_midi_file
+    stage_names = (
+        load_pipeline(args.pipeline) if args.pipeline is not None else args.stages
+    )
+    timing_functions = None
+    if args.timing_function is not None:
+        timing_functions = load_timing_functions(args.timing_function)
+        if "timing_curve" not in stage_names:
+            stage_names = list(stage_names) + ["timing_curve"]
+    if args.humanization == "learned" and args.multipliers is None:
+        parser.error("the learned humanization needs the --multipliers file")
+    humanizer = Humanizer(
+        args.humanization,
+        args.velocity_variation,
+        args.timing_variation,
+        (
+            load_learned_multipliers(args.multipliers)
+            if args.multipliers is not None
+            else None
+        ),
+    )
 
-    main(input_midi_file, output_midi_file)
+    if os.path.isdir(input_midi_file) or any(char in input_midi_file for char in "*?["):
+        render_corpus(
+            input_midi_file,
+            output_midi_file,
+            args.workers,
+            args.seed if args.seed is not None else 0,
+            args.force,
+            stage_names,
+            args.separation,
+            humanizer,
+            timing_functions,
+        )
+    else:
+        main(
+            input_midi_file,
+            output_midi_file,
+            stage_names,
+            args.threads,
+            args.profile,
+            args.trace_memory,
+            args.separation,
+            args.seed,
+            humanizer,
+            args.variants,
+            timing_functions,
+        )
@@ -1,7 +1,18 @@
 import music21
+import numpy as np
 import pretty_midi
 import argparse
+import collections
+import concurrent.futures
+import json
 import os
+import sys
+
+# The MIDI writer of the expressive performances, shared with the phrases
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "assignment_2")
+)
+from midi_writer import TempoMap, encode_track, get_channel, write_midi_file
 
 
 # Constants
@@ -11,378 +22,1104 @@ STANDARD_DURATION = (
 )
 VELOCITY_THRESHOLD = 0.5
 NR_NOTES_FOR_VELOCITY_CHECK = 5
-
-phrases = []  # list of list of notes composing each phrase
-key = None
-tonic_chord_pitches = []
-dominant_chord_pitches = []
-trills = []
-
-
-def get_next_notes(note_idx, notes):
-    """Return the indexes of the next notes that start after the current note.
+MIDI_EXTENSIONS = (".mid", ".midi")
+MANIFEST_FILENAME = "manifest.json"
+# "files" writes a MIDI file per phrase, "tracks" a MIDI file per piece with a track per phrase,
+# "npz" the note arrays of the piece with the offsets of the phrases
+EXPORT_FORMATS = ("files", "tracks", "npz")
+
+# Key profiles (major, minor) correlated with the pitch class distribution to find the key,
+# "aarden" are the Aarden-Essen weights used by default by music21's analyze("key")
+KEY_PROFILES = {
+    "aarden": (
+        [17.7661, 0.145624, 14.9265, 0.160186, 19.8049, 11.3587]
+        + [0.291248, 22.062, 0.145624, 8.15494, 0.232998, 4.95122],
+        [18.2648, 0.737619, 14.0499, 16.8599, 0.702494, 14.4362]
+        + [0.702494, 18.6161, 4.56621, 1.93186, 7.37619, 1.75623],
+    ),
+    "krumhansl": (
+        [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88],
+        [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17],
+    ),
+}
+# Spelling of the tonic of each pitch class, as chosen by music21
+MAJOR_TONIC_NAMES = ["C", "C#", "D", "E-", "E", "F", "F#", "G", "A-", "A", "B-", "B"]
+MINOR_TONIC_NAMES = ["C", "C#", "D", "E-", "E", "F", "F#", "G", "G#", "A", "B-", "B"]
+
+
+# Bit of each MIDI pitch in the pitch class mask of a chord. The pitches of the octave -1 are named
+# differently by pretty_midi once the octave is removed ("C-" for C-1), so they get their own bits
+PITCH_BITS = [1 << (pitch % 12 if pitch >= 12 else 12 + pitch) for pitch in range(128)]
+PITCH_NAMES = [pretty_midi.note_number_to_name(pitch)[:-1] for pitch in range(128)]
+
+
+class SegmentationContext:
+    """The state of the segmentation of one piece: its key, tonic and dominant chords, trills and phrases.
+    Each piece gets its own context, so several pieces can be segmented in the same process.
 
     Args:
-        note_idx: The index of the current note.
-        notes: The list of notes.
+        key: The music21 key of the piece.
     """
-    curr_note = notes[note_idx]
-    next_notes = []
-    next_note_found = False
 
-    curr_concurrent_notes = get_concurrent_notes_idx(curr_note, notes)
-
-    # There can be more than one note with the same start time since they can be played together
-    for next_node_idx in range(note_idx + 1, len(notes)):
-        if next_note_found:
-            break
-        if next_node_idx in curr_concurrent_notes:
-            continue
-        next_note_start = notes[next_node_idx].start
-        if next_note_start > curr_note.end:
-            next_note_found = True
-            next_notes.append(next_node_idx)
-    if len(next_notes) > 0:
-        next_concurrent_notes = get_concurrent_notes_idx(notes[next_notes[0]], notes)
-        next_notes.extend(next_concurrent_notes)
-        next_notes = list(set(next_notes))  # remove duplicates
-    return next_notes
+    def __init__(self, key):
+        self.key = key
+        self.tonic_chord_pitches = [
+            p.name for p in [key.tonic, key.pitchFromDegree(3), key.pitchFromDegree(5)]
+        ]
+        self.dominant_chord_pitches = [
+            p.name
+            for p in [
+                key.pitchFromDegree(5),
+                key.pitchFromDegree(7),
+                key.pitchFromDegree(2),
+                key.pitchFromDegree(4),
+            ]
+        ]
+        self.trills = set()  # indexes of the notes ending a trill
+        self.phrases = []  # list of list of notes composing each phrase
 
 
-def is_extended(note):
-    """Return True if the note is extended, False otherwise.
+def get_pitch_names_mask(pitch_names):
+    """Return the pitch class mask of the pitches whose name, without the octave, is one of the given names.
 
     Args:
-        note: The note to check.
+        pitch_names: The pitch names.
     """
-    note_duration = note.end - note.start
-    threshold = 0.05
-    return note_duration > STANDARD_DURATION + threshold
+    pitch_mask = 0
+    for pitch, pitch_name in enumerate(PITCH_NAMES):
+        if pitch_name in pitch_names:
+            pitch_mask |= PITCH_BITS[pitch]
+    return pitch_mask
 
 
-def sudden_velocity_change(curr_note_idx, next_notes_idx, notes):
-    """Return True if there is a sudden velocity change between the current note and the next notes, False otherwise.
+def split_phrases(notes, context):
+    """Split the notes into phrases. A phrase is a sequence of notes that ends with a silence, a sudden velocity change, a cadence, or a trill.
+    The phrases are added to the segmentation context and returned.
 
     Args:
-        curr_note_idx: The index of the current note.
-        next_notes_idx: The indexes of the next notes.
         notes: The list of notes.
+        context: The segmentation context of the piece.
     """
-    notes_currently_playing = get_notes_currently_playing(curr_note_idx, notes)
-    next_notes = [notes[note_idx] for note_idx in next_notes_idx]
-    curr_velocities = [[note.velocity for note in notes_currently_playing]]
-    next_velocities = [[note.velocity for note in next_notes]]
-
-    i = 0
-    velocity_check_cnt = 0
-    while velocity_check_cnt < NR_NOTES_FOR_VELOCITY_CHECK:
-        if curr_note_idx - i < 0:
-            break
-        prev_notes = get_notes_currently_playing(curr_note_idx - i, notes)
-        # if any of the previous notes is in the current notes, continue
-        if any([note in notes_currently_playing for note in prev_notes]):
-            i += 1
-            continue
+    phrase_slices = get_phrase_slices(
+        notes,
+        context.key.tonic,
+        context.tonic_chord_pitches,
+        context.dominant_chord_pitches,
+        context.trills,
+    )
+    for phrase_start, phrase_end in phrase_slices:
+        context.phrases.append(notes[phrase_start:phrase_end])
+    return context.phrases
 
-        curr_velocities.append([note.velocity for note in prev_notes])
-        i += 1
-        velocity_check_cnt += 1
 
-    i = 0
-    velocity_check_cnt = 0
-    next_notes_last_idx = max(next_notes_idx)
-    while velocity_check_cnt < NR_NOTES_FOR_VELOCITY_CHECK:
-        if next_notes_last_idx + i >= len(notes):
-            break
-        next_next_notes = get_notes_currently_playing(next_notes_last_idx + i, notes)
+def is_trill_duration(note):
+    """Return True if the note is shortened, False otherwise.
 
-        # if any of the next next notes is in the next notes, continue
-        if any([note in next_notes for note in next_next_notes]):
-            i += 1
-            continue
+    Args:
+        note: The note to check.
+    """
+    note_duration = note.end - note.start
+    return note_duration <= 0.05
 
-        next_velocities.append([note.velocity for note in next_next_notes])
-        i += 1
-        velocity_check_cnt += 1
 
-    # Get the avg velocity of the current and next notes of the subarrays and then the array
-    curr_velocities = [sum(subarray) / len(subarray) for subarray in curr_velocities]
-    next_velocities = [sum(subarray) / len(subarray) for subarray in next_velocities]
-    curr_velocity = sum(curr_velocities) // len(curr_velocities)
-    next_velocity = sum(next_velocities) // len(next_velocities)
+class TrillDetector:
+    """
+    Incremental trill detector over a stream of notes. Trills are composed of three notes of short duration,
+    followed by a 4th note which is extended. The notes are added one at a time, so the trills of a live
+    performance are found as soon as their last note is received, keeping only the last four notes.
+    """
 
-    return abs(curr_velocity - next_velocity) >= VELOCITY_THRESHOLD * (curr_velocity)
+    def __init__(self):
+        self.last_notes = collections.deque(maxlen=4)
+        self.nr_notes = 0
+        # the trills do not overlap, the next trill cannot start before this index
+        self.next_trill_start_idx = 0
+        self.trill_end_idx = set()
+
+    def add_note(self, note):
+        """Add the next note of the stream and return True if it is the last note of a trill, False otherwise.
+
+        Args:
+            note: The next note.
+        """
+        self.last_notes.append(note)
+        note_idx = self.nr_notes
+        self.nr_notes += 1
+
+        trill_start_idx = note_idx - 3
+        if trill_start_idx < self.next_trill_start_idx:
+            return False
+        first_note, second_note, third_note, _ = self.last_notes
+        if (
+            (
+                first_note.pitch == second_note.pitch
+                and first_note.pitch == third_note.pitch
+            )
+            and is_trill_duration(first_note)
+            and is_trill_duration(second_note)
+            and is_trill_duration(third_note)
+        ):
+            self.trill_end_idx.add(note_idx)
+            self.next_trill_start_idx = note_idx + 1
+            return True
+        return False
 
 
-def get_concurrent_notes_idx(curr_note, notes):
-    """Return the indexes of the notes that are played together with the current note.
+def identify_trill(notes):
+    """
+    Identify trills in the given list of notes. Trills are composed of three notes of short duration, followed by a 4th note which is extended.
+    Return the set of indexes of the notes ending a trill.
 
     Args:
-        curr_note: The current note.
         notes: The list of notes.
     """
-    concurrent_notes = []
-
-    for other_note_idx, other_note in enumerate(notes):
-        if other_note.pitch == curr_note.pitch:
-            continue
-        if other_note.start <= curr_note.end and other_note.end >= curr_note.start:
-            concurrent_notes.append(other_note_idx)
-        if other_note.start > curr_note.end:
-            break
-    return concurrent_notes
+    trill_detector = TrillDetector()
+    for note in notes:
+        trill_detector.add_note(note)
+    return trill_detector.trill_end_idx
 
 
-def get_notes_currently_playing(curr_note_idx, notes):
-    """Return the indexes of the notes that are currently playing with the current note.
+def get_note_arrays(notes):
+    """Return the start, end, pitch and velocity arrays of the notes.
 
     Args:
-        curr_note_idx: The index of the current note.
         notes: The list of notes.
     """
-    curr_note = notes[curr_note_idx]
-    concurrent_notes = get_concurrent_notes_idx(curr_note, notes)
-    notes_currently_playing = concurrent_notes.copy()
-    notes_currently_playing.append(curr_note_idx)
-    return [notes[note_idx] for note_idx in notes_currently_playing]
+    starts = np.array([note.start for note in notes], dtype=np.float64)
+    ends = np.array([note.end for note in notes], dtype=np.float64)
+    pitches = np.array([note.pitch for note in notes], dtype=np.int64)
+    velocities = np.array([note.velocity for note in notes], dtype=np.int64)
+    return starts, ends, pitches, velocities
 
 
-def is_tonic_chord(note_pitches):
-    """Return True if the note pitches are a tonic chord, False otherwise.
+def get_range_pairs(range_starts, range_stops):
+    """Return the (range, position) pairs of every position in every range, ordered by range then position.
 
     Args:
-        note_pitches: The pitches of the notes.
+        range_starts: The first position of every range.
+        range_stops: The position after the last one of every range, the range is empty if it is not after the first.
     """
-    global tonic_chord_pitches
+    range_sizes = np.maximum(range_stops - range_starts, 0)
+    ranges = np.repeat(np.arange(len(range_starts)), range_sizes)
+    positions = (
+        np.arange(len(ranges))
+        - np.repeat(np.cumsum(range_sizes) - range_sizes, range_sizes)
+    ) + np.repeat(range_starts, range_sizes)
+    return ranges, positions
 
-    return set(note_pitches).issubset(set(tonic_chord_pitches))
 
+def get_concurrent_notes_arrays(starts, ends, pitches):
+    """Return the concurrent notes of every note in compressed form: the notes of another pitch overlapping it,
+    before the first note of another pitch starting after it ends which follows all the notes starting before
+    it ends. The concurrent notes of note i are concurrent_idx[offsets[i] : offsets[i + 1]], in ascending order.
 
-def is_dominant_chord(note_pitches):
-    """Return True if the note pitches are a dominant chord, False otherwise.
+    The overlapping notes are found in the notes sorted by start: the notes starting during a note, and the notes
+    during which it starts. Only the overlapping pairs are built, so a long held note adds one pair per note it
+    overlaps, not the whole piece to the search of every note.
 
     Args:
-        note_pitches: The pitches of the notes.
+        starts: The start times of the notes.
+        ends: The end times of the notes.
+        pitches: The pitches of the notes.
     """
-    global dominant_chord_pitches
+    nr_notes = len(starts)
+    if nr_notes == 0:
+        return np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    start_order = np.argsort(starts, kind="stable")
+    sorted_starts = starts[start_order]
+    first_starting_idx = np.searchsorted(sorted_starts, starts, side="left")
+    first_starting_after_idx = np.searchsorted(sorted_starts, starts, side="right")
+    first_starting_after_end_idx = np.searchsorted(sorted_starts, ends, side="right")
+
+    # the notes starting during each note, from its start to its end
+    starting_owners, starting_positions = get_range_pairs(
+        first_starting_idx, first_starting_after_end_idx
+    )
+    # each note is playing when the notes starting after it and before its end start
+    playing_candidates, playing_positions = get_range_pairs(
+        first_starting_after_idx, first_starting_after_end_idx
+    )
+    owners = np.concatenate([starting_owners, start_order[playing_positions]])
+    candidates = np.concatenate([start_order[starting_positions], playing_candidates])
+
+    # the search for the concurrent notes stops at the first note starting after the end of the note and of the
+    # notes before it, unless it has the same pitch, then at the next note of another pitch starting after the end
+    stop_idx = np.searchsorted(np.maximum.accumulate(starts), ends, side="right")
+    late_same_pitch = stop_idx < nr_notes
+    late_same_pitch[late_same_pitch] = (
+        pitches[stop_idx[late_same_pitch]] == pitches[late_same_pitch]
+    )
+    for curr_note_idx in np.flatnonzero(late_same_pitch):
+        other_note_idx = stop_idx[curr_note_idx] + 1
+        while other_note_idx < nr_notes and (
+            pitches[other_note_idx] == pitches[curr_note_idx]
+            or starts[other_note_idx] <= ends[curr_note_idx]
+        ):
+            other_note_idx += 1
+        stop_idx[curr_note_idx] = other_note_idx
 
-    return set(note_pitches).issubset(set(dominant_chord_pitches))
+    is_concurrent = (
+        (pitches[candidates] != pitches[owners])
+        & (starts[candidates] <= ends[owners])
+        & (ends[candidates] >= starts[owners])
+        & (candidates < stop_idx[owners])
+    )
+    owners = owners[is_concurrent]
+    candidates = candidates[is_concurrent]
+    order = np.lexsort((candidates, owners))
 
+    offsets = np.zeros(nr_notes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(owners, minlength=nr_notes), out=offsets[1:])
+    return offsets, candidates[order]
 
-def is_octave(note_pitches):
-    """Return True if at least two notes with same pitch are the tonic, False otherwise.
+
+def get_next_note_arrays(starts, ends):
+    """Return for every note the index of the first following note that starts after it ends, or the number of
+    notes if there is none.
 
     Args:
-        note_pitches: The pitches of the notes.
+        starts: The start times of the notes.
+        ends: The end times of the notes.
     """
-    global key
+    nr_notes = len(starts)
+    next_idx = np.searchsorted(np.maximum.accumulate(starts), ends, side="right")
 
-    tonic_cnt = 0
-    if len(note_pitches) >= 2:
-        for pitch in note_pitches:
-            if str(pitch) == str(key.tonic):
-                tonic_cnt += 1
-    if tonic_cnt >= 2:
-        return True
-    return False
+    # an earlier note starts after the current note ends, fall back to a scan
+    for curr_note_idx in np.flatnonzero(next_idx <= np.arange(nr_notes)):
+        next_idx[curr_note_idx] = nr_notes
+        for next_note_idx in range(curr_note_idx + 1, nr_notes):
+            if starts[next_note_idx] > ends[curr_note_idx]:
+                next_idx[curr_note_idx] = next_note_idx
+                break
+    return next_idx
 
 
-def is_cadence(notes_currently_playing_idx, notes):
-    """Return True if the notes currently playing are a cadence, False otherwise.
+def reduce_groups(values, offsets, ufunc, empty_value):
+    """Reduce the values of every group of a compressed group layout with the given ufunc.
 
     Args:
-        notes_currently_playing_idx: The indexes of the notes currently playing.
-        notes: The list of notes.
+        values: The values of the group members.
+        offsets: The group offsets, group i is values[offsets[i] : offsets[i + 1]].
+        ufunc: The NumPy ufunc used for the reduction, e.g. np.maximum.
+        empty_value: The value of the empty groups.
     """
-    global tonic_chord_pitches, dominant_chord_pitches
+    nr_groups = len(offsets) - 1
+    reduced = np.full(nr_groups, empty_value, dtype=np.result_type(values, empty_value))
+    non_empty = offsets[1:] > offsets[:-1]
+    if np.any(non_empty):
+        reduced[non_empty] = ufunc.reduceat(values, offsets[:-1][non_empty])
+    return reduced
 
-    notes_currently_playing = [
-        notes[note_idx] for note_idx in notes_currently_playing_idx
-    ]
-    if len(notes_currently_playing) >= 3:
-        notes_currently_playing_pitches = [
-            pretty_midi.note_number_to_name(note.pitch)[:-1]
-            for note in notes_currently_playing
-        ]
 
-        if is_tonic_chord(notes_currently_playing_pitches) or is_octave(
-            notes_currently_playing_pitches
-        ):
-            if any([is_extended(n) for n in notes_currently_playing]):
-                first_note_idx = min(notes_currently_playing_idx)
-                # check if any previous chord is a dominant chord
-                for i in range(first_note_idx - 1, -1, -1):
-                    previous_notes = get_notes_currently_playing(i, notes)
-                    if len(previous_notes) < 3:
-                        continue
-                    previous_notes_pitches = [
-                        pretty_midi.note_number_to_name(n.pitch)[:-1]
-                        for n in previous_notes
-                    ]
-                    if is_dominant_chord(previous_notes_pitches):
-                        return True
-                    else:
-                        break
-
-        # elif is_dominant_chord(notes_currently_playing_pitches):
-        #     if any([is_extended(n) for n in notes_currently_playing]):
-        #         return True
-    return False
-
-
-def split_phrases(notes):
-    """Split the notes into phrases. A phrase is a sequence of notes that ends with a silence, a sudden velocity change, a cadence, or a trill.
+def get_silence_mask(
+    starts, ends, next_idx, offsets, concurrent_idx, last_concurrent_ends, first_idx=0
+):
+    """Return the mask of the notes followed by a silence of at least SILENCE_DURATION.
 
     Args:
-        notes: The list of notes.
+        starts: The start times of the notes.
+        ends: The end times of the notes.
+        next_idx: The index of the next note of every note, see get_next_note_arrays.
+        offsets: The offsets of the concurrent notes.
+        concurrent_idx: The concurrent notes of every note.
+        last_concurrent_ends: The end of the concurrent note of every note that ends last.
+        first_idx: The index in the piece of the first note, when the notes are a window of the piece.
     """
-    phrase_start = 0
-    already_processed = []
-    for curr_note_idx, curr_note in enumerate(notes):
-        if curr_note_idx in already_processed:
-            continue
-        concurrent_notes = get_concurrent_notes_idx(curr_note, notes)
-        next_notes = get_next_notes(curr_note_idx, notes)
-
-        # get the concurrent note that ends last
-        last_concurrent_note_idx = (
-            max(concurrent_notes, key=lambda note_idx: notes[note_idx].end)
-            if len(concurrent_notes) > 0
-            else curr_note_idx
+    nr_notes = len(starts)
+    has_next = next_idx < nr_notes
+    next_group_idx = next_idx[has_next]
+
+    # split_phrases measures the silence from the first note of list(set(next_notes)), so bound the
+    # silence with the earliest and latest start of the next notes and only resolve the ambiguous ones
+    concurrent_starts = starts[concurrent_idx]
+    min_next_start = np.minimum(
+        starts[next_group_idx],
+        reduce_groups(concurrent_starts, offsets, np.minimum, np.inf)[next_group_idx],
+    )
+    max_next_start = np.maximum(
+        starts[next_group_idx],
+        reduce_groups(concurrent_starts, offsets, np.maximum, -np.inf)[next_group_idx],
+    )
+    last_ends = last_concurrent_ends[has_next]
+    is_silence = min_next_start - last_ends >= SILENCE_DURATION
+    is_ambiguous = ~is_silence & (max_next_start - last_ends >= SILENCE_DURATION)
+    for position in np.flatnonzero(is_ambiguous):
+        next_note_idx = next_group_idx[position]
+        # the order of the set depends on the indexes, so they are taken in the piece
+        next_notes = [int(next_note_idx) + first_idx]
+        next_notes.extend(
+            (
+                concurrent_idx[offsets[next_note_idx] : offsets[next_note_idx + 1]]
+                + first_idx
+            ).tolist()
+        )
+        next_notes = list(set(next_notes))
+        is_silence[position] = (
+            starts[next_notes[0] - first_idx] - last_ends[position] >= SILENCE_DURATION
         )
-        last_concurrent_note = notes[last_concurrent_note_idx]
-        if curr_note.end > last_concurrent_note.end:
-            last_concurrent_note = curr_note
 
-        if len(next_notes) > 0:
-            next_note = notes[next_notes[0]]
-            notes_currently_playing_idx = concurrent_notes.copy()
-            notes_currently_playing_idx.append(curr_note_idx)
+    silence_mask = np.zeros(nr_notes, dtype=bool)
+    silence_mask[has_next] = is_silence
+    return silence_mask
 
-            is_there_sudden_velocity_change = sudden_velocity_change(
-                curr_note_idx, next_notes, notes
+
+def get_group_arrays(offsets, concurrent_idx):
+    """Return the notes currently playing with every note, i.e. its concurrent notes and the note itself, in
+    compressed form: the group of note i is group_idx[group_offsets[i] : group_offsets[i + 1]]. Also return the
+    sorted (note, group member) keys used to test the membership of a note in a group.
+
+    Args:
+        offsets: The offsets of the concurrent notes.
+        concurrent_idx: The concurrent notes of every note.
+    """
+    nr_notes = len(offsets) - 1
+    note_idx = np.arange(nr_notes)
+    owners = np.concatenate([np.repeat(note_idx, np.diff(offsets)), note_idx])
+    members = np.concatenate([concurrent_idx, note_idx])
+    order = np.argsort(owners, kind="stable")
+    owners = owners[order]
+    group_idx = members[order]
+
+    group_offsets = np.zeros(nr_notes + 1, dtype=np.int64)
+    np.cumsum(np.diff(offsets) + 1, out=group_offsets[1:])
+    group_keys = np.sort(owners * nr_notes + group_idx)
+    return group_offsets, group_idx, group_keys
+
+
+def get_disjoint_group_windows(
+    group_offsets, group_idx, group_keys, first_idx, step, disjoint_idx
+):
+    """Return for every group the NR_NOTES_FOR_VELOCITY_CHECK closest groups without common notes, whose
+    velocities are compared by get_velocity_change_mask. The groups are visited from first_idx in the direction
+    of step (-1 or 1) and a row is padded with -1 when the notes run out.
+
+    All the groups are visited in the same vectorized round. A group stops being visited once it has enough
+    neighbours or once its position reaches disjoint_idx, from where every following group is known to share
+    no note with it, so the rest of its window is filled in at once.
+
+    Args:
+        group_offsets: The offsets of the groups, see get_group_arrays.
+        group_idx: The members of the groups.
+        group_keys: The sorted (note, group member) keys.
+        first_idx: The position from which the neighbour groups of every group are visited.
+        step: The direction in which the neighbour groups are visited.
+        disjoint_idx: The position of every group from which all neighbour groups are disjoint from it.
+    """
+    nr_notes = len(group_offsets) - 1
+    windows = np.full((nr_notes, NR_NOTES_FOR_VELOCITY_CHECK), -1, dtype=np.int64)
+    nr_found = np.zeros(nr_notes, dtype=np.int64)
+    positions = np.asarray(first_idx, dtype=np.int64).copy()
+    active = np.arange(nr_notes)
+
+    while len(active) > 0:
+        active_positions = positions[active]
+        in_range = (active_positions >= 0) & (active_positions < nr_notes)
+        active = active[in_range]
+        active_positions = active_positions[in_range]
+
+        # from disjoint_idx on, the window is the next consecutive groups
+        is_disjoint_from_here = (active_positions - disjoint_idx[active]) * step >= 0
+        for k in range(NR_NOTES_FOR_VELOCITY_CHECK):
+            window_positions = active_positions + k * step
+            window_slots = nr_found[active] + k
+            can_fill = (
+                is_disjoint_from_here
+                & (window_slots < NR_NOTES_FOR_VELOCITY_CHECK)
+                & (window_positions >= 0)
+                & (window_positions < nr_notes)
             )
+            windows[active[can_fill], window_slots[can_fill]] = window_positions[
+                can_fill
+            ]
+        active = active[~is_disjoint_from_here]
+        active_positions = active_positions[~is_disjoint_from_here]
+        if len(active) == 0:
+            break
 
-            if (
-                next_note.start - last_concurrent_note.end >= SILENCE_DURATION
-                or is_there_sudden_velocity_change
-                or is_cadence(notes_currently_playing_idx, notes)
-                or is_trill(last_concurrent_note)
-            ):
-                already_processed.extend(concurrent_notes)
-                already_processed.append(curr_note_idx)
-
-                phrase = notes[phrase_start : last_concurrent_note_idx + 1]
-                phrases.append(phrase)
-                phrase_start = last_concurrent_note_idx + 1
-    # Add the last phrase
-    phrase = notes[phrase_start:]
-    phrases.append(phrase)
+        # test if the group at the current position shares a note with the group
+        group_sizes = (
+            group_offsets[active_positions + 1] - group_offsets[active_positions]
+        )
+        visited_owners = np.repeat(active, group_sizes)
+        visited_slots = np.arange(len(visited_owners)) - np.repeat(
+            np.cumsum(group_sizes) - group_sizes, group_sizes
+        )
+        visited_members = group_idx[
+            np.repeat(group_offsets[active_positions], group_sizes) + visited_slots
+        ]
+        visited_keys = visited_owners * nr_notes + visited_members
+        key_positions = np.minimum(
+            np.searchsorted(group_keys, visited_keys), len(group_keys) - 1
+        )
+        is_shared = group_keys[key_positions] == visited_keys
+        is_overlapping = np.logical_or.reduceat(
+            is_shared, np.cumsum(group_sizes) - group_sizes
+        )
+
+        is_disjoint = ~is_overlapping
+        windows[active[is_disjoint], nr_found[active[is_disjoint]]] = active_positions[
+            is_disjoint
+        ]
+        nr_found[active[is_disjoint]] += 1
+        positions[active] += step
+        active = active[nr_found[active] < NR_NOTES_FOR_VELOCITY_CHECK]
 
+    return windows
 
-def is_trill_duration(note):
-    """Return True if the note is shortened, False otherwise.
+
+def get_velocity_change_mask(velocities, next_idx, offsets, concurrent_idx):
+    """Return the mask of the notes followed by a sudden velocity change. The velocity before a note is the
+    average velocity of the notes currently playing with it and of the NR_NOTES_FOR_VELOCITY_CHECK closest
+    previous groups without common notes, the velocity after it the same average from its next notes on. The
+    change is sudden if it is at least VELOCITY_THRESHOLD times the velocity before the note.
+
+    The average velocity of the notes currently playing with each note is computed once. The average velocity
+    before a note and after its next notes is then the average of these group averages over a window of groups,
+    gathered through the window indexes and summed one window column at a time.
 
     Args:
-        note: The note to check.
+        velocities: The velocities of the notes.
+        next_idx: The index of the next note of every note, see get_next_note_arrays.
+        offsets: The offsets of the concurrent notes.
+        concurrent_idx: The concurrent notes of every note.
     """
-    note_duration = note.end - note.start
-    return note_duration <= 0.05
+    nr_notes = len(velocities)
+    if nr_notes == 0:
+        return np.zeros(0, dtype=bool)
+
+    group_offsets, group_idx, group_keys = get_group_arrays(offsets, concurrent_idx)
+    group_sizes = np.diff(group_offsets)
+    group_avg_velocities = (
+        reduce_groups(velocities[group_idx], group_offsets, np.add, 0) / group_sizes
+    )
+    group_first_idx = reduce_groups(group_idx, group_offsets, np.minimum, nr_notes)
+    group_last_idx = reduce_groups(group_idx, group_offsets, np.maximum, -1)
+
+    # groups whose notes all come before the first note of a group share no note with it, and conversely
+    left_disjoint_idx = (
+        np.searchsorted(np.maximum.accumulate(group_last_idx), group_first_idx) - 1
+    )
+    right_disjoint_idx = np.searchsorted(
+        np.minimum.accumulate(group_first_idx[::-1])[::-1],
+        group_last_idx,
+        side="right",
+    )
+    left_windows = get_disjoint_group_windows(
+        group_offsets,
+        group_idx,
+        group_keys,
+        np.arange(nr_notes),
+        -1,
+        left_disjoint_idx,
+    )
+    right_windows = get_disjoint_group_windows(
+        group_offsets, group_idx, group_keys, group_last_idx, 1, right_disjoint_idx
+    )
+
+    avg_velocities = []
+    for windows in (left_windows, right_windows):
+        # Add the group averages one window column at a time, so the sums match the ones of a Python sum
+        group_avg_velocity_sum = group_avg_velocities.copy()
+        nr_groups = np.ones(nr_notes, dtype=np.int64)
+        for window_column in windows.T:
+            in_window = window_column >= 0
+            group_avg_velocity_sum += np.where(
+                in_window, group_avg_velocities[window_column], 0.0
+            )
+            nr_groups += in_window
+        avg_velocities.append(group_avg_velocity_sum // nr_groups)
+    curr_avg_velocities, next_avg_velocities = avg_velocities
+
+    has_next = next_idx < nr_notes
+    curr_velocity = curr_avg_velocities[has_next]
+    next_velocity = next_avg_velocities[next_idx[has_next]]
+    velocity_change_mask = np.zeros(nr_notes, dtype=bool)
+    velocity_change_mask[has_next] = abs(
+        curr_velocity - next_velocity
+    ) >= VELOCITY_THRESHOLD * (curr_velocity)
+    return velocity_change_mask
+
+
+def get_cadence_mask(
+    starts,
+    ends,
+    pitches,
+    offsets,
+    concurrent_idx,
+    tonic,
+    tonic_chord_pitches,
+    dominant_chord_pitches,
+):
+    """Return the mask of the notes whose currently playing notes form a cadence: a tonic chord, or a chord with
+    the tonic twice, of at least three notes, one of them extended, whose closest previous chord of at least three
+    notes is a dominant chord.
 
+    Args:
+        starts: The start times of the notes.
+        ends: The end times of the notes.
+        pitches: The pitches of the notes.
+        offsets: The offsets of the concurrent notes.
+        concurrent_idx: The concurrent notes of every note.
+        tonic: The name of the tonic of the key.
+        tonic_chord_pitches: The pitch names of the tonic chord.
+        dominant_chord_pitches: The pitch names of the dominant chord.
+    """
+    nr_notes = len(starts)
+    note_idx = np.arange(nr_notes)
+    group_sizes = np.diff(offsets) + 1
+
+    # the chord of each note as the pitch class mask of the notes currently playing
+    pitch_bits = np.array(PITCH_BITS, dtype=np.int64)[pitches]
+    chord_masks = pitch_bits | reduce_groups(
+        pitch_bits[concurrent_idx], offsets, np.bitwise_or, 0
+    )
+    is_tonic_note = (pitch_bits & get_pitch_names_mask([str(tonic)])) != 0
+    nr_tonic_notes = is_tonic_note + reduce_groups(
+        is_tonic_note[concurrent_idx].astype(np.int64), offsets, np.add, 0
+    )
+    is_tonic_chord_group = (
+        chord_masks & ~get_pitch_names_mask(tonic_chord_pitches)
+    ) == 0
+    is_dominant_chord_group = (
+        chord_masks & ~get_pitch_names_mask(dominant_chord_pitches)
+    ) == 0
+    is_octave_group = nr_tonic_notes >= 2
+    is_extended_note = ends - starts > STANDARD_DURATION + 0.05
+    has_extended_note = is_extended_note | reduce_groups(
+        is_extended_note[concurrent_idx], offsets, np.logical_or, False
+    )
+
+    # the lookback stops at the closest previous group of at least three notes
+    first_group_idx = np.minimum(
+        reduce_groups(concurrent_idx, offsets, np.minimum, nr_notes), note_idx
+    )
+    large_group_idx = np.maximum.accumulate(np.where(group_sizes >= 3, note_idx, -1))
+    previous_large_group_idx = np.where(
+        first_group_idx > 0, large_group_idx[np.maximum(first_group_idx - 1, 0)], -1
+    )
+    is_previous_dominant_chord = (
+        previous_large_group_idx >= 0
+    ) & is_dominant_chord_group[np.maximum(previous_large_group_idx, 0)]
+
+    return (
+        (group_sizes >= 3)
+        & (is_tonic_chord_group | is_octave_group)
+        & has_extended_note
+        & is_previous_dominant_chord
+    )
+
+
+def get_trill_end_mask(starts, ends, pitches):
+    """Return the mask of the notes ending a trill, as identified by TrillDetector.
 
-def identify_trill(notes):
+    Args:
+        starts: The start times of the notes.
+        ends: The end times of the notes.
+        pitches: The pitches of the notes.
     """
-    Identify trills in the given list of notes. Trills are composed of three notes of short duration, followed by a 4th note which is extended.
+    nr_notes = len(starts)
+    trill_end_mask = np.zeros(nr_notes, dtype=bool)
+    if nr_notes < 4:
+        return trill_end_mask
+
+    is_trill_note = ends - starts <= 0.05
+    candidates = (
+        (pitches[:-3] == pitches[1:-2])
+        & (pitches[:-3] == pitches[2:-1])
+        & is_trill_note[:-3]
+        & is_trill_note[1:-2]
+        & is_trill_note[2:-1]
+    )
+    # the trills do not overlap, a candidate is skipped if it is part of the previous trill
+    next_allowed_idx = 0
+    for trill_start_idx in np.flatnonzero(candidates).tolist():
+        if trill_start_idx >= next_allowed_idx:
+            trill_end_mask[trill_start_idx + 3] = True
+            next_allowed_idx = trill_start_idx + 4
+    return trill_end_mask
+
+
+def get_boundary_arrays(
+    notes, tonic, tonic_chord_pitches, dominant_chord_pitches, trills=None, first_idx=0
+):
+    """Return the boolean mask of the notes meeting the silence, velocity change, cadence or trill criteria of
+    split_phrases, along with the concurrent notes arrays and the index of the last concurrent note of each note.
 
     Args:
         notes: The list of notes.
+        tonic: The name of the tonic of the key.
+        tonic_chord_pitches: The pitch names of the tonic chord.
+        dominant_chord_pitches: The pitch names of the dominant chord.
+        trills: The indexes of the notes ending a trill, detected from the notes if not given.
+        first_idx: The index in the piece of the first note, when the notes are a window of the piece.
     """
-    trills = []
-    i = 0
-    while i < len(notes) - 3:
-        if (
-            (
-                notes[i].pitch == notes[i + 1].pitch
-                and notes[i].pitch == notes[i + 2].pitch
-            )
-            and is_trill_duration(notes[i])
-            and is_trill_duration(notes[i + 1])
-            and is_trill_duration(notes[i + 2])
-        ):
-            trills.append((notes[i], notes[i + 1], notes[i + 2], notes[i + 3]))
-            i += 4
-        else:
-            i += 1
+    starts, ends, pitches, velocities = get_note_arrays(notes)
+    nr_notes = len(starts)
+    note_idx = np.arange(nr_notes)
+
+    offsets, concurrent_idx = get_concurrent_notes_arrays(starts, ends, pitches)
+    next_idx = get_next_note_arrays(starts, ends)
+
+    # the concurrent note that ends last, the first one in case of ties
+    concurrent_ends = ends[concurrent_idx]
+    max_concurrent_ends = reduce_groups(concurrent_ends, offsets, np.maximum, -np.inf)
+    is_last_concurrent = concurrent_ends == np.repeat(
+        max_concurrent_ends, np.diff(offsets)
+    )
+    last_concurrent_idx = reduce_groups(
+        np.where(is_last_concurrent, concurrent_idx, nr_notes),
+        offsets,
+        np.minimum,
+        nr_notes,
+    )
+    last_concurrent_idx = np.where(np.diff(offsets) > 0, last_concurrent_idx, note_idx)
+    # the current note is used if it ends after the last concurrent note
+    last_concurrent_note_idx = np.where(
+        ends > ends[last_concurrent_idx], note_idx, last_concurrent_idx
+    )
+    last_concurrent_ends = ends[last_concurrent_note_idx]
+
+    if trills is None:
+        trill_end_mask = get_trill_end_mask(starts, ends, pitches)
+    else:
+        trill_end_mask = np.zeros(nr_notes, dtype=bool)
+        trill_end_mask[list(trills)] = True
+
+    boundary_mask = (next_idx < nr_notes) & (
+        get_silence_mask(
+            starts,
+            ends,
+            next_idx,
+            offsets,
+            concurrent_idx,
+            last_concurrent_ends,
+            first_idx,
+        )
+        | get_velocity_change_mask(velocities, next_idx, offsets, concurrent_idx)
+        | get_cadence_mask(
+            starts,
+            ends,
+            pitches,
+            offsets,
+            concurrent_idx,
+            tonic,
+            tonic_chord_pitches,
+            dominant_chord_pitches,
+        )
+        | trill_end_mask[last_concurrent_note_idx]
+    )
+    return boundary_mask, offsets, concurrent_idx, last_concurrent_idx
 
-    return trills
 
+def get_phrase_slices(
+    notes, tonic, tonic_chord_pitches, dominant_chord_pitches, trills=None
+):
+    """Return the (start, stop) index slices of the phrases of the notes, computing the silence, velocity change,
+    cadence and trill criteria of split_phrases as boolean masks over all the notes at once.
 
-def is_trill(note):
+    Args:
+        notes: The list of notes.
+        tonic: The name of the tonic of the key.
+        tonic_chord_pitches: The pitch names of the tonic chord.
+        dominant_chord_pitches: The pitch names of the dominant chord.
+        trills: The indexes of the notes ending a trill, detected from the notes if not given.
     """
-    Return True if the note is the last note of a trill, False otherwise.
+    boundary_mask, offsets, concurrent_idx, last_concurrent_idx = get_boundary_arrays(
+        notes, tonic, tonic_chord_pitches, dominant_chord_pitches, trills
+    )
+
+    # The notes concurrent with a boundary cannot end a phrase themselves
+    phrase_slices = []
+    phrase_start = 0
+    already_processed = set()
+    for curr_note_idx in np.flatnonzero(boundary_mask).tolist():
+        if curr_note_idx in already_processed:
+            continue
+        already_processed.update(
+            concurrent_idx[offsets[curr_note_idx] : offsets[curr_note_idx + 1]].tolist()
+        )
+        already_processed.add(curr_note_idx)
+
+        phrase_end = int(last_concurrent_idx[curr_note_idx]) + 1
+        phrase_slices.append((phrase_start, phrase_end))
+        phrase_start = phrase_end
+    # Add the last phrase
+    phrase_slices.append((phrase_start, len(notes)))
+    return phrase_slices
+
+
+def get_pitch_class_distribution(notes):
+    """Return the total duration of the notes of each pitch class.
 
     Args:
-        note: The note to check.
+        notes: The list of notes.
     """
-    for trill in trills:
-        if note == trill[-1]:
-            return True
-    return False
+    starts, ends, pitches, _ = get_note_arrays(notes)
+    return np.bincount(pitches % 12, weights=ends - starts, minlength=12)
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("input_midi_file", help="The input MIDI file")
-    parser.add_argument("output_folder", help="The output phrases folder")
-    args = parser.parse_args()
+def estimate_key(notes, profile="aarden"):
+    """Estimate the key of the notes by correlating their pitch class distribution, weighted by duration, with
+    the major and minor key profiles rotated to each tonic. Return the music21 key with the highest correlation.
+
+    Args:
+        notes: The list of notes.
+        profile: The name of the key profiles, see KEY_PROFILES.
+    """
+    distribution = get_pitch_class_distribution(notes)
+    distribution = distribution - distribution.mean()
+
+    best_key = None
+    for mode, weights, tonic_names in zip(
+        ("major", "minor"),
+        KEY_PROFILES[profile],
+        (MAJOR_TONIC_NAMES, MINOR_TONIC_NAMES),
+    ):
+        # row i is the profile of the key whose tonic has pitch class i
+        profiles = np.array([np.roll(weights, tonic) for tonic in range(12)])
+        profiles = profiles - profiles.mean(axis=1, keepdims=True)
+        norms = np.sqrt(np.sum(profiles**2, axis=1) * np.sum(distribution**2))
+        correlations = np.divide(
+            profiles @ distribution,
+            norms,
+            out=np.zeros(12),
+            where=norms > 0,
+        )
+        for tonic in range(12):
+            candidate = (correlations[tonic], tonic_names[tonic], mode)
+            if best_key is None or candidate > best_key:
+                best_key = candidate
 
-    input_midi_file = args.input_midi_file
-    output_folder = args.output_folder
-    filename = input_midi_file.split("/")[-1].split(".")[0]
+    _, tonic_name, mode = best_key
+    return music21.key.Key(tonic_name, mode)
 
-    # create the output folder if it does not exist
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
 
+def segment_piece(input_midi_file, use_music21_key=False):
+    """Segment the performed MIDI file into phrases and return its segmentation context.
+
+    Args:
+        input_midi_file: The input MIDI file.
+        use_music21_key: Whether to parse the file with music21 to analyze the key instead of estimating it
+            from the loaded notes.
+    """
     # Load the input MIDI file representing the unperformed version
     piano = pretty_midi.PrettyMIDI(input_midi_file)
 
     piano_instrument = list(piano.instruments)[0]
 
     # Identify the key of the piece and the tonic and dominant chords
-    score = music21.converter.parse(input_midi_file)
-    key = score.analyze("key")
+    if use_music21_key:
+        score = music21.converter.parse(input_midi_file)
+        context = SegmentationContext(score.analyze("key"))
+    else:
+        context = SegmentationContext(
+            estimate_key(
+                [note for instrument in piano.instruments for note in instrument.notes]
+            )
+        )
+
+    context.trills = identify_trill(piano_instrument.notes)
 
-    tonic_chord_pitches = [key.tonic, key.pitchFromDegree(3), key.pitchFromDegree(5)]
-    tonic_chord_pitches = [p.name for p in tonic_chord_pitches]
+    split_phrases(piano_instrument.notes, context)
+    return context
 
-    dominant_chord_pitches = [
-        key.pitchFromDegree(5),
-        key.pitchFromDegree(7),
-        key.pitchFromDegree(2),
-        key.pitchFromDegree(4),
+
+def get_phrase_note_arrays(phrases):
+    """Return the start, end, pitch and velocity arrays of the notes of each phrase, as views of the arrays of the
+    notes of all the phrases.
+
+    Args:
+        phrases: The list of phrases.
+    """
+    note_arrays = get_note_arrays([note for phrase in phrases for note in phrase])
+    phrase_offsets = np.zeros(len(phrases) + 1, dtype=np.int64)
+    np.cumsum([len(phrase) for phrase in phrases], out=phrase_offsets[1:])
+    return [
+        [note_array[phrase_start:phrase_end] for note_array in note_arrays]
+        for phrase_start, phrase_end in zip(phrase_offsets[:-1], phrase_offsets[1:])
     ]
-    dominant_chord_pitches = [p.name for p in dominant_chord_pitches]
 
-    trills = identify_trill(piano_instrument.notes)
 
-    split_phrases(piano_instrument.notes)
+def write_phrase_tracks(phrases, output_folder, filename, tempo_map):
+    """Write all the phrases into a single MIDI file, with a track per phrase and a text event marking the start
+    of each phrase, and return the name of the file.
 
-    avg_beat_length = 0
+    Args:
+        phrases: The list of phrases.
+        output_folder: The output phrases folder.
+        filename: The name of the piece, used as prefix of the file.
+        tempo_map: The tempo map of the written MIDI files, see midi_writer.TempoMap.
+    """
+    tracks = []
+    text_events = []
+    for i, (phrase, note_arrays) in enumerate(
+        zip(phrases, get_phrase_note_arrays(phrases))
+    ):
+        if len(phrase) == 0:
+            continue
+        tracks.append(
+            encode_track(
+                tempo_map,
+                get_channel(len(tracks), False),
+                0,
+                *note_arrays,
+                name=f"Phrase {i}",
+            )
+        )
+        text_events.append(pretty_midi.Text(f"Phrase {i}", phrase[0].start))
+    phrases_file = f"{filename}_phrases.mid"
+    write_midi_file(f"{output_folder}/{phrases_file}", tempo_map, tracks, text_events)
+    return phrases_file
+
+
+def write_phrase_arrays(phrases, output_folder, filename):
+    """Write the start, end, pitch and velocity arrays of the notes of all the phrases into a single NPZ file,
+    along with the offsets of the phrases, and return the name of the file. The notes of phrase i are the notes
+    phrase_offsets[i] to phrase_offsets[i + 1].
+
+    Args:
+        phrases: The list of phrases.
+        output_folder: The output phrases folder.
+        filename: The name of the piece, used as prefix of the file.
+    """
+    starts, ends, pitches, velocities = get_note_arrays(
+        [note for phrase in phrases for note in phrase]
+    )
+    phrase_offsets = np.zeros(len(phrases) + 1, dtype=np.int64)
+    np.cumsum([len(phrase) for phrase in phrases], out=phrase_offsets[1:])
+    phrases_file = f"{filename}_phrases.npz"
+    np.savez(
+        f"{output_folder}/{phrases_file}",
+        starts=starts,
+        ends=ends,
+        pitches=pitches,
+        velocities=velocities,
+        phrase_offsets=phrase_offsets,
+    )
+    return phrases_file
+
+
+def load_phrases(phrases_file):
+    """Load the phrases written in a single file by write_phrase_tracks or write_phrase_arrays and return the
+    list of phrases.
+
+    Args:
+        phrases_file: The MIDI or NPZ file of the phrases of a piece.
+    """
+    if not phrases_file.endswith(".npz"):
+        phrases_midi = pretty_midi.PrettyMIDI(phrases_file)
+        return [instrument.notes for instrument in phrases_midi.instruments]
+
+    with np.load(phrases_file) as phrase_arrays:
+        notes = [
+            pretty_midi.Note(velocity, pitch, start, end)
+            for start, end, pitch, velocity in zip(
+                phrase_arrays["starts"].tolist(),
+                phrase_arrays["ends"].tolist(),
+                phrase_arrays["pitches"].tolist(),
+                phrase_arrays["velocities"].tolist(),
+            )
+        ]
+        phrase_offsets = phrase_arrays["phrase_offsets"].tolist()
+    return [
+        notes[phrase_start:phrase_end]
+        for phrase_start, phrase_end in zip(phrase_offsets[:-1], phrase_offsets[1:])
+    ]
 
-    # Create a midi file for each phrase
+
+def write_phrases(
+    phrases, output_folder, filename, verbose=True, export_format="files"
+):
+    """Write the phrases in the given export format and return the list of written phrases. The empty phrases
+    are not written.
+
+    Args:
+        phrases: The list of phrases.
+        output_folder: The output phrases folder.
+        filename: The name of the piece, used as prefix of the phrase files.
+        verbose: Whether to print each saved phrase.
+        export_format: One of EXPORT_FORMATS.
+    """
+    # The phrases are written with the default tempo map of pretty_midi, loaded once
+    tempo_map = TempoMap(pretty_midi.PrettyMIDI())
+    if export_format == "tracks":
+        phrases_file = write_phrase_tracks(phrases, output_folder, filename, tempo_map)
+    elif export_format == "npz":
+        phrases_file = write_phrase_arrays(phrases, output_folder, filename)
+    elif export_format != "files":
+        raise ValueError(f"Unknown export format: {export_format}")
+
+    phrase_note_arrays = None
+    if export_format == "files":
+        phrase_note_arrays = get_phrase_note_arrays(phrases)
+
+    written_phrases = []
     for i, phrase in enumerate(phrases):
-        phrase_midi = pretty_midi.PrettyMIDI()
-        phrase_instrument = pretty_midi.Instrument(program=0)
-        phrase_instrument.notes = phrase
-        phrase_midi.instruments.append(phrase_instrument)
+        # a boundary can end the phrase where the previous one ended, leaving it empty
+        if len(phrase) == 0:
+            continue
         beat_start = int(phrase[0].start)
         beat_end = int(phrase[-1].end)
-        avg_beat_length += beat_end - beat_start
-        phrase_midi.write(
-            f"{output_folder}/{filename}_phrase_{i}_start_{beat_start}_end_{beat_end}.mid"
+        if export_format == "files":
+            phrase_file = f"{filename}_phrase_{i}_start_{beat_start}_end_{beat_end}.mid"
+            write_midi_file(
+                f"{output_folder}/{phrase_file}",
+                tempo_map,
+                [
+                    encode_track(
+                        tempo_map, get_channel(0, False), 0, *phrase_note_arrays[i]
+                    )
+                ],
+            )
+        else:
+            phrase_file = phrases_file
+        written_phrases.append(
+            {
+                "file": phrase_file,
+                "beat_start": beat_start,
+                "beat_end": beat_end,
+                "nr_notes": len(phrase),
+            }
         )
-        print(f"Phrase {i} saved, beat start: {beat_start}, beat end: {beat_end}")
+        if verbose:
+            print(f"Phrase {i} saved, beat start: {beat_start}, beat end: {beat_end}")
+    return written_phrases
+
+
+def segment_file(
+    input_midi_file,
+    output_folder,
+    verbose=True,
+    use_music21_key=False,
+    export_format="files",
+):
+    """Segment the performed MIDI file, write its phrases into the output folder and return its manifest entry.
+
+    Args:
+        input_midi_file: The input MIDI file.
+        output_folder: The output phrases folder.
+        verbose: Whether to print each saved phrase.
+        use_music21_key: Whether to analyze the key with music21, see segment_piece.
+        export_format: The format of the written phrases, see write_phrases.
+    """
+    filename = os.path.basename(input_midi_file).split(".")[0]
+
+    # create the output folder if it does not exist
+    os.makedirs(output_folder, exist_ok=True)
+
+    context = segment_piece(input_midi_file, use_music21_key)
+    written_phrases = write_phrases(
+        context.phrases, output_folder, filename, verbose, export_format
+    )
+
+    avg_beat_length = sum(
+        phrase["beat_end"] - phrase["beat_start"] for phrase in written_phrases
+    ) / len(written_phrases)
+    if verbose:
+        print(f"Average beat length: {avg_beat_length}")
+
+    return {
+        "input_midi_file": input_midi_file,
+        "key": str(context.key),
+        "nr_notes": sum(phrase["nr_notes"] for phrase in written_phrases),
+        "nr_phrases": len(written_phrases),
+        "avg_beat_length": avg_beat_length,
+        "phrases": written_phrases,
+    }
+
+
+def segment_corpus(
+    input_folder,
+    output_folder,
+    nr_workers=None,
+    use_music21_key=False,
+    export_format="files",
+):
+    """Segment every MIDI file of the input folder in a pool of processes, write their phrases into the
+    output folder and a manifest summarizing the segmentation of each file.
+
+    Args:
+        input_folder: The folder containing the performed MIDI files.
+        output_folder: The output phrases folder.
+        nr_workers: The number of processes, by default the number of CPUs.
+        use_music21_key: Whether to analyze the keys with music21, see segment_piece.
+        export_format: The format of the written phrases, see write_phrases.
+    """
+    input_midi_files = sorted(
+        os.path.join(input_folder, file)
+        for file in os.listdir(input_folder)
+        if file.lower().endswith(MIDI_EXTENSIONS)
+    )
+    os.makedirs(output_folder, exist_ok=True)
+
+    manifest = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nr_workers) as executor:
+        futures = {
+            executor.submit(
+                segment_file,
+                input_midi_file,
+                output_folder,
+                False,
+                use_music21_key,
+                export_format,
+            ): input_midi_file
+            for input_midi_file in input_midi_files
+        }
+        for future in concurrent.futures.as_completed(futures):
+            input_midi_file = futures[future]
+            try:
+                entry = future.result()
+                print(f"{input_midi_file}: {entry['nr_phrases']} phrases saved")
+            except Exception as e:
+                entry = {"input_midi_file": input_midi_file, "error": repr(e)}
+                print(f"{input_midi_file}: segmentation failed, {e!r}")
+            manifest.append(entry)
+
+    manifest.sort(key=lambda entry: entry["input_midi_file"])
+    with open(os.path.join(output_folder, MANIFEST_FILENAME), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "input_midi_file",
+        help="The input MIDI file, or a folder of MIDI files to segment in parallel",
+    )
+    parser.add_argument("output_folder", help="The output phrases folder")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="The number of processes used for a folder, by default the number of CPUs",
+    )
+    parser.add_argument(
+        "--music21-key",
+        action="store_true",
+        help="Analyze the key by parsing the file with music21 instead of estimating it from the notes",
+    )
+    parser.add_argument(
+        "--format",
+        choices=EXPORT_FORMATS,
+        default="files",
+        help="Write a MIDI file per phrase, a MIDI file per piece with a track per phrase, or an NPZ file per piece",
+    )
+    args = parser.parse_args()
 
-    avg_beat_length = avg_beat_length / len(phrases)
-    print(f"Average beat length: {avg_beat_length}")
+    if os.path.isdir(args.input_midi_file):
+        segment_corpus(
+            args.input_midi_file,
+            args.output_folder,
+            args.workers,
+            args.music21_key,
+            args.format,
+        )
+    else:
+        segment_file(
+            args.input_midi_file,
+            args.output_folder,
+            use_music21_key=args.music21_key,
+            export_format=args.format,
+        )
@@ -0,0 +1,347 @@
+import mido
+import music21
+import numpy as np
+import pretty_midi
+import argparse
+import collections
+import json
+import time
+
+from phrase_segmentation import (
+    SegmentationContext,
+    TrillDetector,
+    estimate_key,
+    get_boundary_arrays,
+)
+
+
+# Constants
+# The notes received after a note before deciding if it ends a phrase, which bounds the latency
+LOOKAHEAD_NOTES = 32
+# The decided notes kept as context for the velocity and cadence criteria, which bounds the memory
+HISTORY_NOTES = 64
+HOP_NOTES = 16  # the notes received between two segmentations of the buffer
+KEY_ESTIMATION_NOTES = 256  # the notes buffered to estimate the key if not given
+
+PhraseBoundary = collections.namedtuple(
+    "PhraseBoundary",
+    ["phrase_idx", "start_idx", "end_idx", "start_time", "end_time", "emit_time"],
+)
+
+
+def read_file_events(midi_file, realtime=False):
+    """Yield the (time, message) events of the MIDI file in time order, the time being in seconds from the start.
+
+    Args:
+        midi_file: The MIDI file to replay.
+        realtime: Whether to wait for the time of each event, as if the file was played live.
+    """
+    midi = mido.MidiFile(midi_file)
+    # The times are converted from ticks by pretty_midi, so the notes are the same as the notes of the loaded file
+    tick_to_time = pretty_midi.PrettyMIDI(midi_file).tick_to_time
+    start_time = time.perf_counter()
+    tick = 0
+    for message in mido.merge_tracks(midi.tracks):
+        tick += message.time
+        current_time = float(tick_to_time(tick))
+        if realtime:
+            time.sleep(max(0.0, current_time - (time.perf_counter() - start_time)))
+        yield current_time, message
+
+
+def read_port_events(port_name=None):
+    """Yield the (time, message) events received on the MIDI input port, the time being in seconds from the start.
+
+    Args:
+        port_name: The name of the MIDI input port, the default port if not given.
+    """
+    with mido.open_input(port_name) as port:
+        start_time = time.perf_counter()
+        for message in port:
+            yield time.perf_counter() - start_time, message
+
+
+def get_stream_notes(events):
+    """Yield the notes of the stream of (time, message) events, each note being yielded when it ends.
+    The notes are matched as by pretty_midi, so they come in the same order as the notes of a loaded file.
+
+    Args:
+        events: The (time, message) events, in time order.
+    """
+    # (start, velocity) of the notes turned on for each (channel, pitch)
+    open_notes = {}
+    for current_time, message in events:
+        if message.type == "note_on" and message.velocity > 0:
+            open_notes.setdefault((message.channel, message.note), []).append(
+                (current_time, message.velocity)
+            )
+        elif message.type in ("note_on", "note_off"):
+            key = (message.channel, message.note)
+            if key not in open_notes:
+                continue
+            # a note on at the same time as the note off continues
+            notes_to_close = [
+                (start, velocity)
+                for start, velocity in open_notes[key]
+                if start != current_time
+            ]
+            notes_to_keep = [
+                (start, velocity)
+                for start, velocity in open_notes[key]
+                if start == current_time
+            ]
+            for start, velocity in notes_to_close:
+                yield pretty_midi.Note(velocity, message.note, start, current_time)
+            if len(notes_to_close) > 0 and len(notes_to_keep) > 0:
+                open_notes[key] = notes_to_keep
+            else:
+                del open_notes[key]
+
+
+class StreamingSegmenter:
+    """
+    Phrase segmentation of a stream of notes, using the criteria of phrase_segmentation over a sliding buffer.
+    A note is decided once the lookahead notes following it are received, and only the history notes before the
+    first undecided note are kept, so the latency and the memory are bounded whatever the length of the stream.
+    The phrases are emitted as PhraseBoundary tuples with the indexes of their first and past the last note.
+
+    Args:
+        key: The music21 key of the piece, estimated from the first notes if not given.
+        lookahead: The number of notes received after a note before deciding if it ends a phrase.
+        history: The number of decided notes kept as context.
+        hop: The number of notes received between two segmentations of the buffer.
+    """
+
+    def __init__(
+        self,
+        key=None,
+        lookahead=LOOKAHEAD_NOTES,
+        history=HISTORY_NOTES,
+        hop=HOP_NOTES,
+    ):
+        self.context = SegmentationContext(key) if key is not None else None
+        self.lookahead = lookahead
+        self.history = history
+        self.hop = hop
+        self.notes = []  # the buffered notes
+        self.buffer_start_idx = 0  # index in the stream of the first buffered note
+        self.nr_notes = 0  # number of notes received
+        self.decided_idx = 0  # index of the first note not decided yet
+        self.already_processed = set()  # undecided notes concurrent with a boundary
+        self.trill_detector = TrillDetector()
+        self.phrase_start_idx = 0
+        self.phrase_start_time = None
+        self.nr_phrases = 0
+
+    def add_note(self, note):
+        """Add the next note of the stream and return the list of phrases ended by the notes decided.
+
+        Args:
+            note: The next note, the notes being received in the order of their end.
+        """
+        self.notes.append(note)
+        self.nr_notes += 1
+        self.trill_detector.add_note(note)
+        if self.phrase_start_time is None and self.phrase_start_idx < self.nr_notes:
+            self.phrase_start_time = self.get_note(self.phrase_start_idx).start
+
+        if self.context is None:
+            if self.nr_notes < KEY_ESTIMATION_NOTES:
+                return []
+            self.context = SegmentationContext(estimate_key(self.notes))
+        if self.nr_notes - self.lookahead - self.decided_idx < self.hop:
+            return []
+        return self.segment_buffer(self.nr_notes - self.lookahead)
+
+    def finish(self):
+        """Decide the remaining notes at the end of the stream and return the list of the last phrases."""
+        if self.nr_notes == 0:
+            return []
+        if self.context is None:
+            self.context = SegmentationContext(estimate_key(self.notes))
+        phrases = self.segment_buffer(self.nr_notes)
+        if self.phrase_start_idx < self.nr_notes:
+            phrases.append(self.end_phrase(self.nr_notes))
+        return phrases
+
+    def get_note(self, note_idx):
+        """Return the buffered note with the given index in the stream.
+
+        Args:
+            note_idx: The index of the note in the stream.
+        """
+        return self.notes[note_idx - self.buffer_start_idx]
+
+    def end_phrase(self, phrase_end_idx):
+        """End the current phrase before the given note and return its boundary.
+
+        Args:
+            phrase_end_idx: The index past the last note of the phrase, after its first note.
+        """
+        last_note = self.get_note(phrase_end_idx - 1)
+        boundary = PhraseBoundary(
+            self.nr_phrases,
+            self.phrase_start_idx,
+            phrase_end_idx,
+            self.phrase_start_time,
+            last_note.end,
+            self.notes[-1].end,
+        )
+        self.nr_phrases += 1
+        self.phrase_start_idx = phrase_end_idx
+        self.phrase_start_time = None
+        if phrase_end_idx < self.nr_notes:
+            self.phrase_start_time = self.get_note(phrase_end_idx).start
+        return boundary
+
+    def segment_buffer(self, decided_idx):
+        """Segment the buffered notes, decide the notes before the given index and return the list of phrases
+        they end. The notes which are no longer needed are then removed from the buffer.
+
+        Args:
+            decided_idx: The index of the first note left undecided.
+        """
+        trills = {
+            note_idx - self.buffer_start_idx
+            for note_idx in self.trill_detector.trill_end_idx
+        }
+        (
+            boundary_mask,
+            offsets,
+            concurrent_idx,
+            last_concurrent_idx,
+        ) = get_boundary_arrays(
+            self.notes,
+            self.context.key.tonic,
+            self.context.tonic_chord_pitches,
+            self.context.dominant_chord_pitches,
+            trills,
+            self.buffer_start_idx,
+        )
+
+        # The notes concurrent with a boundary cannot end a phrase themselves
+        phrases = []
+        start = self.decided_idx - self.buffer_start_idx
+        stop = decided_idx - self.buffer_start_idx
+        for curr_note_idx in (
+            np.flatnonzero(boundary_mask[start:stop]) + start
+        ).tolist():
+            if curr_note_idx + self.buffer_start_idx in self.already_processed:
+                continue
+            self.already_processed.update(
+                (
+                    concurrent_idx[offsets[curr_note_idx] : offsets[curr_note_idx + 1]]
+                    + self.buffer_start_idx
+                ).tolist()
+            )
+            phrase_end_idx = (
+                int(last_concurrent_idx[curr_note_idx]) + 1 + self.buffer_start_idx
+            )
+            # a boundary can fall before the end of the previous phrase, leaving no note to the phrase
+            if phrase_end_idx > self.phrase_start_idx:
+                phrases.append(self.end_phrase(phrase_end_idx))
+        self.decided_idx = decided_idx
+
+        # Drop the notes before the history, and the state of the notes already decided
+        buffer_start_idx = max(self.buffer_start_idx, decided_idx - self.history)
+        del self.notes[: buffer_start_idx - self.buffer_start_idx]
+        self.buffer_start_idx = buffer_start_idx
+        self.already_processed = {
+            note_idx for note_idx in self.already_processed if note_idx >= decided_idx
+        }
+        self.trill_detector.trill_end_idx = {
+            note_idx
+            for note_idx in self.trill_detector.trill_end_idx
+            if note_idx >= buffer_start_idx
+        }
+        return phrases
+
+
+def segment_stream(
+    events, key=None, lookahead=LOOKAHEAD_NOTES, history=HISTORY_NOTES, hop=HOP_NOTES
+):
+    """Segment the stream of (time, message) events into phrases, yielding each phrase boundary when it is decided.
+
+    Args:
+        events: The (time, message) events, in time order.
+        key: The music21 key of the piece, estimated from the first notes if not given.
+        lookahead: The number of notes received after a note before deciding if it ends a phrase.
+        history: The number of decided notes kept as context.
+        hop: The number of notes received between two segmentations of the buffer.
+    """
+    segmenter = StreamingSegmenter(key, lookahead, history, hop)
+    try:
+        for note in get_stream_notes(events):
+            yield from segmenter.add_note(note)
+    except KeyboardInterrupt:
+        # the stream of a port ends when the performer stops it
+        pass
+    yield from segmenter.finish()
+
+
+def print_phrase(phrase):
+    """Print the phrase boundary as a JSON line.
+
+    Args:
+        phrase: The phrase boundary.
+    """
+    print(
+        json.dumps(
+            {
+                "phrase": phrase.phrase_idx,
+                "start_time": round(phrase.start_time, 3),
+                "end_time": round(phrase.end_time, 3),
+                "nr_notes": phrase.end_idx - phrase.start_idx,
+                "latency": round(phrase.emit_time - phrase.end_time, 3),
+            }
+        ),
+        flush=True,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--file", help="The MIDI file to replay as a stream")
+    source.add_argument(
+        "--port",
+        nargs="?",
+        const="",
+        help="The MIDI input port to listen to, the default port if no name is given",
+    )
+    parser.add_argument(
+        "--realtime",
+        action="store_true",
+        help="Replay the file at the speed of the performance",
+    )
+    parser.add_argument(
+        "--key", help='The key of the piece, such as "A major", estimated if not given'
+    )
+    parser.add_argument(
+        "--lookahead",
+        type=int,
+        default=LOOKAHEAD_NOTES,
+        help="The notes received after a note before deciding if it ends a phrase",
+    )
+    parser.add_argument(
+        "--history",
+        type=int,
+        default=HISTORY_NOTES,
+        help="The decided notes kept as context",
+    )
+    parser.add_argument(
+        "--hop",
+        type=int,
+        default=HOP_NOTES,
+        help="The notes received between two segmentations",
+    )
+    args = parser.parse_args()
+
+    if args.file is not None:
+        events = read_file_events(args.file, args.realtime)
+    else:
+        events = read_port_events(args.port or None)
+    key = music21.key.Key(*args.key.split()) if args.key else None
+
+    for phrase in segment_stream(events, key, args.lookahead, args.history, args.hop):
+        print_phrase(phrase)
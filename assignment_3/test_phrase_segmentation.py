@@ -0,0 +1,91 @@
+import numpy as np
+import pretty_midi
+import music21
+import tracemalloc
+
+import phrase_segmentation
+
+
+def get_held_note_piece(nr_notes):
+    """Return the start, end and pitch arrays of a piece of short notes over one note held during the whole piece,
+    the held note coming first.
+
+    Args:
+        nr_notes: The number of notes of the piece.
+    """
+    starts = np.arange(nr_notes) * 0.1
+    ends = starts + 0.09
+    pitches = 40 + np.arange(nr_notes) % 40
+    ends[0] = nr_notes * 0.1 + 1
+    pitches[0] = 30
+    return starts, ends, pitches
+
+
+def get_reference_concurrent_notes(starts, ends, pitches):
+    """Return the concurrent notes of every note, found by scanning the notes one at a time.
+
+    Args:
+        starts: The start times of the notes.
+        ends: The end times of the notes.
+        pitches: The pitches of the notes.
+    """
+    max_starts = np.maximum.accumulate(starts)
+    concurrent_notes = []
+    for curr_note_idx in range(len(starts)):
+        stop_idx = np.searchsorted(max_starts, ends[curr_note_idx], side="right")
+        curr_concurrent_notes = []
+        for other_note_idx in range(len(starts)):
+            if pitches[other_note_idx] == pitches[curr_note_idx]:
+                continue
+            is_overlapping = (
+                starts[other_note_idx] <= ends[curr_note_idx]
+                and ends[other_note_idx] >= starts[curr_note_idx]
+            )
+            if (
+                other_note_idx >= stop_idx
+                and starts[other_note_idx] > ends[curr_note_idx]
+            ):
+                break
+            if is_overlapping:
+                curr_concurrent_notes.append(other_note_idx)
+        concurrent_notes.append(curr_concurrent_notes)
+    return concurrent_notes
+
+
+def test_concurrent_notes_with_held_note():
+    starts, ends, pitches = get_held_note_piece(300)
+    offsets, concurrent_idx = phrase_segmentation.get_concurrent_notes_arrays(
+        starts, ends, pitches
+    )
+    reference = get_reference_concurrent_notes(starts, ends, pitches)
+    for curr_note_idx, curr_concurrent_notes in enumerate(reference):
+        assert (
+            concurrent_idx[offsets[curr_note_idx] : offsets[curr_note_idx + 1]].tolist()
+            == curr_concurrent_notes
+        )
+
+
+def test_concurrent_notes_with_held_note_are_linear():
+    nr_notes = 20000
+    starts, ends, pitches = get_held_note_piece(nr_notes)
+    tracemalloc.start()
+    try:
+        offsets, concurrent_idx = phrase_segmentation.get_concurrent_notes_arrays(
+            starts, ends, pitches
+        )
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # the held note is concurrent with every other note, and every other note with the held note only
+    assert len(concurrent_idx) <= 2 * nr_notes
+    assert peak_bytes < 64 * nr_notes * 8
+
+
+def test_split_phrases_with_held_note():
+    notes = [
+        pretty_midi.Note(80, int(pitch), start, end)
+        for start, end, pitch in zip(*get_held_note_piece(2000))
+    ]
+    context = phrase_segmentation.SegmentationContext(music21.key.Key("C"))
+    phrases = phrase_segmentation.split_phrases(notes, context)
+    assert sum(len(phrase) for phrase in phrases) == len(notes)
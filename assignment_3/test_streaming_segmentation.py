@@ -0,0 +1,47 @@
+import numpy as np
+import pretty_midi
+import music21
+
+import streaming_segmentation
+
+
+def get_random_stream(seed, nr_notes=300):
+    """Return random notes in the order of their end, as received from a stream.
+
+    Args:
+        seed: The seed of the random generator.
+        nr_notes: The number of notes.
+    """
+    rng = np.random.default_rng(seed)
+    starts = np.cumsum(rng.exponential(0.15, nr_notes))
+    ends = starts + rng.exponential(0.3, nr_notes) + 0.01
+    pitches = rng.integers(40, 90, nr_notes)
+    velocities = rng.integers(20, 120, nr_notes)
+    return [
+        pretty_midi.Note(
+            int(velocities[note_idx]),
+            int(pitches[note_idx]),
+            float(starts[note_idx]),
+            float(ends[note_idx]),
+        )
+        for note_idx in np.argsort(ends, kind="stable")
+    ]
+
+
+def test_emitted_phrases_are_not_empty():
+    for seed in range(20):
+        segmenter = streaming_segmentation.StreamingSegmenter(music21.key.Key("C"))
+        phrases = []
+        for note in get_random_stream(seed):
+            phrases += segmenter.add_note(note)
+        phrases += segmenter.finish()
+
+        assert len(phrases) > 0
+        for phrase in phrases:
+            assert phrase.end_idx > phrase.start_idx
+            assert phrase.end_time >= phrase.start_time
+        assert [phrase.phrase_idx for phrase in phrases] == list(range(len(phrases)))
+        assert phrases[0].start_idx == 0
+        assert phrases[-1].end_idx == segmenter.nr_notes
+        for phrase, next_phrase in zip(phrases, phrases[1:]):
+            assert phrase.end_idx == next_phrase.start_idx
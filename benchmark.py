@@ -0,0 +1,447 @@
+import numpy as np
+import pretty_midi
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPOSITORY_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(REPOSITORY_FOLDER, "assignment_2"))
+sys.path.insert(0, os.path.join(REPOSITORY_FOLDER, "assignment_3"))
+
+import phrase_segmentation
+import transform
+
+
+# Constants
+DEFAULT_SIZES = [1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000]
+DEFAULT_POLYPHONY = 3  # the average number of notes of the chords of the left hand
+DEFAULT_MAX_SECONDS = 60  # the larger sizes are skipped once a run takes longer
+DEFAULT_OUTPUT_FILE = "benchmark_results.json"
+# The duration of a sixteenth note of the synthetic performances
+SIXTEENTH_DURATION = 0.15
+# The ticks per beat of the synthetic performances, lower than the default of pretty_midi so the largest
+# performances stay below the largest tick it accepts
+SYNTHETIC_RESOLUTION = 96
+PHRASE_ONSETS = 32  # the melody notes of a synthetic phrase, followed by a silence
+PHRASE_SILENCE = 0.5
+TRILL_PROBABILITY = 0.01
+MAJOR_SCALE = [0, 2, 4, 5, 7, 9, 11]
+PHRASE_SEGMENTATION_FIXTURES = [
+    os.path.join(REPOSITORY_FOLDER, "assignment_3", "Stahievitch02.mid"),
+    os.path.join(REPOSITORY_FOLDER, "assignment_3", "larger_corpus"),
+]
+TRANSFORM_FIXTURES = [os.path.join(REPOSITORY_FOLDER, "assignment_2", "midi_score.mid")]
+
+
+def make_performance(nr_notes, polyphony=DEFAULT_POLYPHONY, seed=0):
+    """Return a synthetic piano performance of about nr_notes notes, the right hand playing a melody in phrases
+    separated by silences, with repeated notes and trills, and the left hand playing chords on every beat.
+
+    Args:
+        nr_notes: The number of notes of the performance.
+        polyphony: The average number of notes of the chords of the left hand.
+        seed: The seed of the random generator.
+    """
+    rng = np.random.default_rng(seed)
+    piano = pretty_midi.PrettyMIDI(resolution=SYNTHETIC_RESOLUTION)
+    right_hand = pretty_midi.Instrument(program=0, name="Right hand")
+    left_hand = pretty_midi.Instrument(program=0, name="Left hand")
+    piano.instruments.extend([right_hand, left_hand])
+
+    tonic = int(rng.integers(12))
+    current_time = 0.0
+    velocity = 70
+    pitch = 72 + tonic
+    nr_generated = 0
+    onset_idx = 0
+    while nr_generated < nr_notes:
+        if onset_idx % PHRASE_ONSETS == 0:
+            current_time += PHRASE_SILENCE
+            velocity = int(rng.integers(40, 100))
+
+        # the left hand plays a chord of the key on every beat
+        if onset_idx % 4 == 0:
+            chord_size = max(1, int(rng.poisson(polyphony)))
+            root = 48 + tonic + MAJOR_SCALE[int(rng.integers(7))]
+            for i in range(chord_size):
+                left_hand.notes.append(
+                    pretty_midi.Note(
+                        max(1, velocity - 20 + int(rng.integers(-5, 6))),
+                        root - 12 * (i // 3) + (0, 4, 7)[i % 3],
+                        current_time,
+                        current_time + 4 * SIXTEENTH_DURATION * rng.uniform(0.8, 1.0),
+                    )
+                )
+            nr_generated += chord_size
+
+        # the melody moves by steps, repeating its note or playing a trill from time to time
+        if rng.random() < TRILL_PROBABILITY:
+            for _ in range(3):
+                right_hand.notes.append(
+                    pretty_midi.Note(velocity, pitch, current_time, current_time + 0.04)
+                )
+                current_time += 0.05
+            nr_generated += 3
+        elif rng.random() < 0.8:
+            pitch = int(np.clip(pitch + rng.integers(-2, 3), 60 + tonic, 84 + tonic))
+        nr_sixteenths = int(rng.choice([1, 2, 4], p=[0.5, 0.35, 0.15]))
+        duration = nr_sixteenths * SIXTEENTH_DURATION
+        right_hand.notes.append(
+            pretty_midi.Note(
+                int(np.clip(velocity + rng.integers(-8, 9), 1, 127)),
+                pitch,
+                current_time,
+                current_time + duration * rng.uniform(0.7, 1.0),
+            )
+        )
+        nr_generated += 1
+        current_time += duration
+        onset_idx += 1
+    return piano
+
+
+def write_performance(piano, midi_file, merge_hands=False):
+    """Write the synthetic performance into a MIDI file.
+
+    Args:
+        piano: The synthetic performance.
+        midi_file: The output MIDI file.
+        merge_hands: Whether to write both hands in a single track, as the performances of the corpus.
+    """
+    if merge_hands:
+        merged_piano = pretty_midi.PrettyMIDI(resolution=piano.resolution)
+        merged_instrument = pretty_midi.Instrument(program=0)
+        merged_instrument.notes = [
+            note for instrument in piano.instruments for note in instrument.notes
+        ]
+        merged_piano.instruments.append(merged_instrument)
+        piano = merged_piano
+    piano.write(midi_file)
+
+
+@contextlib.contextmanager
+def measure(stages, name):
+    """Measure the duration of the stage and, when tracemalloc is tracing, its peak memory.
+
+    Args:
+        stages: The measures of the stages, the measure of this stage is added to it.
+        name: The name of the stage.
+    """
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+    start_time = time.perf_counter()
+    yield
+    stages[name] = {"seconds": time.perf_counter() - start_time}
+    if tracemalloc.is_tracing():
+        stages[name]["peak_bytes"] = tracemalloc.get_traced_memory()[1] - start_memory
+
+
+def run_phrase_segmentation(midi_file, output_folder, export_format="npz", seed=0):
+    """Segment the MIDI file as segment_file does and return the measures of each stage.
+
+    Args:
+        midi_file: The performed MIDI file.
+        output_folder: The output phrases folder.
+        export_format: The format of the written phrases, see phrase_segmentation.write_phrases.
+        seed: Unused, the segmentation is deterministic.
+    """
+    stages = {}
+    with measure(stages, "load"):
+        piano = pretty_midi.PrettyMIDI(midi_file)
+        notes = piano.instruments[0].notes
+    with measure(stages, "key"):
+        context = phrase_segmentation.SegmentationContext(
+            phrase_segmentation.estimate_key(
+                [note for instrument in piano.instruments for note in instrument.notes]
+            )
+        )
+    with measure(stages, "trills"):
+        context.trills = phrase_segmentation.identify_trill(notes)
+    with measure(stages, "boundaries"):
+        phrase_segmentation.split_phrases(notes, context)
+    with measure(stages, "export"):
+        filename = os.path.basename(midi_file).split(".")[0]
+        phrase_segmentation.write_phrases(
+            context.phrases, output_folder, filename, False, export_format
+        )
+    return stages
+
+
+def run_transform(midi_file, output_folder, export_format=None, seed=0):
+    """Transform the MIDI file with the stages of the default pipeline of transform.py, in order, and return the
+    measures of each stage.
+
+    Args:
+        midi_file: The unperformed MIDI file, with the melody and the bass as first instruments.
+        output_folder: The output folder of the performed MIDI file.
+        export_format: Unused, the performance is written as a MIDI file.
+        seed: The seed of the humanization.
+    """
+    stages = {}
+    with measure(stages, "load"):
+        piano = pretty_midi.PrettyMIDI(midi_file)
+        performance = transform.Performance(piano, seed=seed)
+    for name in transform.DEFAULT_PIPELINE:
+        with measure(stages, name):
+            transform.PIPELINE_STAGES[name].function(performance)
+    with measure(stages, "write"):
+        transform.write_performance(
+            performance, os.path.join(output_folder, os.path.basename(midi_file))
+        )
+    return stages
+
+
+def run_stages(run, midi_file, export_format, seed, trace_memory):
+    """Run the stages on the MIDI file once to time them and, if asked, once more under tracemalloc to measure
+    their peak memory, which would otherwise slow down the timed run. Return the measures of each stage.
+
+    Args:
+        run: The function running the stages, run_phrase_segmentation or run_transform.
+        midi_file: The input MIDI file.
+        export_format: The format of the written phrases.
+        seed: The seed of the random effects.
+        trace_memory: Whether to measure the peak memory of the stages.
+    """
+    with tempfile.TemporaryDirectory() as output_folder:
+        stages = run(midi_file, output_folder, export_format, seed)
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            with tempfile.TemporaryDirectory() as output_folder:
+                memory_stages = run(midi_file, output_folder, export_format, seed)
+        finally:
+            tracemalloc.stop()
+        for name, measures in memory_stages.items():
+            stages[name]["peak_bytes"] = measures["peak_bytes"]
+    return stages
+
+
+def get_scaling_exponents(runs):
+    """Return the exponent of the growth of the duration of each stage with the number of notes, i.e. the slope
+    of the log-log curve of the duration against the number of notes.
+
+    Args:
+        runs: The runs of a script on the synthetic performances.
+    """
+    exponents = {}
+    if len(runs) < 2:
+        return exponents
+    nr_notes = np.array([run["nr_notes"] for run in runs], dtype=np.float64)
+    for name in runs[0]["stages"]:
+        seconds = np.array([run["stages"][name]["seconds"] for run in runs])
+        exponents[name] = float(
+            np.polyfit(np.log(nr_notes), np.log(np.maximum(seconds, 1e-9)), 1)[0]
+        )
+    return exponents
+
+
+def benchmark_synthetic(
+    run, sizes, polyphony, seed, max_seconds, export_format, trace_memory, merge_hands
+):
+    """Run the stages on synthetic performances of increasing sizes and return the list of runs. The larger
+    sizes are skipped once a run takes longer than max_seconds.
+
+    Args:
+        run: The function running the stages, run_phrase_segmentation or run_transform.
+        sizes: The numbers of notes of the synthetic performances.
+        polyphony: The average number of notes of the chords of the left hand.
+        seed: The seed of the synthetic performances and of the random effects.
+        max_seconds: The duration of a run after which the larger sizes are skipped.
+        export_format: The format of the written phrases.
+        trace_memory: Whether to measure the peak memory of the stages.
+        merge_hands: Whether to write both hands in a single track.
+    """
+    runs = []
+    with tempfile.TemporaryDirectory() as input_folder:
+        for nr_notes in sorted(sizes):
+            piano = make_performance(nr_notes, polyphony, seed)
+            midi_file = os.path.join(input_folder, f"synthetic_{nr_notes}.mid")
+            write_performance(piano, midi_file, merge_hands)
+            stages = run_stages(run, midi_file, export_format, seed, trace_memory)
+            total_seconds = sum(measures["seconds"] for measures in stages.values())
+            runs.append(
+                {
+                    "nr_notes": sum(len(i.notes) for i in piano.instruments),
+                    "total_seconds": total_seconds,
+                    "stages": stages,
+                }
+            )
+            print(f"{run.__name__}: {nr_notes} notes in {total_seconds:.3f}s")
+            if total_seconds > max_seconds:
+                print(f"{run.__name__}: larger sizes skipped")
+                break
+    return runs
+
+
+def benchmark_fixtures(run, fixtures, seed, export_format, trace_memory):
+    """Run the stages on the MIDI files of the repository and return the list of runs.
+
+    Args:
+        run: The function running the stages, run_phrase_segmentation or run_transform.
+        fixtures: The MIDI files, or folders of MIDI files.
+        seed: The seed of the random effects.
+        export_format: The format of the written phrases.
+        trace_memory: Whether to measure the peak memory of the stages.
+    """
+    midi_files = []
+    for fixture in fixtures:
+        if os.path.isdir(fixture):
+            midi_files.extend(
+                sorted(
+                    os.path.join(fixture, file)
+                    for file in os.listdir(fixture)
+                    if file.lower().endswith(phrase_segmentation.MIDI_EXTENSIONS)
+                )
+            )
+        else:
+            midi_files.append(fixture)
+
+    runs = []
+    for midi_file in midi_files:
+        stages = run_stages(run, midi_file, export_format, seed, trace_memory)
+        nr_notes = sum(
+            len(instrument.notes)
+            for instrument in pretty_midi.PrettyMIDI(midi_file).instruments
+        )
+        total_seconds = sum(measures["seconds"] for measures in stages.values())
+        runs.append(
+            {
+                "file": os.path.relpath(midi_file, REPOSITORY_FOLDER),
+                "nr_notes": nr_notes,
+                "total_seconds": total_seconds,
+                "stages": stages,
+            }
+        )
+        print(f"{run.__name__}: {midi_file} in {total_seconds:.3f}s")
+    return runs
+
+
+def compare_results(results, previous_results):
+    """Print the ratio of the duration of each stage to its duration in the previous results, for the runs
+    present in both.
+
+    Args:
+        results: The benchmark results.
+        previous_results: The benchmark results of a previous run.
+    """
+    for script, script_results in results["scripts"].items():
+        previous_script_results = previous_results["scripts"].get(script, {})
+        for kind in ("synthetic", "fixtures"):
+            previous_runs = {
+                run.get("file", run["nr_notes"]): run
+                for run in previous_script_results.get(kind, [])
+            }
+            for run in script_results[kind]:
+                previous_run = previous_runs.get(run.get("file", run["nr_notes"]))
+                if previous_run is None:
+                    continue
+                ratios = ", ".join(
+                    f"{name} x{measures['seconds'] / max(previous_run['stages'][name]['seconds'], 1e-9):.2f}"
+                    for name, measures in run["stages"].items()
+                    if name in previous_run["stages"]
+                )
+                print(f"{script} {run.get('file', run['nr_notes'])}: {ratios}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SIZES,
+        help="The numbers of notes of the synthetic performances",
+    )
+    parser.add_argument(
+        "--polyphony",
+        type=float,
+        default=DEFAULT_POLYPHONY,
+        help="The average number of notes of the chords of the left hand",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        default=DEFAULT_MAX_SECONDS,
+        help="The duration of a run after which the larger sizes are skipped",
+    )
+    parser.add_argument(
+        "--scripts",
+        nargs="+",
+        choices=["phrase_segmentation", "transform"],
+        default=["phrase_segmentation", "transform"],
+    )
+    parser.add_argument(
+        "--format",
+        choices=phrase_segmentation.EXPORT_FORMATS,
+        default="npz",
+        help="The format of the exported phrases",
+    )
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="Skip the tracemalloc run measuring the peak memory of each stage",
+    )
+    parser.add_argument(
+        "--no-fixtures",
+        action="store_true",
+        help="Skip the MIDI files of the repository",
+    )
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_FILE)
+    parser.add_argument(
+        "--compare", help="The results of a previous run to compare the durations to"
+    )
+    args = parser.parse_args()
+
+    scripts = {
+        "phrase_segmentation": (run_phrase_segmentation, PHRASE_SEGMENTATION_FIXTURES),
+        "transform": (run_transform, TRANSFORM_FIXTURES),
+    }
+    results = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "polyphony": args.polyphony,
+        "scripts": {},
+    }
+    for script in args.scripts:
+        run, fixtures = scripts[script]
+        synthetic_runs = benchmark_synthetic(
+            run,
+            args.sizes,
+            args.polyphony,
+            args.seed,
+            args.max_seconds,
+            args.format,
+            not args.no_memory,
+            script == "phrase_segmentation",
+        )
+        results["scripts"][script] = {
+            "synthetic": synthetic_runs,
+            "scaling_exponents": get_scaling_exponents(synthetic_runs),
+            "fixtures": (
+                []
+                if args.no_fixtures
+                else benchmark_fixtures(
+                    run, fixtures, args.seed, args.format, not args.no_memory
+                )
+            ),
+        }
+
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results saved in {args.output}")
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            compare_results(results, json.load(previous_file))